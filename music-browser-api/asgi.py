@@ -0,0 +1,19 @@
+import sys
+
+from src import app as flask_app, asgi_app
+from src.services.shared_service import supported_data_provider
+
+
+if flask_app.config['DATA_PROVIDER'] is None:
+    print('Missing data provider configuration, shutting down')
+    sys.exit()
+
+if not supported_data_provider(flask_app.config['DATA_PROVIDER']):
+    print('Unsupported data provider, shutting down')
+    sys.exit()
+
+print('Starting the Music Browser API')
+
+# Served with an ASGI server, e.g. uvicorn asgi:app. Behind a proxy, the server is the one to apply the forwarded headers (with uvicorn's
+# --proxy-headers option), since the ProxyFix used by app.py only wraps the WSGI app.
+app = asgi_app
@@ -0,0 +1,266 @@
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from src.enums.enums import EntityType
+from src.services.music_brainz_service import build_artist, build_discography_list, build_release_tracks, build_song, build_search_results, \
+                                              build_tag_list
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baselines', 'builders.json')
+
+# The generators are seeded, so every run builds exactly the same payloads
+SEED = 1234
+
+# Changes smaller than these never count as a regression, whatever the percentage, since the fastest builders only take a millisecond or so and
+# are at the mercy of the machine's noise
+MIN_TIME_CHANGE = 0.0005
+MIN_MEMORY_CHANGE = 16 * 1024
+
+# Each builder is timed for at least this many seconds, however many rounds that takes, so the quick ones get enough rounds for their fastest
+# to be a fair one. The time is split over this many passes through all of the builders.
+MIN_DURATION = 2.0
+PASSES = 5
+
+
+def make_tags(rng: random.Random, count: int):
+    return list(map(lambda x: {'id': f'tag-{x}', 'name': f'tag {x}', 'count': str(rng.randint(0, 500))}, range(count)))
+
+
+def make_date(rng: random.Random):
+    return f'{rng.randint(1950, 2024)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}'
+
+
+def make_release_groups(rng: random.Random, count: int):
+    types = ['Album', 'Album', 'Single', 'EP', 'Compilation', 'Live']
+
+    return list(map(lambda x: {'id': f'rg-{x}', 'title': f'Release group {x}', 'type': rng.choice(types), 'primary-type': 'Album',
+                               'first-release-date': make_date(rng)}, range(count)))
+
+
+def make_album_images(release_groups: list):
+    return {x['id']: [{'url': f'https://images.example/{x['id']}.jpg'}] for x in release_groups[::2]}
+
+
+def make_orchestra(rng: random.Random, member_count: int, release_group_count: int, tag_count: int):
+    """
+        An artist the size of a large orchestra, with thousands of member relations (a quarter of them repeats of someone already listed, as
+        happens when a member has played in more than one period), hundreds of tags and a long list of links.
+    """
+    relations = []
+
+    for index in range(member_count):
+        person = index if index % 4 else rng.randrange(max(index, 1))
+        relations.append({'type': 'member of band', 'begin': str(rng.randint(1900, 2020)), 'ended': 'true',
+                          'artist': {'id': f'person-{person}', 'name': f'Member {person}', 'type': 'Person'}})
+
+    link_types = ['allmusic', 'discogs', 'songkick', 'setlistfm', 'fanpage'] * 20
+    links = list(map(lambda x: {'type': x, 'target': f'https://{x}.example/artist'}, link_types))
+    release_groups = make_release_groups(rng, release_group_count)
+    artist = {'id': 'orchestra', 'name': 'The Orchestra', 'type': 'Orchestra', 'life-span': {'begin': '1900'}, 'tag-list': make_tags(rng, tag_count),
+              'genre-list': make_tags(rng, tag_count), 'artist-relation-list': relations, 'url-relation-list': links}
+
+    return [{'artist': artist}, {'release-group-list': release_groups, 'release-group-count': len(release_groups)},
+            [{'url': 'https://images.example/a.jpg'}], make_album_images(release_groups)]
+
+
+def make_box_set(rng: random.Random, medium_count: int, track_count: int):
+    """A box set's media, each with a full track list where every track has its own artist credit"""
+    return list(map(lambda medium: {'position': str(medium + 1), 'format': 'CD', 'track-list': list(map(lambda track: {
+        'length': str(rng.randint(60000, 900000)),
+        'recording': {'id': f'recording-{medium}-{track}', 'title': f'Track {track + 1}'},
+        'artist-credit': [{'artist': {'id': f'artist-{track % 7}', 'name': f'Artist {track % 7}'}}]
+    }, range(track_count)))}, range(medium_count)))
+
+
+def make_song(rng: random.Random, release_count: int, tag_count: int):
+    """A song that has been released on a great many compilations and reissues, many of them versions of the same release group"""
+    releases = []
+
+    for index in range(release_count):
+        release_group = {'id': f'rg-{index % (release_count // 3)}', 'title': f'Album {index}', 'type': rng.choice(['Album', 'Album', 'Compilation'])}
+        releases.append({'id': f'release-{index}', 'title': f'Album {index}', 'date': make_date(rng), 'country': 'GB', 'release-group': release_group,
+                         'release-event-list': [{'date': make_date(rng), 'area': {'name': '[Worldwide]'}}],
+                         'artist-credit': [{'artist': {'id': 'artist-1', 'name': 'Artist 1'}}]})
+
+    recording = {'id': 'song', 'title': 'The Song', 'length': '245000', 'first-release-date': '1975-10-31', 'tag-list': make_tags(rng, tag_count),
+                 'artist-credit': [{'artist': {'id': 'artist-1', 'name': 'Artist 1'}}], 'url-relation-list': []}
+
+    return [{'recording': recording}, {'release-list': releases, 'release-count': len(releases)}]
+
+
+def make_song_search(rng: random.Random, row_count: int, tag_count: int):
+    rows = list(map(lambda x: {'id': f'recording-{x}', 'title': f'Song {x}', 'ext:score': str(100 - x % 100), 'artist-credit-phrase': f'Artist {x}',
+                               'artist-credit': [{'artist': {'id': f'artist-{x}', 'name': f'Artist {x}'}}],
+                               'release-list': [{'release-group': {'id': f'rg-{x}', 'title': f'Album {x}'}}],
+                               'tag-list': make_tags(rng, tag_count)}, range(row_count)))
+
+    return {'recording-list': rows, 'recording-count': str(row_count)}
+
+
+def get_benchmarks():
+    """Each benchmark is a function to time, along with the arguments it is called with, which are built once up front"""
+    rng = random.Random(SEED)
+    orchestra = make_orchestra(rng, 3000, 500, 300)
+    discography = make_release_groups(rng, 2000)
+    box_set = make_box_set(rng, 20, 40)
+    song = make_song(rng, 2000, 200)
+
+    return {
+        'build_artist/orchestra': (build_artist, [orchestra, 'A description']),
+        'build_discography_list/artist': (build_discography_list, [[{'release-group-list': discography, 'release-group-count': len(discography)},
+                                                                     make_album_images(discography)], EntityType.ARTIST.value, False]),
+        'build_discography_list/song': (build_discography_list, [[song[1], {}], EntityType.SONG.value, True]),
+        'build_release_tracks/box_set': (lambda media: list(map(build_release_tracks, media)), [box_set]),
+        'build_song/compilations': (build_song, [song]),
+        'build_search_results/songs': (build_search_results, [EntityType.SONG, 'recording-list', 'recording-count', make_song_search(rng, 100, 50)]),
+        'build_tag_list/large': (build_tag_list, [make_tags(rng, 1000)])
+    }
+
+
+def time_rounds(function, args: list, rounds: int, duration: float):
+    """
+        Times at least the given number of rounds, and however many more fit in the duration. The garbage collector is off while timing, as it
+        is for timeit, so a collection of whatever another benchmark left behind isn't charged to this one.
+    """
+    durations = []
+    gc.collect()
+    gc.disable()
+
+    try:
+        end_time = time.perf_counter() + duration
+
+        while len(durations) < rounds or time.perf_counter() < end_time:
+            begin_time = time.perf_counter()
+            function(*args)
+            durations.append(time.perf_counter() - begin_time)
+    finally:
+        gc.enable()
+
+    return durations
+
+
+def measure_memory(function, args: list):
+    """
+        The peak allocated while building the result once. It's measured apart from the timing, since tracing allocations slows everything down.
+    """
+    tracemalloc.start()
+    function(*args)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak_memory
+
+
+def run_benchmarks(name_filter: str, rounds: int):
+    """
+        Each builder is warmed up with one round, then timed for at least the given number of rounds and MIN_DURATION seconds in total. The
+        timing is spread over PASSES passes through all of the builders, so a spell where the machine is busy with something else slows every
+        builder a little rather than one of them a lot.
+    """
+    benchmarks = {name: benchmark for name, benchmark in get_benchmarks().items() if not name_filter or name_filter in name}
+    durations = {name: [] for name in benchmarks}
+
+    for function, args in benchmarks.values():
+        function(*args)
+
+    for _ in range(PASSES):
+        for name, (function, args) in benchmarks.items():
+            durations[name] += time_rounds(function, args, math.ceil(rounds / PASSES), MIN_DURATION / PASSES)
+
+    results = {}
+
+    for name, (function, args) in benchmarks.items():
+        result = results[name] = {'median': statistics.median(durations[name]), 'min': min(durations[name]),
+                                  'stdev': statistics.stdev(durations[name]) if len(durations[name]) > 1 else 0.0,
+                                  'rounds': len(durations[name]), 'peak_memory': measure_memory(function, args)}
+        print(f'{name:<34}{result['median'] * 1000:>10.2f} ms{result['min'] * 1000:>10.2f} ms{result['peak_memory'] / 1024:>10.0f} KiB')
+
+    return results
+
+
+def get_machine():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor() or platform.machine()}
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """
+        Returns the names of the benchmarks that got slower, or used more memory, than the baseline by more than the threshold (a fraction, so
+        0.2 allows for 20%) and by more than MIN_TIME_CHANGE or MIN_MEMORY_CHANGE. Times are compared by their fastest round, which is the one
+        least disturbed by whatever else the machine was doing. Benchmarks that aren't in the baseline are listed but never count as a regression.
+    """
+    regressions = []
+
+    print(f'\n{'benchmark':<34}{'min':>10}{'baseline':>12}{'change':>9}{'memory':>12}{'baseline':>12}{'change':>9}')
+
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+
+        if base is None:
+            print(f'{name:<34}{result['min'] * 1000:>8.2f}ms{'(new)':>12}')
+            continue
+
+        time_change = result['min'] / base['min'] - 1 if base['min'] else 0.0
+        memory_change = result['peak_memory'] / base['peak_memory'] - 1 if base['peak_memory'] else 0.0
+        regressed = (time_change > threshold and result['min'] - base['min'] > MIN_TIME_CHANGE) or \
+                    (memory_change > threshold and result['peak_memory'] - base['peak_memory'] > MIN_MEMORY_CHANGE)
+
+        print(f'{name:<34}{result['min'] * 1000:>8.2f}ms{base['min'] * 1000:>10.2f}ms{time_change:>+9.0%}'
+              f'{result['peak_memory'] / 1024:>9.0f}KiB{base['peak_memory'] / 1024:>9.0f}KiB{memory_change:>+9.0%}'
+              f'{'  REGRESSION' if regressed else ''}')
+
+        if regressed:
+            regressions.append(name)
+
+    if baseline.get('machine') != get_machine():
+        print('\nThe baseline was recorded on a different machine or Python version, so the times may not be comparable')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the response builders, and the memory they use, on very large synthetic payloads')
+    parser.add_argument('command', choices=['run', 'save', 'compare'], help='run just reports the results, save stores them as the baseline, and '
+                                                                            'compare checks them against the baseline')
+    parser.add_argument('--filter', help='Only run the benchmarks whose names contain this')
+    parser.add_argument('--rounds', type=int, default=30, help='The fewest times each builder is timed')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='The baseline file to save to or compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='How much slower or bigger than the baseline counts as a regression')
+    args = parser.parse_args()
+
+    print(f'{'benchmark':<34}{'median':>13}{'min':>13}{'peak memory':>14}')
+    results = run_benchmarks(args.filter, args.rounds)
+
+    if args.command == 'save':
+        baseline = {'machine': get_machine(), 'results': results}
+
+        # When only some of the benchmarks were run, the others keep their existing baselines
+        if args.filter and os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as file:
+                baseline['results'] = json.load(file)['results'] | results
+
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+
+        print(f'\nBaseline saved to {args.baseline}')
+    elif args.command == 'compare':
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+
+        if regressions:
+            print(f'\n{len(regressions)} regressed: {', '.join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from werkzeug.exceptions import HTTPException
+
+from benchmarks.stub_upstreams import start_stub_upstreams, stop_stub_upstreams
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Requests for the routes that don't belong to an entity, which are made along with each pass over the workload
+OTHER_URLS = ['/', '/stats', '/metrics', '/favicon', '/robots933456.txt']
+
+
+def read_workload(path: str, page_size: int):
+    """
+        The workload file has the same entity lines as the input to warm_cache.py, each of which is turned into the requests a visitor would make
+        for that entity. It can also have searches, as "search <entity type> <query>", songs picked from an album's track list, as
+        "track <release group MBID> <position>", and lines starting with / are requested as they are.
+    """
+    # This imports the service, so it can only be done once the service has been configured
+    from warm_cache import read_entry, get_urls
+    from src.enums.enums import EntityType
+
+    urls = []
+
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+
+            if line.startswith('/'):
+                urls.append(line)
+            elif line.startswith('search '):
+                _, entity_type, query = line.split(maxsplit=2)
+                urls.append(f'/search/{entity_type}?{urllib.parse.urlencode({'query': query, 'pageSize': page_size})}')
+            elif line.startswith('track '):
+                _, album_id, position = line.split()
+                urls.extend(get_urls(f'{EntityType.SONG.value} {get_track_id(album_id, int(position))}', page_size))
+            else:
+                entry = read_entry(line, line_number, None)
+
+                if entry:
+                    urls.extend(get_urls(entry, page_size))
+
+    return urls + OTHER_URLS
+
+
+def get_track_id(album_id: str, position: int):
+    """
+        The MBID of the recording at the given position on the album's first medium, which is found with a lookup of the album. When recording,
+        the lookup is recorded along with everything else, so the same song is found when the fixtures are replayed.
+    """
+    from src import app
+
+    response = app.test_client().get(f'/lookup/album/{album_id}')
+
+    if response.status_code != 200:
+        raise ValueError(f'The track list of album {album_id} could not be read ({response.status_code})')
+
+    return response.get_json()['trackList'][0]['tracks'][position - 1]['id']
+
+
+def configure_service(settings: dict, args):
+    """The service reads its settings when it is first imported, so these have to be in place before that"""
+    work_dir = tempfile.mkdtemp(prefix='music-browser-benchmark-')
+
+    os.environ.update(settings)
+    os.environ['DATA_PROVIDER'] = 'music-brainz'
+    os.environ['ASYNC_PROVIDER'] = str(args.async_provider).lower()
+    os.environ['CACHE_TYPE'] = 'FileSystemCache' if getattr(args, 'cached', False) else 'NullCache'
+    os.environ['CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    os.environ['COALESCE_LOCK_DIR'] = os.path.join(work_dir, 'locks')
+    os.environ['MUSIC_BRAINZ_RATE_LIMIT_FILE'] = os.path.join(work_dir, 'mb-rate-limit')
+
+    # The stand-ins don't need protecting, so unless asked to, MusicBrainz calls aren't held back by the rate limiter when replaying
+    if args.command == 'run':
+        os.environ['MUSIC_BRAINZ_RATE_LIMIT_INTERVAL'] = str(args.mb_interval)
+
+
+def get_route(app, url: str):
+    try:
+        return app.url_map.bind('localhost').match(url.split('?')[0])[0]
+    except HTTPException:
+        return url.split('?')[0]
+
+
+def run_requests(app, urls: list, concurrency: int, total_requests: int, duration: float):
+    """Each worker takes the next URL from the workload, round and round, until the request count or the duration is used up"""
+    next_url = itertools.cycle(urls)
+    lock = threading.Lock()
+    results = []
+    end_time = time.monotonic() + duration if duration else None
+
+    def work():
+        client = app.test_client()
+
+        while True:
+            with lock:
+                if (end_time and time.monotonic() >= end_time) or (not end_time and len(results) >= total_requests):
+                    return
+
+                url = next(next_url)
+                results.append(None)
+                index = len(results) - 1
+
+            begin_time = time.monotonic()
+            response = client.get(url)
+            results[index] = {'route': get_route(app, url), 'duration': time.monotonic() - begin_time, 'status': response.status_code}
+
+    begin_time = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(map(lambda x: x.result(), [executor.submit(work) for _ in range(concurrency)]))
+
+    return results, time.monotonic() - begin_time
+
+
+def get_percentile(durations: list, percentile: float):
+    """Nearest-rank percentile of an already sorted list"""
+    return durations[min(int(len(durations) * percentile / 100), len(durations) - 1)]
+
+
+def get_summary(results: list, total_time: float):
+    summary = {'requests': len(results), 'seconds': total_time, 'rps': len(results) / total_time if total_time else 0, 'routes': {}}
+
+    for route in sorted(set(map(lambda x: x['route'], results))):
+        route_results = [x for x in results if x['route'] == route]
+        durations = sorted(map(lambda x: x['duration'], route_results))
+        summary['routes'][route] = {'requests': len(route_results), 'errors': len([x for x in route_results if x['status'] >= 400]),
+                                    'p50': get_percentile(durations, 50), 'p95': get_percentile(durations, 95), 'p99': get_percentile(durations, 99)}
+
+    durations = sorted(map(lambda x: x['duration'], results))
+    summary['all'] = {'requests': len(results), 'errors': len([x for x in results if x['status'] >= 400]), 'p50': get_percentile(durations, 50),
+                      'p95': get_percentile(durations, 95), 'p99': get_percentile(durations, 99)}
+
+    return summary
+
+
+def print_summary(summary: dict):
+    print(f'\n{summary['requests']} requests in {summary['seconds']:.2f}s, {summary['rps']:.1f} requests per second\n')
+    print(f'{'route':<24}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}')
+
+    for route, stats in list(summary['routes'].items()) + [('all', summary['all'])]:
+        print(f'{route:<24}{stats['requests']:>10}{stats['errors']:>8}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}')
+
+
+def print_missing_fixtures(stubs: dict):
+    for name, stub in stubs.items():
+        if stub.fixtures.missing:
+            print(f'\n{len(stub.fixtures.missing)} {name} requests had no fixture (run the record command to capture them), e.g.')
+            print(f'  {sorted(stub.fixtures.missing)[0]}')
+
+
+def record(args):
+    """Makes each request in the workload once, one at a time, with every upstream call passed on to the live servers and kept as a fixture"""
+    stubs, settings = start_stub_upstreams(args.fixtures, record=True)
+    configure_service(settings, args)
+
+    from src import app
+
+    try:
+        client = app.test_client()
+
+        for url in read_workload(args.workload, args.page_size):
+            response = client.get(url)
+            print(f'{response.status_code} {url}')
+    finally:
+        from src.services.executor_service import shutdown_executors
+        shutdown_executors(wait=True)
+        stop_stub_upstreams(stubs, save=True)
+
+    print(f'\nFixtures saved to {args.fixtures}: ' + ', '.join(f'{len(x.fixtures.fixtures)} {name}' for name, x in stubs.items()))
+
+
+def run(args):
+    stubs, settings = start_stub_upstreams(args.fixtures, args.latency / 1000, args.jitter / 1000)
+    configure_service(settings, args)
+
+    from src import app
+
+    try:
+        urls = read_workload(args.workload, args.page_size)
+
+        # With the caches on, a first pass fills them, so the measured requests show how the service does once it is warm
+        if args.cached:
+            run_requests(app, urls, args.concurrency, len(urls), 0)
+
+        results, total_time = run_requests(app, urls, args.concurrency, args.requests, args.duration)
+    finally:
+        from src.services.executor_service import shutdown_executors
+        shutdown_executors()
+        stop_stub_upstreams(stubs)
+
+    summary = get_summary(results, total_time)
+    print_summary(summary)
+    print_missing_fixtures(stubs)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(summary | {'settings': {key: value for key, value in vars(args).items() if key != 'func'}}, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the throughput and latency of the API, with local stand-ins for MusicBrainz, fanart and '
+                                                 'Wikipedia')
+    parser.add_argument('--workload', default=os.path.join(BENCHMARKS_DIR, 'workload.txt'), help='The entities, searches and paths to request')
+    parser.add_argument('--fixtures', default=os.path.join(BENCHMARKS_DIR, 'fixtures'), help='Where the upstream fixtures are kept')
+    parser.add_argument('--page-size', type=int, default=10, choices=[10, 25], help='The page size the requests are made with')
+    parser.add_argument('--async-provider', action='store_true', help='Use the async MusicBrainz provider')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='Capture the fixtures for the workload from the live upstreams')
+    record_parser.set_defaults(func=record)
+
+    run_parser = commands.add_parser('run', help='Run the workload against the stand-ins, and report the latency and throughput')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='How many requests are made at the same time')
+    run_parser.add_argument('--requests', type=int, default=200, help='How many requests are made in total')
+    run_parser.add_argument('--duration', type=float, help='Keep making requests for this many seconds, rather than a set number of them')
+    run_parser.add_argument('--latency', type=float, default=50, help='How long each upstream takes to answer, in milliseconds')
+    run_parser.add_argument('--jitter', type=float, default=20, help='The most the latency varies by either way, in milliseconds')
+    run_parser.add_argument('--mb-interval', type=float, default=0, help='The MusicBrainz rate limit interval, in seconds')
+    run_parser.add_argument('--cached', action='store_true', help='Keep the service caches on, and fill them before measuring')
+    run_parser.add_argument('--output', help='A file to write the results to, as JSON')
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+
+# The live servers each stand-in records from, and the setting that points the service at it
+UPSTREAMS = {
+    'musicbrainz': {'live_url': 'https://musicbrainz.org', 'setting': 'MUSIC_BRAINZ_URL'},
+    'fanart': {'live_url': 'https://webservice.fanart.tv/v3', 'setting': 'FANART_URL'},
+    'wikidata': {'live_url': 'https://www.wikidata.org', 'setting': 'WIKIDATA_URL'},
+    'wikipedia': {'live_url': 'https://en.wikipedia.org', 'setting': 'WIKIPEDIA_URL'}
+}
+
+# Query parameters that are left out of fixture keys, so recorded fixtures don't hold secrets and replay with any key
+IGNORED_PARAMETERS = ['api_key']
+
+
+def get_fixture_key(path: str):
+    """The path of a request, with its query parameters sorted, so the same request always maps to the same fixture"""
+    parts = urllib.parse.urlsplit(path)
+    query = sorted(filter(lambda x: x[0] not in IGNORED_PARAMETERS, urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+
+    return parts.path + ('?' + urllib.parse.urlencode(query) if query else '')
+
+
+class FixtureStore:
+    """The recorded responses for one upstream, kept in a JSON file of fixture keys to status, content type and body"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fixtures = {}
+        self.missing = set()
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                self.fixtures = json.load(file)
+
+
+    def get(self, key: str):
+        with self.lock:
+            fixture = self.fixtures.get(key)
+
+            if fixture is None:
+                self.missing.add(key)
+
+            return fixture
+
+
+    def put(self, key: str, fixture: dict):
+        with self.lock:
+            self.fixtures[key] = fixture
+
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+        with self.lock, open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(self.fixtures, file, indent=1, sort_keys=True, ensure_ascii=False)
+
+
+class StubUpstream:
+    """
+        A stand-in for one upstream, which answers from its fixtures after a delay of the given latency plus or minus a random amount of up to the
+        given jitter (both in seconds). In record mode, each request is passed on to the live upstream instead, and its response is kept as a
+        fixture. Requests with no fixture get a 404, and are reported afterwards.
+    """
+
+    def __init__(self, name: str, fixtures: FixtureStore, latency: float = 0.0, jitter: float = 0.0, record: bool = False):
+        self.name = name
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.live_url = UPSTREAMS[name]['live_url'] if record else None
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), get_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=f'stub-{name}', daemon=True)
+
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def get_response(self, path: str, headers: dict):
+        key = get_fixture_key(path)
+
+        if self.live_url:
+            response = requests.get(self.live_url + path, headers=headers, timeout=30)
+            fixture = {'status': response.status_code, 'content_type': response.headers.get('content-type', ''), 'body': response.text}
+            self.fixtures.put(key, fixture)
+
+            return fixture
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return self.fixtures.get(key) or {'status': 404, 'content_type': 'text/plain', 'body': f'No {self.name} fixture for {key}'}
+
+
+def get_handler(upstream: StubUpstream):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            # The live upstreams want to know who is calling, so the service's user agent is passed on to them
+            headers = {key: self.headers[key] for key in ['user-agent', 'accept'] if key in self.headers}
+            fixture = upstream.get_response(self.path, headers)
+            body = fixture['body'].encode('utf-8')
+
+            self.send_response(fixture['status'])
+            self.send_header('content-type', fixture['content_type'])
+            self.send_header('content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def start_stub_upstreams(fixtures_dir: str, latency: float = 0.0, jitter: float = 0.0, record: bool = False):
+    """Starts a stand-in for each upstream, and returns them along with the settings that point the service at them"""
+    stubs = {}
+
+    for name in UPSTREAMS:
+        stubs[name] = StubUpstream(name, FixtureStore(os.path.join(fixtures_dir, f'{name}.json')), latency, jitter, record)
+        stubs[name].start()
+
+    return stubs, {UPSTREAMS[name]['setting']: stub.url for name, stub in stubs.items()}
+
+
+def stop_stub_upstreams(stubs: dict, save: bool = False):
+    for stub in stubs.values():
+        stub.stop()
+
+        if save:
+            stub.fixtures.save()
@@ -0,0 +1,67 @@
+import argparse
+import datetime
+import os
+import tarfile
+
+from src import Config
+from src.services.local_database_service import create_database, import_records, finish_import, IMPORT_FUNCTIONS
+
+app_config = Config()
+
+# Release groups are imported before releases, so the release group columns that depend on them can be filled in once everything is there
+IMPORT_ORDER = ['artist', 'release-group', 'release', 'recording']
+
+
+def get_entity(path: str):
+    """The entity in a dump is taken from its file name, e.g. release-group.tar.xz or release-group.jsonl"""
+    name = os.path.basename(path).split('.')[0]
+
+    if name not in IMPORT_FUNCTIONS:
+        raise ValueError(f'Unable to tell which entity {path} contains, expected one of: {', '.join(IMPORT_ORDER)}')
+
+    return name
+
+
+def read_dump(path: str, entity: str):
+    """
+        Dumps can be given as the archives MusicBrainz publishes, where the records are in mbdump/<entity>, or as a plain file with one JSON
+        record per line. Archives are read as a stream, so they don't need to be unpacked first.
+    """
+    if not tarfile.is_tarfile(path):
+        with open(path, encoding='utf-8') as file:
+            yield from file
+
+        return
+
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and member.name == f'mbdump/{entity}':
+                yield from map(lambda x: x.decode('utf-8'), archive.extractfile(member))
+                return
+
+    raise ValueError(f'No mbdump/{entity} file found in {path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the database used by the local-database data provider from the MusicBrainz JSON dumps')
+    parser.add_argument('dumps', nargs='+', help='The dump files to import (artist, release-group, release and recording)')
+    parser.add_argument('--database', default=app_config.LOCAL_DATABASE_PATH, help='The database file to create or add to')
+    args = parser.parse_args()
+
+    dumps = sorted(map(lambda x: (get_entity(x), x), args.dumps), key=lambda x: IMPORT_ORDER.index(x[0]))
+    connection = create_database(args.database)
+    begin_time = datetime.datetime.now()
+
+    for entity, path in dumps:
+        entity_begin_time = datetime.datetime.now()
+        count = import_records(connection, entity, read_dump(path, entity))
+        print(f'Imported {count} {entity} records from {path}: {datetime.datetime.now() - entity_begin_time}')
+
+    finish_import(connection)
+    connection.close()
+
+    print(f'Import total: {datetime.datetime.now() - begin_time}')
+
+
+if __name__ == '__main__':
+    main()
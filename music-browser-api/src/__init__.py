@@ -10,6 +10,15 @@ from flask_caching import Cache
 from src.config import Config
 from src.schema.schema import SearchParameters, SearchOutput, Artist, Album, Discography, Song, DiscographyParameters, PaginationParameters, ArtistParameters
 from src.services.shared_service import supported_entity_type, get_data_provider
+from src.services.event_loop_service import run_provider_call
+from src.services.music_brainz_service import migrate_cached_images
+from src.services.executor_service import init_executors, get_executor_stats
+from src.services.metrics_service import get_counters, get_metrics_text
+from src.services.lookup_cache_service import get_lookup_result, get_lookup_result_async
+from src.services.budget_service import LookupBudget
+from src.services.serialization_service import serialize
+from src.services.timing_service import start_request_timing, finish_request_timing
+from src.services.asgi_service import AsgiAdapter
 from src.providers.music_brainz_provider import MusicBrainzProvider
 from src.enums.enums import EntityType, DiscographyType
 
@@ -33,6 +42,10 @@ def create_app(test_config=None):
 try:
     app = create_app()
     cache = Cache(app)
+    migrate_cached_images(cache)
+    init_executors()
+    asgi_app = AsgiAdapter(app)
+
     allowed_origin = '*'
 
     if app.config['PRODUCTION'] is not None and str(app.config['PRODUCTION']).lower() == 'true':
@@ -57,11 +70,28 @@ def home():
 def search(entity_type, query_data):
     """Performs a search of a particular collection"""
 
+    return make_search_response(run_provider_call(run_search(entity_type, query_data)))
+
+
+@asgi_app.async_view('search', SearchParameters, SearchOutput)
+async def search_async(entity_type, query_data):
+    """The same as search, for when the service is served over ASGI with the async provider"""
+
+    return make_search_response(await run_search(entity_type, query_data))
+
+
+def run_search(entity_type, query_data):
     if not supported_entity_type(entity_type):
         raise BadRequest(description='Unsupported entity type')
 
     db = get_data_provider(app.config)
-    results = db.run_search(entity_type=entity_type, query=query_data['query'], page=query_data['page'], page_size=query_data['pageSize'])
+
+    return db.run_search(entity_type=entity_type, query=query_data['query'], page=query_data['page'], page_size=query_data['pageSize'], cache=cache)
+
+
+def make_search_response(results):
+    if app.config['FAST_SERIALIZATION']:
+        return app.json.response(serialize(SearchOutput(), results))
 
     return results
 
@@ -72,10 +102,31 @@ def search(entity_type, query_data):
 def lookup_artist(entity_id, query_data):
     """Performs a lookup of a specific artist"""
 
+    cache_key, run_lookup = get_artist_lookup(entity_id, query_data)
+    result, cache_status, etag, omitted = get_lookup_result(cache_key, Artist(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+@asgi_app.async_view('lookup_artist', PaginationParameters, Artist)
+async def lookup_artist_async(entity_id, query_data):
+    """The same as lookup_artist, for when the service is served over ASGI with the async provider"""
+
+    cache_key, run_lookup = get_artist_lookup(entity_id, query_data)
+    result, cache_status, etag, omitted = await get_lookup_result_async(cache_key, Artist(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+def get_artist_lookup(entity_id, query_data):
     db = get_data_provider(app.config)
-    result = db.run_lookup(entity_type=EntityType.ARTIST.value, entity_id=entity_id, secondary_id=None, page_size=query_data['pageSize'], cache=cache)
+    cache_key = f'lookup-{app.config['DATA_PROVIDER']}-artist-{entity_id}-{query_data['pageSize']}'
 
-    return result
+    def run_lookup(budget: LookupBudget, refresh: bool = False):
+        return db.run_lookup(entity_type=EntityType.ARTIST.value, entity_id=entity_id, secondary_id=None, page_size=query_data['pageSize'],
+                             cache=cache, budget=budget, refresh=refresh)
+
+    return cache_key, run_lookup
 
 
 @app.get('/lookup/discography/<string:entity_type>/<string:entity_id>')
@@ -84,14 +135,35 @@ def lookup_artist(entity_id, query_data):
 def lookup_discography(entity_type, entity_id, query_data):
     """Performs a lookup of the discography for an artist or that which is associated with a particular song"""
 
+    cache_key, run_lookup = get_discography_lookup(entity_type, entity_id, query_data)
+    result, cache_status, etag, omitted = get_lookup_result(cache_key, Discography(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+@asgi_app.async_view('lookup_discography', DiscographyParameters, Discography)
+async def lookup_discography_async(entity_type, entity_id, query_data):
+    """The same as lookup_discography, for when the service is served over ASGI with the async provider"""
+
+    cache_key, run_lookup = get_discography_lookup(entity_type, entity_id, query_data)
+    result, cache_status, etag, omitted = await get_lookup_result_async(cache_key, Discography(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+def get_discography_lookup(entity_type, entity_id, query_data):
     if not supported_entity_type(entity_type):
         raise BadRequest(description='Unsupported entity type')
 
     db = get_data_provider(app.config)
-    result = db.run_discography_lookup(discog_type=query_data['discogType'], entity_id=entity_id, entity_type=entity_type, page=query_data['page'],
-                                       page_size=query_data['pageSize'], cache=cache)
+    cache_key = (f'lookup-{app.config['DATA_PROVIDER']}-discography-{entity_type}-{entity_id}-{query_data['discogType']}-{query_data['page']}-'
+                 f'{query_data['pageSize']}')
+
+    def run_lookup(budget: LookupBudget, refresh: bool = False):
+        return db.run_discography_lookup(discog_type=query_data['discogType'], entity_id=entity_id, entity_type=entity_type, page=query_data['page'],
+                                         page_size=query_data['pageSize'], cache=cache, budget=budget, refresh=refresh)
 
-    return result
+    return cache_key, run_lookup
 
 
 @app.get('/lookup/album/<string:entity_id>')
@@ -100,15 +172,36 @@ def lookup_discography(entity_type, entity_id, query_data):
 def lookup_album(entity_id, query_data):
     """Performs a lookup of a specific album"""
 
+    cache_key, run_lookup = get_album_lookup(entity_id, query_data)
+    result, cache_status, etag, omitted = get_lookup_result(cache_key, Album(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+@asgi_app.async_view('lookup_album', ArtistParameters, Album)
+async def lookup_album_async(entity_id, query_data):
+    """The same as lookup_album, for when the service is served over ASGI with the async provider"""
+
+    cache_key, run_lookup = get_album_lookup(entity_id, query_data)
+    result, cache_status, etag, omitted = await get_lookup_result_async(cache_key, Album(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+def get_album_lookup(entity_id, query_data):
     db = get_data_provider(app.config)
     secondary_id = None
 
     if 'artistId' in query_data:
         secondary_id = query_data['artistId']
 
-    result = db.run_lookup(entity_type=EntityType.ALBUM.value, entity_id=entity_id, secondary_id=secondary_id, page_size=None, cache=cache)
+    cache_key = f'lookup-{app.config['DATA_PROVIDER']}-album-{entity_id}-{secondary_id}'
+
+    def run_lookup(budget: LookupBudget, refresh: bool = False):
+        return db.run_lookup(entity_type=EntityType.ALBUM.value, entity_id=entity_id, secondary_id=secondary_id, page_size=None, cache=cache,
+                             budget=budget, refresh=refresh)
 
-    return result
+    return cache_key, run_lookup
 
 
 @app.get('/lookup/song/<string:entity_id>')
@@ -117,10 +210,75 @@ def lookup_album(entity_id, query_data):
 def lookup_song(entity_id, query_data):
     """Performs a lookup of a specific song"""
 
+    cache_key, run_lookup = get_song_lookup(entity_id, query_data)
+    result, cache_status, etag, omitted = get_lookup_result(cache_key, Song(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+@asgi_app.async_view('lookup_song', PaginationParameters, Song)
+async def lookup_song_async(entity_id, query_data):
+    """The same as lookup_song, for when the service is served over ASGI with the async provider"""
+
+    cache_key, run_lookup = get_song_lookup(entity_id, query_data)
+    result, cache_status, etag, omitted = await get_lookup_result_async(cache_key, Song(), run_lookup, cache)
+
+    return make_lookup_response(result, cache_status, etag, omitted)
+
+
+def get_song_lookup(entity_id, query_data):
     db = get_data_provider(app.config)
-    result = db.run_lookup(entity_type=EntityType.SONG.value, entity_id=entity_id, secondary_id=None, page_size=query_data['pageSize'], cache=cache)
+    cache_key = f'lookup-{app.config['DATA_PROVIDER']}-song-{entity_id}-{query_data['pageSize']}'
+
+    def run_lookup(budget: LookupBudget, refresh: bool = False):
+        return db.run_lookup(entity_type=EntityType.SONG.value, entity_id=entity_id, secondary_id=None, page_size=query_data['pageSize'],
+                             cache=cache, budget=budget, refresh=refresh)
+
+    return cache_key, run_lookup
+
+
+def make_lookup_response(result: dict, cache_status: str, etag: str, omitted: list):
+    """If the client already has the current version of the result, a 304 response is returned without serializing anything. A result that had to
+    leave out some optional parts, because the lookup ran out of time for them, lists them in the X-Partial-Response header. It is sent without an
+    ETag and marked as not to be stored, so neither the client nor a proxy holds on to it in place of the complete result."""
+
+    headers = {'X-Cache-Status': cache_status}
+
+    if omitted:
+        headers['X-Partial-Response'] = ', '.join(omitted)
+        headers['Cache-Control'] = 'no-store'
+    else:
+        headers['ETag'] = f'"{etag}"'
+
+        if flask.request.if_none_match.contains(etag):
+            return flask.Response(status=304, headers=headers)
+
+    # The cached result is already in its serialized form, so with FAST_SERIALIZATION on it is written out as is, rather than being dumped through
+    # the output schema again. The JSON is produced the same way as in the normal path.
+    if app.config['FAST_SERIALIZATION']:
+        response = app.json.response(result)
+        response.headers.update(headers)
+
+        return response
+
+    return result, headers
+
 
-    return result
+@app.get('/stats')
+def stats():
+    """Returns statistics about the work the service is currently doing"""
+
+    return {'executors': get_executor_stats(), 'counters': get_counters()}
+
+
+@app.get('/metrics')
+def metrics():
+    """Returns the service's metrics in the Prometheus text format, for scraping"""
+
+    response = flask.Response(get_metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    response.cache_control.no_store = True
+
+    return response
 
 
 @app.get('/robots933456.txt')
@@ -132,14 +290,40 @@ def return_empty():
     return ''
 
 
+@app.before_request
+def start_timing():
+    """Starts keeping stage timings for the request, if SERVER_TIMING is on and the request is sampled"""
+
+    start_request_timing()
+
+
+@app.after_request
+def add_server_timing_header(response):
+    """Adds the stage timings kept for the request as a Server-Timing header"""
+
+    server_timing = finish_request_timing()
+
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+
+    return response
+
+
 @app.after_request
 def set_cache_headers(response):
     """Sets caching headers in a response"""
 
-    if isinstance(response, flask.wrappers.Response) and response.status_code < 300:
+    # Responses that must never be cached (such as the metrics and partial lookups) say so themselves, and are left alone
+    if isinstance(response, flask.wrappers.Response) and (response.status_code < 300 or response.status_code == 304) and \
+            not response.cache_control.no_store:
         max_age = app.config['LOOKUP_RESPONSE_CACHE_AGE']
         response.cache_control.max_age = max_age
 
+        # Responses that don't already have an ETag (i.e. anything other than lookups) get one from a hash of the body
+        if response.status_code == 200 and not response.direct_passthrough:
+            response.add_etag()
+            response.make_conditional(flask.request)
+
     return response
 
 
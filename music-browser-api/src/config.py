@@ -1,5 +1,19 @@
 import dataclasses
 import os
+import tempfile
+
+
+def get_mapping_setting(name: str, default: str = ''):
+    """Reads a setting made up of comma-separated key=value pairs, e.g. 'artist=86400,album=604800', into a dictionary of numbers"""
+    result = {}
+
+    for entry in (os.environ.get(name) or default).split(','):
+        if '=' in entry:
+            key, value = entry.split('=', 1)
+            result[key.strip()] = float(value)
+
+    return result
+
 
 @dataclasses.dataclass
 class Config:
@@ -9,7 +23,43 @@ class Config:
     CACHE_TYPE = os.environ.get('CACHE_TYPE', 'FileSystemCache')
     CACHE_DIR = os.environ.get('CACHE_DIR', 'mb-cache')
     CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', '2678400'))  # 31 days
+    CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD', '50000'))
+    DESCRIPTION_CACHE_TIMEOUT = int(os.environ.get('DESCRIPTION_CACHE_TIMEOUT', '604800'))  # 7 days
+    DESCRIPTION_NEGATIVE_CACHE_TIMEOUT = int(os.environ.get('DESCRIPTION_NEGATIVE_CACHE_TIMEOUT', '86400'))  # 1 day
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+    HTTP_KEEP_ALIVE = (os.environ.get('HTTP_KEEP_ALIVE') or 'true').lower() == 'true'
+    HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '30'))
+    HTTP_HOST_TIMEOUTS = get_mapping_setting('HTTP_HOST_TIMEOUTS')
+    RESPONSE_CACHE_TIMEOUTS = get_mapping_setting('RESPONSE_CACHE_TIMEOUTS', 'artist=86400,artist_albums=86400,discography_index=86400,album=604800,'
+                                                                             'release=2678400,release_data=604800,song=604800,song_albums=86400')
+    MUSIC_BRAINZ_MAX_WORKERS = int(os.environ.get('MUSIC_BRAINZ_MAX_WORKERS', '4'))
+    FANART_MAX_WORKERS = int(os.environ.get('FANART_MAX_WORKERS', '8'))
+    WIKIPEDIA_MAX_WORKERS = int(os.environ.get('WIKIPEDIA_MAX_WORKERS', '8'))
+    SEARCH_CACHE_TIMEOUT = int(os.environ.get('SEARCH_CACHE_TIMEOUT', '600'))  # 10 minutes
+    MUSIC_BRAINZ_RATE_LIMIT_INTERVAL = float(os.environ.get('MUSIC_BRAINZ_RATE_LIMIT_INTERVAL', '1.0'))
+    MUSIC_BRAINZ_RATE_LIMIT_FILE = os.environ.get('MUSIC_BRAINZ_RATE_LIMIT_FILE') or os.path.join(tempfile.gettempdir(), 'music-browser-mb-rate-limit')
+    COALESCE_LOCK_DIR = os.environ.get('COALESCE_LOCK_DIR') or os.path.join(tempfile.gettempdir(), 'music-browser-locks')
+    BACKGROUND_MAX_WORKERS = int(os.environ.get('BACKGROUND_MAX_WORKERS', '4'))
+    LOOKUP_FRESH_AGE = int(os.environ.get('LOOKUP_FRESH_AGE', '3600'))  # 1 hour
+    LOOKUP_STALE_GRACE = int(os.environ.get('LOOKUP_STALE_GRACE', '86400'))  # 1 day
+    # How long a lookup waits for its images and description, in seconds, before returning without them (0 waits as long as they take)
+    LOOKUP_BUDGET = float(os.environ.get('LOOKUP_BUDGET', '0'))
+    ASYNC_PROVIDER = (os.environ.get('ASYNC_PROVIDER') or 'false').lower() == 'true'
+    FAST_SERIALIZATION = (os.environ.get('FAST_SERIALIZATION') or 'false').lower() == 'true'
+    PREFETCH_ALBUM_COUNT = int(os.environ.get('PREFETCH_ALBUM_COUNT', '0'))
+    SEARCH_INDEX = (os.environ.get('SEARCH_INDEX') or 'false').lower() == 'true'
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH', 'mb-search.db')
+    SEARCH_INDEX_MAX_BACKLOG = float(os.environ.get('SEARCH_INDEX_MAX_BACKLOG', '5.0'))
+    SERVER_TIMING = (os.environ.get('SERVER_TIMING') or 'false').lower() == 'true'
+    SERVER_TIMING_SAMPLE_RATE = float(os.environ.get('SERVER_TIMING_SAMPLE_RATE', '1.0'))
+    # The upstreams can be pointed at other servers, such as the stand-ins used by the benchmarks. MusicBrainz and fanart use their client
+    # packages' own defaults unless these are set.
+    MUSIC_BRAINZ_URL = os.environ.get('MUSIC_BRAINZ_URL')
+    FANART_URL = os.environ.get('FANART_URL')
+    WIKIDATA_URL = os.environ.get('WIKIDATA_URL', 'https://www.wikidata.org')
+    WIKIPEDIA_URL = os.environ.get('WIKIPEDIA_URL', 'https://en.wikipedia.org')
     DATA_PROVIDER = os.environ.get('DATA_PROVIDER')
+    LOCAL_DATABASE_PATH = os.environ.get('LOCAL_DATABASE_PATH', 'mb-local.db')
     EXCLUDED_TAGS = os.environ.get('EXCLUDED_TAGS') or ''
     SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID')
     SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET')
@@ -15,3 +15,13 @@ class DiscographyType(Enum):
 class DataProvider(Enum):
     MUSIC_BRAINZ = 'music-brainz'
     SPOTIFY = 'spotify'
+    LOCAL_DATABASE = 'local-database'
+
+class Upstream(Enum):
+    MUSIC_BRAINZ = 'musicbrainz'
+    FANART = 'fanart'
+    WIKIPEDIA = 'wikipedia'
+
+class RequestPriority(Enum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
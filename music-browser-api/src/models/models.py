@@ -1,21 +1,165 @@
-from src.schema.schema import Link
+from src.enums.enums import RequestPriority
 
 
 class DataRequest:
     data_type: str
-    release_types: list[str]
+    release_types: list[str] = None
     entity_id: str
-    secondary_id: str
-    limit: int
-    offset: int
-    use_cache: bool
+    secondary_id: str = None
+    limit: int = None
+    offset: int = None
+    use_cache: bool = False
+    refresh: bool = False
+    priority: RequestPriority = RequestPriority.INTERACTIVE
 
 
-class Links:
-    def __init__(self):
-        super().__init__()
-        self.items = []
-        self.entity_description = ''
+# The classes below are what the service code builds its results from. They only carry data, and are dumped by the matching schemas in
+# src.schema.schema. Attributes that are never assigned are left out of the output, the same as for a schema instance.
 
-    items: list[Link]
-    entity_description: str
+class Image:
+    __slots__ = ('height', 'width', 'url')
+
+    height: int
+    width: int
+    url: str
+
+
+class Tag:
+    __slots__ = ('id', 'name')
+
+    id: str
+    name: str
+
+
+class SearchResult:
+    __slots__ = ('id', 'name', 'artist', 'artistId', 'album', 'albumId', 'score', 'tags', 'entityType')
+
+    id: str
+    name: str
+    artist: str
+    artistId: str
+    album: str
+    albumId: str
+    score: int
+    tags: list[Tag]
+    entityType: str
+
+
+class SearchOutput:
+    __slots__ = ('rows', 'count')
+
+    rows: list[SearchResult]
+    count: int
+
+
+class LifeSpan:
+    __slots__ = ('begin', 'end', 'ended')
+
+    begin: str
+    end: str
+    ended: bool
+
+
+class Member:
+    __slots__ = ('id', 'name', 'lifeSpan')
+
+    id: str
+    name: str
+    lifeSpan: LifeSpan
+
+
+class Link:
+    __slots__ = ('ordinal', 'label', 'target')
+
+    ordinal: int
+    label: str
+    target: str
+
+
+class Track:
+    __slots__ = ('id', 'name', 'duration', 'artistId', 'artist')
+
+    id: str
+    name: str
+    duration: str
+    artistId: str
+    artist: str
+
+
+class TrackList:
+    __slots__ = ('tracks', 'totalDuration', 'position', 'format')
+
+    tracks: list[Track]
+    totalDuration: str
+    position: int
+    format: str
+
+
+class Album:
+    __slots__ = ('id', 'name', 'albumType', 'artist', 'artistId', 'releaseDate', 'label', 'catalogNumber', 'description', 'comment', 'country',
+                 'ordinal', 'trackList', 'tags', 'genres', 'images', 'links')
+
+    id: str
+    name: str
+    albumType: str
+    artist: str
+    artistId: str
+    releaseDate: str
+    label: str
+    catalogNumber: str
+    description: str
+    comment: str
+    country: str
+    ordinal: int
+    trackList: list[TrackList]
+    tags: list[Tag]
+    genres: list[Tag]
+    images: list[Image]
+    links: list[Link]
+
+
+class Artist:
+    __slots__ = ('id', 'name', 'artistType', 'description', 'comment', 'annotation', 'lifeSpan', 'area', 'beginArea', 'endArea', 'tags', 'genres',
+                 'images', 'albums', 'totalAlbums', 'members', 'links')
+
+    id: str
+    name: str
+    artistType: str
+    description: str
+    comment: str
+    annotation: str
+    lifeSpan: LifeSpan
+    area: dict
+    beginArea: dict
+    endArea: dict
+    tags: list[Tag]
+    genres: list[Tag]
+    images: list[Image]
+    albums: list[Album]
+    totalAlbums: int
+    members: list[Member]
+    links: list[Link]
+
+
+class Song:
+    __slots__ = ('id', 'name', 'artist', 'artistId', 'duration', 'releaseDate', 'comment', 'annotation', 'appearsOn', 'tags', 'genres', 'links')
+
+    id: str
+    name: str
+    artist: str
+    artistId: str
+    duration: str
+    releaseDate: str
+    comment: str
+    annotation: str
+    appearsOn: list[Album]
+    tags: list[Tag]
+    genres: list[Tag]
+    links: list[Link]
+
+
+class Discography:
+    __slots__ = ('rows', 'count')
+
+    rows: list[Album]
+    count: int
@@ -0,0 +1,28 @@
+from abc import abstractmethod
+from flask_caching import Cache
+
+from src.services.budget_service import LookupBudget
+
+
+class AsyncBaseProvider:
+    """The same interface as BaseProvider, for providers whose calls are coroutines"""
+
+    def __init__(self):
+        pass
+
+
+    @abstractmethod
+    async def run_search(self, entity_type: str, query: str, page: int, page_size: int, cache: Cache):
+        pass
+
+
+    @abstractmethod
+    async def run_lookup(self, entity_type: str, entity_id: str, secondary_id: str, page_size: int, cache: Cache, budget: LookupBudget = None,
+                         refresh: bool = False):
+        pass
+
+
+    @abstractmethod
+    async def run_discography_lookup(self, discog_type: str, entity_id: str, entity_type: str, page: int, page_size: int, cache: Cache,
+                                     budget: LookupBudget = None, refresh: bool = False):
+        pass
@@ -0,0 +1,213 @@
+import asyncio
+import time
+
+from flask_caching import Cache
+import httpx
+import musicbrainzngs
+
+from src.enums.enums import EntityType, RequestPriority
+from src.models.models import DataRequest
+from src.providers.async_base_provider import AsyncBaseProvider
+from src.providers.music_brainz_provider import music_brainz_requests, release_data_requests, image_requests, description_requests, \
+                                                get_stored_search_data, get_fallback_search_data, build_search_result, get_artist_requests, \
+                                                build_artist_result, get_album_requests, build_album_result, get_song_requests, build_song_result, \
+                                                get_discography_requests, build_discography_result, set_up_music_brainz
+from src.services.music_brainz_service import get_artist_data_async, get_album_data_async, get_release_data_async, get_discography_data_async, \
+                                              get_song_data_async, get_cached_images, set_cached_images, get_wikidata_url, get_cached_response, \
+                                              fetch_response_async, get_response_cache_key, normalize_search_query, set_cached_search_data, \
+                                              call_music_brainz_async, get_search_params
+from src.services.wikipedia_service import get_entity_description_async
+from src.services.prefetch_service import submit_album_prefetch
+from src.services.metrics_service import observe_duration
+from src.services.budget_service import LookupBudget
+
+
+class AsyncMusicBrainzProvider(AsyncBaseProvider):
+    """
+        Does the same work as MusicBrainzProvider, but the calls to MusicBrainz, fanart and Wikipedia are made as tasks on an event loop rather
+        than on the upstream pools, so a lookup that is waiting on the network doesn't hold any threads besides the one running the loop. The
+        requests and results are put together by the same functions MusicBrainzProvider uses, calls are coalesced with the ones it makes, and
+        both use the same caches. Reading and writing the caches and querying the search index are blocking file operations, so they are run on
+        worker threads, since doing them on the loop would hold up every other lookup that is running on it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        set_up_music_brainz()
+
+
+    async def run_search(self, entity_type, query, page, page_size, cache: Cache):
+        begin_time = time.monotonic()
+
+        search_query, artist_query = normalize_search_query(query, entity_type == EntityType.SONG.value)
+        data = await asyncio.to_thread(get_stored_search_data, entity_type, search_query, artist_query, page, page_size, cache)
+
+        if data is None:
+            try:
+                data = await self.search_music_brainz(entity_type, search_query, artist_query, page_size, (page - 1) * page_size)
+            except (musicbrainzngs.MusicBrainzError, httpx.HTTPError):
+                data = await asyncio.to_thread(get_fallback_search_data, entity_type, search_query, artist_query, page, page_size)
+
+                if data is None:
+                    raise
+            else:
+                await asyncio.to_thread(set_cached_search_data, entity_type, search_query, artist_query, page, page_size, data, cache)
+
+        results = build_search_result(entity_type, data)
+        observe_duration('search_duration_seconds', {'entity': entity_type}, begin_time)
+
+        return results
+
+
+    @staticmethod
+    async def search_music_brainz(entity_type, search_query, artist_query, page_size, offset):
+        data = None
+
+        match entity_type:
+            case EntityType.ARTIST.value:
+                data = await call_music_brainz_async(RequestPriority.INTERACTIVE, 'artist',
+                                                     params=get_search_params({'artist': search_query}, limit=page_size, offset=offset))
+            case EntityType.ALBUM.value:
+                params = get_search_params({'type': 'album', 'status': 'official'}, search_query, page_size, offset)
+                data = await call_music_brainz_async(RequestPriority.INTERACTIVE, 'release-group', params=params)
+            case EntityType.SONG.value:
+                if artist_query:
+                    fields = {'artist': artist_query, 'primarytype': 'album', 'status': 'official'}
+                else:
+                    fields = {'primarytype': 'album', 'status': 'official'}
+
+                data = await call_music_brainz_async(RequestPriority.INTERACTIVE, 'recording',
+                                                     params=get_search_params(fields, search_query, page_size, offset))
+
+        return data
+
+
+    async def run_lookup(self, entity_type, entity_id, secondary_id, page_size, cache: Cache, budget: LookupBudget = None,
+                         refresh: bool = False):
+        result = None
+        begin_time = time.monotonic()
+        budget = budget or LookupBudget()
+
+        match entity_type:
+            case EntityType.ARTIST.value:
+                artist_request, artist_albums_request, artist_images_request, album_images_request = get_artist_requests(entity_id, page_size,
+                                                                                                                         refresh)
+                artist_task = asyncio.create_task(self.get_data(get_artist_data_async, artist_request, cache))
+                artist_albums_task = asyncio.create_task(self.get_data(get_artist_data_async, artist_albums_request, cache))
+                image_tasks = [
+                    asyncio.create_task(self.get_images(get_artist_data_async, artist_images_request, EntityType.ARTIST, entity_id, cache)),
+                    asyncio.create_task(self.get_images(get_artist_data_async, album_images_request, EntityType.ALBUM, entity_id, cache))
+                ]
+
+                # The description only depends on the artist record, so it is fetched while the other requests are still running
+                try:
+                    artist_data = await artist_task
+                except Exception:
+                    # The albums request usually fails the same way (e.g. for an unknown artist), so it is waited for, and its error dropped
+                    await asyncio.gather(artist_albums_task, return_exceptions=True)
+                    raise
+
+                description_task = asyncio.create_task(self.get_description(artist_data['artist'], cache, refresh))
+                data = [artist_data, await artist_albums_task, await budget.get_optional_result_async(image_tasks[0], 'images', []),
+                        await budget.get_optional_result_async(image_tasks[1], 'images', {})]
+                description = await budget.get_optional_result_async(description_task, 'description', '')
+
+                observe_duration('lookup_fetch_duration_seconds', {'entity': 'artist'}, begin_time)
+
+                result = build_artist_result(data, description)
+                submit_album_prefetch(result, cache)
+            case EntityType.ALBUM.value:
+                album_request, album_images_request = get_album_requests(entity_id, secondary_id, refresh)
+
+                # We only cache fetched images if we have an artist ID they can be stored under
+                album_task = asyncio.create_task(self.get_data(get_album_data_async, album_request, cache))
+                images_task = asyncio.create_task(self.get_images(get_album_data_async, album_images_request, EntityType.ALBUM, secondary_id,
+                                                                  cache))
+
+                # Once we have the release group, the canonical release and the description can be fetched alongside the images
+                album_data = await album_task
+                release_group = album_data['release-group']
+                release_task = asyncio.create_task(release_data_requests.submit_async(
+                    release_group['id'], lambda: get_release_data_async(release_group, cache, RequestPriority.INTERACTIVE, refresh)))
+                description_task = asyncio.create_task(self.get_description(release_group, cache, refresh))
+
+                data = [album_data, await budget.get_optional_result_async(images_task, 'images', {})]
+                release_data = await release_task
+                description = await budget.get_optional_result_async(description_task, 'description', '')
+
+                observe_duration('lookup_fetch_duration_seconds', {'entity': 'album'}, begin_time)
+
+                result = build_album_result(data, description, release_data)
+            case EntityType.SONG.value:
+                song_requests = get_song_requests(entity_id, page_size, refresh)
+                data = await asyncio.gather(*map(lambda x: self.get_data(get_song_data_async, x, cache), song_requests))
+
+                observe_duration('lookup_fetch_duration_seconds', {'entity': 'song'}, begin_time)
+
+                result = build_song_result(data)
+
+        observe_duration('lookup_duration_seconds', {'entity': entity_type}, begin_time)
+
+        return result
+
+
+    @staticmethod
+    async def get_data(fetch_function, data_request: DataRequest, cache: Cache):
+        cached_response = await asyncio.to_thread(get_cached_response, data_request, cache)
+
+        if cached_response is not None:
+            return cached_response
+
+        return await music_brainz_requests.submit_async(get_response_cache_key(data_request),
+                                                        lambda: fetch_response_async(fetch_function, data_request, cache))
+
+
+    @staticmethod
+    async def get_images(fetch_function, data_request: DataRequest, entity_type: EntityType, cache_entity_id: str, cache: Cache):
+        cached_images = None
+
+        if cache_entity_id and not data_request.refresh:
+            cached_images = await asyncio.to_thread(get_cached_images, cache_entity_id, entity_type, cache)
+
+        if cached_images:
+            return cached_images
+
+        async def fetch():
+            images = await fetch_function(data_request)
+
+            if cache_entity_id:
+                await asyncio.to_thread(set_cached_images, cache_entity_id, entity_type, images, cache)
+
+            return images
+
+        request_key = f'{fetch_function.__name__}-{data_request.data_type}-{data_request.entity_id}-{data_request.secondary_id}'
+
+        return await image_requests.submit_async(request_key, fetch)
+
+
+    @staticmethod
+    async def get_description(record: dict, cache: Cache, refresh: bool = False):
+        wikidata_url = get_wikidata_url(record)
+
+        if wikidata_url:
+            return await description_requests.submit_async(wikidata_url, lambda: get_entity_description_async(wikidata_url, cache, refresh))
+
+        return ''
+
+
+    async def run_discography_lookup(self, discog_type, entity_id, entity_type, page, page_size, cache: Cache, budget: LookupBudget = None,
+                                     refresh: bool = False):
+        begin_time = time.monotonic()
+        budget = budget or LookupBudget()
+
+        discog_request, album_images_request = get_discography_requests(discog_type, entity_id, entity_type, page, page_size, refresh)
+        images_task = asyncio.create_task(self.get_images(get_discography_data_async, album_images_request, EntityType.ALBUM, entity_id, cache))
+        data = [await self.get_data(get_discography_data_async, discog_request, cache),
+                await budget.get_optional_result_async(images_task, 'images', {})]
+
+        observe_duration('lookup_fetch_duration_seconds', {'entity': 'discography'}, begin_time)
+
+        result = build_discography_result(data, discog_type, entity_type, page, page_size)
+        observe_duration('discography_lookup_duration_seconds', {'entity': entity_type, 'discog_type': discog_type}, begin_time)
+
+        return result
@@ -1,6 +1,8 @@
 from abc import abstractmethod
 from flask_caching import Cache
 
+from src.services.budget_service import LookupBudget
+
 
 class BaseProvider:
     def __init__(self):
@@ -8,15 +10,17 @@ class BaseProvider:
 
 
     @abstractmethod
-    def run_search(self, entity_type: str, query: str, page: int, page_size: int):
+    def run_search(self, entity_type: str, query: str, page: int, page_size: int, cache: Cache):
         pass
 
 
     @abstractmethod
-    def run_lookup(self, entity_type: str, entity_id: str, secondary_id: str, page_size: int, cache: Cache):
+    def run_lookup(self, entity_type: str, entity_id: str, secondary_id: str, page_size: int, cache: Cache, budget: LookupBudget = None,
+                   refresh: bool = False):
         pass
 
 
     @abstractmethod
-    def run_discography_lookup(self, discog_type: str, entity_id: str, entity_type: str, page: int, page_size: int, cache: Cache):
+    def run_discography_lookup(self, discog_type: str, entity_id: str, entity_type: str, page: int, page_size: int, cache: Cache,
+                               budget: LookupBudget = None, refresh: bool = False):
         pass
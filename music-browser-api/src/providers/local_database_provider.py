@@ -0,0 +1,89 @@
+import time
+
+from flask_caching import Cache
+
+from src.enums.enums import EntityType
+from src.models.models import DataRequest, Artist
+from src.providers.music_brainz_provider import MusicBrainzProvider, get_completed_future
+from src.services.music_brainz_service import build_search_results, normalize_search_query, get_release_id, build_release_data, \
+                                              read_all_release_groups, build_discography_index
+from src.services.local_database_service import get_artist, browse_release_groups, get_release_group, get_release, get_recording, \
+                                                browse_releases, search
+from src.services.metrics_service import observe_duration
+
+
+class LocalDatabaseProvider(MusicBrainzProvider):
+    """
+        Serves MusicBrainz data from a local copy of the database, built from the MusicBrainz JSON dumps by import_database.py. The records are
+        stored in the same shape as the responses from the web service, so lookups are put together exactly the way MusicBrainzProvider does it,
+        but none of the MusicBrainz data has to wait on the network or the rate limiter. Images and descriptions still come from fanart and
+        Wikipedia (and their caches), since they aren't part of the dumps.
+    """
+
+    def run_search(self, entity_type, query, page, page_size, cache: Cache):
+        results = None
+        offset = (page - 1) * page_size
+        begin_time = time.monotonic()
+
+        search_query, artist_query = normalize_search_query(query, entity_type == EntityType.SONG.value)
+
+        match entity_type:
+            case EntityType.ARTIST.value:
+                data = search(EntityType.ARTIST, search_query, artist_query, page_size, offset)
+                results = build_search_results(EntityType.ARTIST, 'artist-list', 'artist-count', data)
+            case EntityType.ALBUM.value:
+                data = search(EntityType.ALBUM, search_query, artist_query, page_size, offset)
+                results = build_search_results(EntityType.ALBUM, 'release-group-list', 'release-group-count', data)
+            case EntityType.SONG.value:
+                data = search(EntityType.SONG, search_query, artist_query, page_size, offset)
+                results = build_search_results(EntityType.SONG, 'recording-list', 'recording-count', data)
+
+        observe_duration('search_duration_seconds', {'entity': entity_type}, begin_time)
+
+        return results
+
+
+    @staticmethod
+    def submit_data_request(fetch_function, data_request: DataRequest, cache: Cache):
+        """
+            Data is read from the local database right away, on the calling thread. It is quick enough that it isn't worth handing off to a worker
+            or keeping in the response cache.
+        """
+        return get_completed_future(get_local_data(data_request))
+
+
+    @staticmethod
+    def submit_release_data_request(release_group: dict, cache: Cache, refresh: bool = False):
+        release_id = get_release_id(release_group)
+
+        if release_id is None:
+            return get_completed_future({'release_id': None, 'track_list': [], 'label': '', 'catalog_number': ''})
+
+        return get_completed_future(build_release_data(get_release(release_id)))
+
+
+    @staticmethod
+    def submit_album_prefetch(artist: Artist, cache: Cache):
+        # Album data comes straight from the local database, so there is nothing worth fetching ahead of time
+        pass
+
+
+def get_local_data(data_request: DataRequest):
+    result = None
+
+    match data_request.data_type:
+        case 'artist':
+            result = get_artist(data_request.entity_id)
+        case 'artist_albums':
+            result = browse_release_groups(data_request.entity_id, ['album'], data_request.limit, data_request.offset)
+        case 'discography_index':
+            result = build_discography_index(read_all_release_groups(lambda limit, offset: browse_release_groups(data_request.entity_id, None, limit,
+                                                                                                                 offset)))
+        case 'album':
+            result = get_release_group(data_request.entity_id)
+        case 'song':
+            result = get_recording(data_request.entity_id)
+        case 'song_albums':
+            result = browse_releases(data_request.entity_id, data_request.release_types, data_request.limit, data_request.offset)
+
+    return result
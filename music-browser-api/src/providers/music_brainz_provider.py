@@ -1,220 +1,388 @@
+from concurrent.futures import Future
 import copy
-from concurrent.futures import ThreadPoolExecutor
-import datetime
+import time
 
 from flask_caching import Cache
 import musicbrainzngs
 
-from src.enums.enums import EntityType, DiscographyType
-from src.models.models import DataRequest
+from src import Config
+from src.enums.enums import EntityType, DiscographyType, Upstream, RequestPriority
+from src.models.models import DataRequest, Artist
 from src.providers.base_provider import BaseProvider
 from src.services.music_brainz_service import build_search_results, get_artist_data, get_album_data, get_release_data, get_discography_data, \
                                               get_song_data, build_artist, build_album, build_discography_list, build_song, get_cached_images, \
-                                              set_cached_images
+                                              set_cached_images, get_wikidata_url, get_cached_response, fetch_response, get_response_cache_key, normalize_search_query, \
+                                              get_cached_search_data, set_cached_search_data, call_music_brainz, get_cached_release_data, \
+                                              get_discography_page, set_music_brainz_server, DISCOGRAPHY_RELEASE_TYPES
+from src.services.search_index_service import get_indexed_search_data, search_index_preferred, submit_index_update, index_artist_lookup, \
+                                              index_album_lookup, index_song_lookup
+from src.services.wikipedia_service import get_entity_description
+from src.services.prefetch_service import submit_album_prefetch
+from src.services.executor_service import get_executor
+from src.services.coalesce_service import SingleFlight
+from src.services.metrics_service import observe_duration
+from src.services.budget_service import LookupBudget
 
+app_config = Config()
 
-class MusicBrainzProvider(BaseProvider):
-    def __init__(self):
-        super().__init__()
-        musicbrainzngs.set_useragent('Music Browser', '2.0.0', 'http://cmtybur.com')
+# Identical upstream calls that are in flight at the same time, from any request in this process, are shared rather than repeated
+music_brainz_requests = SingleFlight('musicbrainz')
+release_data_requests = SingleFlight('release_data')
+image_requests = SingleFlight('fanart')
+description_requests = SingleFlight('wikipedia')
 
 
-    def run_search(self, entity_type, query, page, page_size):
-        results = None
-        offset = (page - 1) * page_size
-        begin_time = datetime.datetime.now()
+def get_completed_future(result):
+    future = Future()
+    future.set_result(result)
 
-        match entity_type:
-            case EntityType.ARTIST.value:
-                data = musicbrainzngs.search_artists(artist=query.strip(), limit=page_size, offset=offset)
-                print(f'__MusicBrainz artist search: {datetime.datetime.now() - begin_time}')
+    return future
 
-                results = build_search_results(EntityType.ARTIST, 'artist-list', 'artist-count', data)
-            case EntityType.ALBUM.value:
-                data = musicbrainzngs.search_release_groups(query=query.strip(), limit=page_size, offset=offset, type='album', status='official')
-                print(f'__MusicBrainz album search: {datetime.datetime.now() - begin_time}')
 
-                results = build_search_results(EntityType.ALBUM, 'release-group-list', 'release-group-count', data)
-            case EntityType.SONG.value:
-                if 'artist:' in query:
-                    song_query = query[:query.index('artist:')].strip()
-                    artist_query = query[query.index('artist:') + 7:].strip()
+def set_up_music_brainz():
+    musicbrainzngs.set_useragent('Music Browser', '2.0.0', 'http://cmtybur.com')
 
-                    data = musicbrainzngs.search_recordings(query=song_query, limit=page_size, offset=offset, artist=artist_query, primarytype='album',
-                                                            status='official')
-                else:
-                    data = musicbrainzngs.search_recordings(query=query.strip(), limit=page_size, offset=offset, primarytype='album', status='official')
+    if app_config.MUSIC_BRAINZ_URL:
+        set_music_brainz_server(app_config.MUSIC_BRAINZ_URL)
+
+    # Rate limiting is done by our own limiter, which is shared by all the workers on the host
+    musicbrainzngs.set_rate_limit(False)
+
+
+# The functions below put together the requests each kind of lookup is made from, and build its result from the responses. They are shared by
+# MusicBrainzProvider and AsyncMusicBrainzProvider, which only differ in how the requests are made and waited on.
+
+def get_stored_search_data(entity_type: str, search_query: str, artist_query: str, page: int, page_size: int, cache: Cache):
+    """
+        Returns the cached results of the search server for a search, or the matches from the search index while the server is backed up. The
+        index only has the entities that have been looked up, so it is otherwise only a stand-in for when the server fails (see
+        get_fallback_search_data), and its results are never cached as the server's. Returns None if the search has to go to the server.
+    """
+    data = get_cached_search_data(entity_type, search_query, artist_query, page, page_size, cache)
+
+    if data is None and search_index_preferred():
+        data = get_indexed_search_data(entity_type, search_query, artist_query, page_size, (page - 1) * page_size)
+
+    return data
+
+
+def get_fallback_search_data(entity_type: str, search_query: str, artist_query: str, page: int, page_size: int):
+    return get_indexed_search_data(entity_type, search_query, artist_query, page_size, (page - 1) * page_size)
+
+
+def build_search_result(entity_type: str, data: dict):
+    results = None
+
+    match entity_type:
+        case EntityType.ARTIST.value:
+            results = build_search_results(EntityType.ARTIST, 'artist-list', 'artist-count', data)
+        case EntityType.ALBUM.value:
+            results = build_search_results(EntityType.ALBUM, 'release-group-list', 'release-group-count', data)
+        case EntityType.SONG.value:
+            results = build_search_results(EntityType.SONG, 'recording-list', 'recording-count', data)
+
+    return results
+
+
+def get_artist_requests(entity_id: str, page_size: int, refresh: bool = False):
+    """Returns the requests for the artist, the first page of their albums, their images and the images of their albums"""
+    artist_request = DataRequest()
+    artist_request.data_type = 'artist'
+    artist_request.entity_id = entity_id
+    artist_request.refresh = refresh
+
+    artist_albums_request = copy.copy(artist_request)
+    artist_albums_request.data_type = 'artist_albums'
+    artist_albums_request.limit = page_size
+    artist_albums_request.offset = 0
+
+    artist_images_request = copy.copy(artist_request)
+    artist_images_request.data_type = 'artist_images'
+
+    album_images_request = copy.copy(artist_request)
+    album_images_request.data_type = 'album_images'
+
+    return [artist_request, artist_albums_request, artist_images_request, album_images_request]
+
+
+def build_artist_result(data: list, description: str):
+    result = build_artist(data, description)
+    submit_index_update(index_artist_lookup, data[0]['artist'], data[1])
+
+    return result
+
+
+def get_album_requests(entity_id: str, secondary_id: str, refresh: bool = False):
+    """Returns the requests for the release group and its images. The images are looked up under the artist, if we have their ID."""
+    album_request = DataRequest()
+    album_request.data_type = 'album'
+    album_request.entity_id = entity_id
+    album_request.refresh = refresh
+
+    album_images_request = copy.copy(album_request)
+    album_images_request.data_type = 'album_images'
+    album_images_request.entity_id = entity_id
+    album_images_request.secondary_id = secondary_id
+
+    return [album_request, album_images_request]
+
+
+def build_album_result(data: list, description: str, release_data: dict):
+    result = build_album(data, description)
+    result.label = release_data['label']
+    result.catalogNumber = release_data['catalog_number']
+    result.trackList = release_data['track_list']
+    submit_index_update(index_album_lookup, data[0]['release-group'], release_data['track_list'])
+
+    return result
+
+
+def get_song_requests(entity_id: str, page_size: int, refresh: bool = False):
+    """Returns the requests for the recording and the first page of the albums it is on"""
+    song_request = DataRequest()
+    song_request.data_type = 'song'
+    song_request.entity_id = entity_id
+    song_request.refresh = refresh
+
+    song_albums_request = copy.copy(song_request)
+    song_albums_request.data_type = 'song_albums'
+    song_albums_request.entity_id = entity_id
+    song_albums_request.release_types = ['album']
+    song_albums_request.limit = page_size
+    song_albums_request.offset = 0
 
-                print(f'__MusicBrainz song search: {datetime.datetime.now() - begin_time}')
+    return [song_request, song_albums_request]
 
-                results = build_search_results(EntityType.SONG, 'recording-list', 'recording-count', data)
 
-        print(f'Search total: {datetime.datetime.now() - begin_time}')
+def build_song_result(data: list):
+    result = build_song(data)
+    submit_index_update(index_song_lookup, data[0]['recording'], data[1])
+
+    return result
+
+
+def get_discography_requests(discog_type: str, entity_id: str, entity_type: str, page: int, page_size: int, refresh: bool = False):
+    """Returns the requests for a page of the discography and the images of the artist's albums"""
+    discog_request = DataRequest()
+    discog_request.entity_id = entity_id
+    discog_request.refresh = refresh
+
+    if entity_type == EntityType.SONG.value:
+        discog_request.data_type = 'song_albums'
+        discog_request.release_types = DISCOGRAPHY_RELEASE_TYPES.get(discog_type)
+        discog_request.offset = (page - 1) * page_size
+        discog_request.limit = page_size
+    else:
+        # An artist's whole discography is fetched once, and every page of every type is served from it
+        discog_request.data_type = 'discography_index'
+
+    album_images_request = copy.copy(discog_request)
+    album_images_request.data_type = 'album_images'
+
+    return [discog_request, album_images_request]
+
+
+def build_discography_result(data: list, discog_type: str, entity_type: str, page: int, page_size: int):
+    if entity_type != EntityType.SONG.value:
+        data[0] = get_discography_page(data[0], discog_type, page_size, (page - 1) * page_size)
+
+    return build_discography_list(data, entity_type, discog_type == DiscographyType.ALBUM.value)
+
+
+class MusicBrainzProvider(BaseProvider):
+    def __init__(self):
+        super().__init__()
+        set_up_music_brainz()
+
+
+    def run_search(self, entity_type, query, page, page_size, cache: Cache):
+        begin_time = time.monotonic()
+
+        search_query, artist_query = normalize_search_query(query, entity_type == EntityType.SONG.value)
+        data = get_stored_search_data(entity_type, search_query, artist_query, page, page_size, cache)
+
+        if data is None:
+            try:
+                data = self.search_music_brainz(entity_type, search_query, artist_query, page_size, (page - 1) * page_size)
+            except musicbrainzngs.MusicBrainzError:
+                data = get_fallback_search_data(entity_type, search_query, artist_query, page, page_size)
+
+                if data is None:
+                    raise
+            else:
+                set_cached_search_data(entity_type, search_query, artist_query, page, page_size, data, cache)
+
+        results = build_search_result(entity_type, data)
+        observe_duration('search_duration_seconds', {'entity': entity_type}, begin_time)
 
         return results
 
 
-    def run_lookup(self, entity_type, entity_id, secondary_id, page_size, cache: Cache):
-        result = None
-        begin_time = datetime.datetime.now()
+    @staticmethod
+    def search_music_brainz(entity_type, search_query, artist_query, page_size, offset):
+        data = None
 
         match entity_type:
             case EntityType.ARTIST.value:
-                artist_request = DataRequest()
-                artist_request.data_type = 'artist'
-                artist_request.entity_id = entity_id
+                data = call_music_brainz(RequestPriority.INTERACTIVE, musicbrainzngs.search_artists, artist=search_query, limit=page_size,
+                                         offset=offset)
+            case EntityType.ALBUM.value:
+                data = call_music_brainz(RequestPriority.INTERACTIVE, musicbrainzngs.search_release_groups, query=search_query, limit=page_size,
+                                         offset=offset, type='album', status='official')
+            case EntityType.SONG.value:
+                if artist_query:
+                    data = call_music_brainz(RequestPriority.INTERACTIVE, musicbrainzngs.search_recordings, query=search_query, limit=page_size,
+                                             offset=offset, artist=artist_query, primarytype='album', status='official')
+                else:
+                    data = call_music_brainz(RequestPriority.INTERACTIVE, musicbrainzngs.search_recordings, query=search_query, limit=page_size,
+                                             offset=offset, primarytype='album', status='official')
 
-                artist_albums_request = copy.copy(artist_request)
-                artist_albums_request.data_type = 'artist_albums'
-                artist_albums_request.limit = page_size
-                artist_albums_request.offset = 0
+        return data
 
-                artist_images_request = copy.copy(artist_request)
-                artist_images_request.data_type = 'artist_images'
-                artist_images_request.use_cache = False
 
-                album_images_request = copy.copy(artist_request)
-                album_images_request.data_type = 'album_images'
-                album_images_request.use_cache = False
+    def run_lookup(self, entity_type, entity_id, secondary_id, page_size, cache: Cache, budget: LookupBudget = None, refresh: bool = False):
+        """
+            A refresh (of a stale lookup result) fetches everything from the upstreams again, rather than reusing the cached responses, images and
+            descriptions, and replaces them in the cache.
+        """
+        result = None
+        begin_time = time.monotonic()
+        budget = budget or LookupBudget()
 
-                cached_artist_images = get_cached_images(entity_id, EntityType.ARTIST, cache)
-                cached_album_images = get_cached_images(entity_id, EntityType.ALBUM, cache)
+        match entity_type:
+            case EntityType.ARTIST.value:
+                artist_request, artist_albums_request, artist_images_request, album_images_request = get_artist_requests(entity_id, page_size,
+                                                                                                                         refresh)
+                futures = [
+                    self.submit_data_request(get_artist_data, artist_request, cache),
+                    self.submit_data_request(get_artist_data, artist_albums_request, cache),
+                    self.submit_images_request(get_artist_data, artist_images_request, EntityType.ARTIST, entity_id, cache),
+                    self.submit_images_request(get_artist_data, album_images_request, EntityType.ALBUM, entity_id, cache)
+                ]
+
+                # The description only depends on the artist record, so it is fetched while the other requests are still running
+                description_future = self.submit_description_fetch(futures[0].result()['artist'], cache, refresh)
+                data = [futures[0].result(), futures[1].result(), budget.get_optional_result(futures[2], 'images', []),
+                        budget.get_optional_result(futures[3], 'images', {})]
+                description = budget.get_optional_result(description_future, 'description', '') if description_future else ''
+
+                observe_duration('lookup_fetch_duration_seconds', {'entity': 'artist'}, begin_time)
+
+                result = build_artist_result(data, description)
+                self.submit_album_prefetch(result, cache)
+            case EntityType.ALBUM.value:
+                album_request, album_images_request = get_album_requests(entity_id, secondary_id, refresh)
 
-                if cached_artist_images:
-                    artist_images_request.use_cache = True
+                # We only cache fetched images if we have an artist ID they can be stored under
+                futures = [
+                    self.submit_data_request(get_album_data, album_request, cache),
+                    self.submit_images_request(get_album_data, album_images_request, EntityType.ALBUM, secondary_id, cache)
+                ]
 
-                if cached_album_images:
-                    album_images_request.use_cache = True
+                # Once we have the release group, the canonical release and the description can be fetched alongside the images
+                release_group = futures[0].result()['release-group']
+                release_future = self.submit_release_data_request(release_group, cache, refresh)
+                description_future = self.submit_description_fetch(release_group, cache, refresh)
 
-                with ThreadPoolExecutor(max_workers=4) as executor:
-                    data = list(executor.map(get_artist_data, [artist_request, artist_albums_request, artist_images_request, album_images_request]))
+                data = [futures[0].result(), budget.get_optional_result(futures[1], 'images', {})]
+                release_data = release_future.result()
+                description = budget.get_optional_result(description_future, 'description', '') if description_future else ''
 
-                print(f'__MusicBrainz artist lookup: {datetime.datetime.now() - begin_time}')
+                observe_duration('lookup_fetch_duration_seconds', {'entity': 'album'}, begin_time)
 
-                if cached_artist_images:
-                    data[2] = cached_artist_images
-                else:
-                    set_cached_images(entity_id, EntityType.ARTIST, data[2], cache)
+                result = build_album_result(data, description, release_data)
+            case EntityType.SONG.value:
+                futures = list(map(lambda x: self.submit_data_request(get_song_data, x, cache), get_song_requests(entity_id, page_size, refresh)))
+                data = list(map(lambda x: x.result(), futures))
 
-                if cached_album_images:
-                    data[3] = cached_album_images
-                else:
-                    set_cached_images(entity_id, EntityType.ALBUM, data[3], cache)
+                observe_duration('lookup_fetch_duration_seconds', {'entity': 'song'}, begin_time)
 
-                result = build_artist(data)
-            case EntityType.ALBUM.value:
-                album_request = DataRequest()
-                album_request.data_type = 'album'
-                album_request.entity_id = entity_id
+                result = build_song_result(data)
 
-                album_images_request = copy.copy(album_request)
-                album_images_request.data_type = 'album_images'
-                album_images_request.entity_id = entity_id
-                album_images_request.secondary_id = secondary_id
-                album_images_request.use_cache = False
+        observe_duration('lookup_duration_seconds', {'entity': entity_type}, begin_time)
 
-                cached_album_images = None
+        return result
 
-                if secondary_id:
-                    cached_album_images = get_cached_images(secondary_id, EntityType.ALBUM, cache)
 
-                if cached_album_images:
-                    album_images_request.use_cache = True
+    @staticmethod
+    def submit_data_request(fetch_function, data_request: DataRequest, cache: Cache):
+        # Cached MusicBrainz responses are returned right away, without taking up a worker
+        cached_response = get_cached_response(data_request, cache)
 
-                data_requests = [album_request, album_images_request]
+        if cached_response is not None:
+            return get_completed_future(cached_response)
 
-                with ThreadPoolExecutor(max_workers=4) as executor:
-                    data = list(executor.map(get_album_data, data_requests))
+        return music_brainz_requests.submit(get_response_cache_key(data_request),
+                                            lambda: get_executor(Upstream.MUSIC_BRAINZ).submit(fetch_response, fetch_function, data_request, cache))
 
-                print(f'__MusicBrainz album lookup: {datetime.datetime.now() - begin_time}')
 
-                if cached_album_images:
-                    data[1] = cached_album_images
-                else:
-                    # We only cache fetched images if we have an artist ID they can be stored under
-                    if secondary_id:
-                        set_cached_images(secondary_id, EntityType.ALBUM, data[1], cache)
+    @staticmethod
+    def submit_release_data_request(release_group: dict, cache: Cache, refresh: bool = False):
+        cached_release_data = get_cached_release_data(release_group['id'], cache) if not refresh else None
 
-                result = build_album(data)
-                release_data = get_release_data(data[0]['release-group'])
+        if cached_release_data is not None:
+            return get_completed_future(cached_release_data)
 
-                result.label = release_data['label']
-                result.catalogNumber = release_data['catalog_number']
-                result.trackList = release_data['track_list']
+        return release_data_requests.submit(release_group['id'],
+                                            lambda: get_executor(Upstream.MUSIC_BRAINZ).submit(get_release_data, release_group, cache,
+                                                                                                RequestPriority.INTERACTIVE, refresh))
 
-            case EntityType.SONG.value:
-                song_request = DataRequest()
-                song_request.data_type = 'song'
-                song_request.entity_id = entity_id
 
-                song_albums_request = copy.copy(song_request)
-                song_albums_request.data_type = 'song_albums'
-                song_albums_request.entity_id = entity_id
-                song_albums_request.limit = page_size
-                song_albums_request.offset = 0
+    @staticmethod
+    def submit_images_request(fetch_function, data_request: DataRequest, entity_type: EntityType, cache_entity_id: str, cache: Cache):
+        """
+            Images are cached under the given entity ID, if there is one, and are only fetched if they aren't cached already. Fetched images are
+            stored once, by whichever request started the fetch, rather than by every request that ends up sharing it.
+        """
+        cached_images = get_cached_images(cache_entity_id, entity_type, cache) if cache_entity_id and not data_request.refresh else None
 
-                data_requests = [song_request, song_albums_request]
+        if cached_images:
+            return get_completed_future(cached_images)
 
-                with ThreadPoolExecutor(max_workers=4) as executor:
-                    data = list(executor.map(get_song_data, data_requests))
+        def start_fetch():
+            future = get_executor(Upstream.FANART).submit(fetch_function, data_request)
 
-                print(f'__MusicBrainz song lookup: {datetime.datetime.now() - begin_time}')
+            if cache_entity_id:
+                future.add_done_callback(lambda x: set_cached_images(cache_entity_id, entity_type, x.result(), cache) if not x.exception() else None)
 
-                result = build_song(data)
+            return future
 
-        print(f'Lookup total: {datetime.datetime.now() - begin_time}')
+        request_key = f'{fetch_function.__name__}-{data_request.data_type}-{data_request.entity_id}-{data_request.secondary_id}'
 
-        return result
+        return image_requests.submit(request_key, start_fetch)
 
 
-    def run_discography_lookup(self, discog_type, entity_id, entity_type, page, page_size, cache: Cache):
-        offset = (page - 1) * page_size
-        release_types = None
-        album_only = False
-        begin_time = datetime.datetime.now()
-
-        match discog_type:
-            case DiscographyType.ALBUM.value:
-                release_types = ['album']
-                album_only = True
-            case DiscographyType.SINGLE_EP.value:
-                release_types = ['single', 'ep']
-            case DiscographyType.COMPILATION.value:
-                release_types = ['compilation']
-            case DiscographyType.LIVE.value:
-                release_types = ['live']
-            case DiscographyType.DEMO.value:
-                release_types = ['demo']
-
-        discog_request = DataRequest()
-        discog_request.data_type = 'song_albums' if entity_type == EntityType.SONG.value else 'discography'
-        discog_request.entity_id = entity_id
-        discog_request.release_types = release_types
-        discog_request.offset = offset
-        discog_request.limit = page_size
+    @staticmethod
+    def submit_album_prefetch(artist: Artist, cache: Cache):
+        submit_album_prefetch(artist, cache)
+
 
-        album_images_request = copy.copy(discog_request)
-        album_images_request.data_type = 'album_images'
-        album_images_request.use_cache = False
+    @staticmethod
+    def submit_description_fetch(record: dict, cache: Cache, refresh: bool = False):
+        wikidata_url = get_wikidata_url(record)
 
-        cached_album_images = get_cached_images(entity_id, EntityType.ALBUM, cache)
+        if wikidata_url:
+            return description_requests.submit(wikidata_url,
+                                               lambda: get_executor(Upstream.WIKIPEDIA).submit(get_entity_description, wikidata_url, cache, refresh))
 
-        if cached_album_images:
-            album_images_request.use_cache = True
+        return None
 
-        data_requests = [discog_request, album_images_request]
 
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            data = list(executor.map(get_discography_data, data_requests))
+    def run_discography_lookup(self, discog_type, entity_id, entity_type, page, page_size, cache: Cache, budget: LookupBudget = None,
+                               refresh: bool = False):
+        begin_time = time.monotonic()
+        budget = budget or LookupBudget()
 
-        print(f'__MusicBrainz discography lookup ({discog_type}): {datetime.datetime.now() - begin_time}')
+        discog_request, album_images_request = get_discography_requests(discog_type, entity_id, entity_type, page, page_size, refresh)
+        futures = [
+            self.submit_data_request(get_discography_data, discog_request, cache),
+            self.submit_images_request(get_discography_data, album_images_request, EntityType.ALBUM, entity_id, cache)
+        ]
+        data = [futures[0].result(), budget.get_optional_result(futures[1], 'images', {})]
 
-        if cached_album_images:
-            data[1] = cached_album_images
-        else:
-            set_cached_images(entity_id, EntityType.ALBUM, data[1], cache)
+        observe_duration('lookup_fetch_duration_seconds', {'entity': 'discography'}, begin_time)
 
-        result = build_discography_list(data, entity_type, album_only)
-        print(f'Discography lookup total: {datetime.datetime.now() - begin_time}')
+        result = build_discography_result(data, discog_type, entity_type, page, page_size)
+        observe_duration('discography_lookup_duration_seconds', {'entity': entity_type, 'discog_type': discog_type}, begin_time)
 
         return result
@@ -15,7 +15,7 @@ class SpotifyProvider(BaseProvider):
         self.client_secret = client_secret
 
 
-    def run_search(self, entity_type, query, page, page_size):
+    def run_search(self, entity_type, query, page, page_size, cache):
         auth_manager = SpotifyClientCredentials(self.client_id, self.client_secret)
         sp = spotipy.Spotify(auth_manager=auth_manager)
         results = None
@@ -34,7 +34,7 @@ class SpotifyProvider(BaseProvider):
         return results
 
 
-    def run_lookup(self, entity_type, entity_id, secondary_id, page_size, cache):
+    def run_lookup(self, entity_type, entity_id, secondary_id, page_size, cache, budget=None, refresh=False):
         # auth_manager = SpotifyClientCredentials(self.client_id, self.client_secret)
         # sp = spotipy.Spotify(auth_manager=auth_manager)
         result = None
@@ -50,7 +50,7 @@ class SpotifyProvider(BaseProvider):
         return result
 
 
-    def run_discography_lookup(self, discog_type, entity_id, entity_type, page, page_size, cache):
+    def run_discography_lookup(self, discog_type, entity_id, entity_type, page, page_size, cache, budget=None, refresh=False):
         pass # TODO
 
 
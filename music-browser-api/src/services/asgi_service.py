@@ -0,0 +1,207 @@
+import asyncio
+import io
+import sys
+
+import flask
+from flask.signals import request_started
+from werkzeug.exceptions import HTTPException
+
+from src.services.event_loop_service import set_event_loop
+from src.services.shared_service import uses_async_provider
+
+
+class AsgiAdapter:
+    """
+        Serves the app over ASGI. With the async provider on, lookups and searches are awaited on the server's event loop, so a worker can hold as
+        many of them as are waiting on the upstreams without a thread for each. Every other request is handed to the WSGI app on a thread, the
+        way an ASGI server runs any Flask app.
+    """
+
+    def __init__(self, app: flask.Flask):
+        self.app = app
+        self.views = {}
+        self.loop = None
+
+
+    def async_view(self, endpoint: str, input_schema, output_schema):
+        """
+            Registers an async version of the view for the given endpoint, which is used in its place when the async provider is on. Its query
+            parameters are parsed, and its result serialized, by the same APIFlask decorators the regular view uses.
+        """
+        parse_input = self.app.input(input_schema, location='query')(lambda query_data: query_data)
+        make_output = self.app.output(output_schema)(lambda result: result)
+
+        def decorator(view_function):
+            async def view(**kwargs):
+                return make_output(await view_function(**kwargs, query_data=parse_input()))
+
+            self.views[endpoint] = view
+
+            return view_function
+
+        return decorator
+
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.run_lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_request(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope type: {scope['type']}')
+
+
+    async def run_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                self.use_running_loop()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+    async def handle_request(self, scope: dict, receive, send):
+        self.use_running_loop()
+
+        environ = await self.get_environ(scope, receive)
+        view = self.get_async_view(environ)
+
+        if view is None:
+            status, headers, body = await asyncio.to_thread(self.call_wsgi_app, environ)
+        else:
+            status, headers, body = await self.call_async_view(view, environ)
+
+        await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+    def use_running_loop(self):
+        """
+            The server's loop is the one the async provider's calls run on, including the ones made from other threads (such as a background
+            refresh of a stale lookup), so everything shares its coalesced calls.
+        """
+        loop = asyncio.get_running_loop()
+
+        if self.loop is not loop:
+            self.loop = loop
+            set_event_loop(loop)
+
+
+    def get_async_view(self, environ: dict):
+        if not uses_async_provider(self.app.config):
+            return None
+
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # Left to the WSGI app, which gives the same response for it as it always has
+            return None
+
+        return self.views.get(endpoint)
+
+
+    async def call_async_view(self, view, environ: dict):
+        """
+            Does what Flask.wsgi_app does for a request, except the view is awaited. This and dispatch_request only use the app's public methods,
+            but they follow how this version of Flask handles a request, which is why Flask is pinned in the requirements.
+        """
+        with self.app.request_context(environ):
+            try:
+                response = await self.dispatch_request(view)
+            except Exception as error:
+                response = self.app.handle_exception(error)
+
+            return get_response_parts(response, environ)
+
+
+    async def dispatch_request(self, view):
+        """Does what Flask.full_dispatch_request does, except the view is awaited"""
+        try:
+            request_started.send(self.app)
+            response = self.app.preprocess_request()
+
+            if response is None:
+                if flask.request.routing_exception is not None:
+                    self.app.raise_routing_exception(flask.request)
+
+                response = await view(**flask.request.view_args)
+        except Exception as error:
+            response = self.app.handle_user_exception(error)
+
+        return self.app.finalize_request(response)
+
+
+    def call_wsgi_app(self, environ: dict):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        # The body has to be read first, since the app may not start the response until it is
+        body = read_body(self.app(environ, start_response))
+
+        return response['status'], response['headers'], body
+
+
+    @staticmethod
+    async def get_environ(scope: dict, receive):
+        """Builds the WSGI environment for a request, which is what Flask works from either way"""
+        body = b''
+        more_body = True
+
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        root_path = scope.get('root_path', '')
+        path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port or 80),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get('http_version', '1.1')}',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+
+        for name, value in scope.get('headers', []):
+            key = name.decode('latin-1').upper().replace('-', '_')
+            key = key if key in ['CONTENT_TYPE', 'CONTENT_LENGTH'] else f'HTTP_{key}'
+            value = value.decode('latin-1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+        return environ
+
+
+def get_response_parts(response: flask.Response, environ: dict):
+    body_parts, status, headers = response.get_wsgi_response(environ)
+
+    return status, headers, read_body(body_parts)
+
+
+def read_body(body_parts):
+    try:
+        return b''.join(body_parts)
+    finally:
+        if hasattr(body_parts, 'close'):
+            body_parts.close()
@@ -0,0 +1,46 @@
+import asyncio
+from concurrent.futures import Future
+import time
+
+
+class LookupBudget:
+    """
+        How long a lookup may spend waiting for its optional parts (images and descriptions). The core MusicBrainz data is always waited for,
+        however long it takes. Once the budget is used up, any optional part that hasn't arrived is left out of the result and noted as omitted.
+        A budget of zero or less never runs out.
+    """
+
+    def __init__(self, seconds: float = 0):
+        self.deadline = time.monotonic() + seconds if seconds > 0 else None
+        self.omitted = set()
+
+
+    def get_remaining_time(self):
+        if self.deadline is None:
+            return None
+
+        return max(self.deadline - time.monotonic(), 0)
+
+
+    def get_optional_result(self, future: Future, part: str, default):
+        """
+            Waits for the future for whatever is left of the budget. The work behind it keeps running when we stop waiting, so it still fills the
+            caches for the next request.
+        """
+        try:
+            return future.result(timeout=self.get_remaining_time())
+        except TimeoutError:
+            self.omitted.add(part)
+            return default
+
+
+    async def get_optional_result_async(self, task: asyncio.Task, part: str, default):
+        """
+            The same as get_optional_result, for a task. The task is shielded, so running out of time doesn't cancel it, and it keeps running on
+            the long-lived event loop after the lookup is done.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.get_remaining_time())
+        except TimeoutError:
+            self.omitted.add(part)
+            return default
@@ -0,0 +1,114 @@
+import asyncio
+from concurrent.futures import Future
+from contextlib import contextmanager
+import hashlib
+import os
+import threading
+
+from src import Config
+from src.services.metrics_service import increment_counter
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, in which case requests are only coalesced within each process
+    fcntl = None
+
+app_config = Config()
+
+# Lock files are shared out over a fixed number of stripes, so they don't pile up as new keys come along
+LOCK_STRIPES = 1024
+
+
+class SingleFlight:
+    """
+        Coalesces identical calls that are in flight at the same time. The first caller for a given key starts the work, and everyone who asks for
+        the same key before it finishes gets the same future back.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.tasks = set()
+
+
+    def submit(self, key: str, start_function) -> Future:
+        with self.lock:
+            future = self.calls.get(key)
+
+            if future is not None:
+                increment_counter('coalesced_requests', {'call': self.name, 'scope': 'process'})
+                return future
+
+            future = start_function()
+            self.calls[key] = future
+
+        future.add_done_callback(lambda x: self.remove(key, x))
+
+        return future
+
+
+    async def submit_async(self, key: str, coroutine_function):
+        """
+            The same as submit, for callers on an event loop. The first caller runs the coroutine as a task on its own loop, and the result is
+            passed on through a regular future, so calls made with submit, or from other event loops, can share it too.
+        """
+        def start_task():
+            # A running future can't be cancelled, so a caller that stops waiting doesn't cancel the call for everyone else
+            future = Future()
+            future.set_running_or_notify_cancel()
+
+            async def run():
+                try:
+                    future.set_result(await coroutine_function())
+                except asyncio.CancelledError:
+                    # A caller that stops waiting (such as when its lookup budget runs out) leaves the task running on the long-lived loop, so
+                    # it finishes and caches its result. Tasks are only cancelled when the loop is shutting down, and the call isn't started
+                    # again anywhere else, so anyone still waiting on it gets an error.
+                    future.set_exception(RuntimeError(f'The {self.name} call was cancelled'))
+                    raise
+                except Exception as error:
+                    future.set_exception(error)
+
+            # The loop only keeps a weak reference to its tasks
+            task = asyncio.get_running_loop().create_task(run())
+            self.tasks.add(task)
+            task.add_done_callback(self.remove_task)
+
+            return future
+
+        return await asyncio.wrap_future(self.submit(key, start_task))
+
+
+    def remove(self, key: str, future: Future):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+
+    def remove_task(self, task: asyncio.Task):
+        with self.lock:
+            self.tasks.discard(task)
+
+
+@contextmanager
+def host_lock(key: str):
+    """
+        Holds an exclusive lock for the given key across every worker process on the host. A worker that has to wait for the lock can then check
+        the cache for a result another worker has just stored, rather than making the same upstream call itself.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    os.makedirs(app_config.COALESCE_LOCK_DIR, exist_ok=True)
+
+    stripe = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+    fd = os.open(os.path.join(app_config.COALESCE_LOCK_DIR, f'{stripe}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
@@ -0,0 +1,74 @@
+import asyncio
+from concurrent.futures import Future
+import contextvars
+import inspect
+import threading
+
+event_loop = None
+event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+        The long-lived event loop the async provider's calls run on. When the service is served over ASGI, it is the server's own loop (see
+        AsgiAdapter). Otherwise a loop is started on a thread of its own the first time one is needed, and every worker thread hands its calls to
+        that, rather than each request starting and tearing down a loop of its own.
+    """
+    global event_loop
+
+    with event_loop_lock:
+        if event_loop is None or event_loop.is_closed():
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever, name='event-loop', daemon=True).start()
+
+        return event_loop
+
+
+def set_event_loop(loop: asyncio.AbstractEventLoop):
+    global event_loop
+
+    with event_loop_lock:
+        event_loop = loop
+
+
+def run_provider_call(result):
+    """
+        Calls to an async provider return a coroutine, which is run on the long-lived event loop while the calling thread waits for it. Results
+        from a regular provider are passed through as is.
+    """
+    if inspect.iscoroutine(result):
+        loop = get_event_loop()
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        # Waiting here for the loop we're running on would block it forever
+        if running_loop is loop:
+            result.close()
+            raise RuntimeError('Provider calls made on the event loop must be awaited')
+
+        # The coroutine runs in a copy of the caller's context, as it would with asyncio.run, so whatever it records for the request (like its
+        # stage timings) is kept with that request
+        context = contextvars.copy_context()
+        future = Future()
+
+        def start_task():
+            task = loop.create_task(result, context=context)
+            task.add_done_callback(lambda x: pass_on_result(x, future))
+
+        loop.call_soon_threadsafe(start_task)
+
+        return future.result()
+
+    return result
+
+
+def pass_on_result(task: asyncio.Task, future: Future):
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
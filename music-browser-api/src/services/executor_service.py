@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import threading
+
+from src import Config
+from src.enums.enums import Upstream
+
+
+class BoundedExecutor:
+    """A long-lived thread pool, which keeps track of how much work is waiting and running in it."""
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queued = 0
+        self.active = 0
+
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            self.queued += 1
+
+        # The work runs in a copy of the caller's context, so whatever it records for the request it was submitted by (like its stage timings)
+        # is kept with that request
+        return self.executor.submit(contextvars.copy_context().run, self.run, fn, *args, **kwargs)
+
+
+    def run(self, fn, *args, **kwargs):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+                if self.queued == 0 and self.active == 0:
+                    self.idle.notify_all()
+
+
+    def stats(self):
+        with self.lock:
+            return {'maxWorkers': self.max_workers, 'queued': self.queued, 'active': self.active}
+
+
+    def wait_until_idle(self):
+        """Waits until nothing is queued or running, including any work submitted by the work that was already there"""
+        with self.idle:
+            self.idle.wait_for(lambda: self.queued == 0 and self.active == 0)
+
+
+    def shutdown(self, wait: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+app_config = Config()
+executors = {}
+executors_lock = threading.Lock()
+
+# Work that isn't a call to an upstream itself, such as refreshing a cached lookup result, runs in this pool. It must never run on one of the
+# upstream pools, since it waits on work submitted to those.
+BACKGROUND_EXECUTOR = 'background'
+
+
+def init_executors():
+    """
+        Each upstream gets its own pool so that a slow one (usually fanart) can only tie up its own workers and not starve the others.
+    """
+    max_workers = {
+        Upstream.MUSIC_BRAINZ.value: app_config.MUSIC_BRAINZ_MAX_WORKERS,
+        Upstream.FANART.value: app_config.FANART_MAX_WORKERS,
+        Upstream.WIKIPEDIA.value: app_config.WIKIPEDIA_MAX_WORKERS,
+        BACKGROUND_EXECUTOR: app_config.BACKGROUND_MAX_WORKERS
+    }
+
+    with executors_lock:
+        for name, workers in max_workers.items():
+            if name not in executors:
+                executors[name] = BoundedExecutor(name, workers)
+
+
+def get_executor(upstream: Upstream):
+    return get_named_executor(upstream.value)
+
+
+def get_background_executor():
+    return get_named_executor(BACKGROUND_EXECUTOR)
+
+
+def get_named_executor(name: str):
+    if name not in executors:
+        # The app creates the executors at startup, but code that runs outside of it (e.g. command-line tools) may not have done so
+        init_executors()
+
+    return executors[name]
+
+
+def get_executor_stats():
+    return {name: executor.stats() for name, executor in executors.items()}
+
+
+def shutdown_executors(wait: bool = False):
+    """
+        Unless told to wait for them, work that hasn't started yet is cancelled, and work that is running is left to finish on its own. When
+        waiting, the background pool is drained before anything is shut down, since its work (such as a lookup refresh) submits to the upstream
+        pools and to the background pool itself.
+    """
+    with executors_lock:
+        background_executor = executors.get(BACKGROUND_EXECUTOR)
+        upstream_executors = [executor for name, executor in executors.items() if name != BACKGROUND_EXECUTOR]
+
+    if background_executor:
+        if wait:
+            background_executor.wait_until_idle()
+
+        background_executor.shutdown(wait)
+
+    for executor in upstream_executors:
+        executor.shutdown(wait)
+
+    with executors_lock:
+        executors.clear()
@@ -1,12 +1,21 @@
 import os
 from itertools import chain
-import datetime
 import fanart
 from fanart.core import Request
 from fanart.errors import ResponseFanartError
+import httpx
+import requests
 
-from src.schema.schema import Image
-from src.enums.enums import EntityType
+from src import Config
+from src.enums.enums import EntityType, Upstream
+from src.services.http_service import http_get, async_http_get
+from src.services.metrics_service import track_upstream_call
+
+app_config = Config()
+
+# The fanart package builds its request URLs from this module setting
+if app_config.FANART_URL:
+    fanart.BASEURL = app_config.FANART_URL
 
 
 def get_artist_images(entity_id: str):
@@ -14,37 +23,15 @@ def get_artist_images(entity_id: str):
         If any artist thumbnails or artist background images are found, they will be included. If none of either type is found, logo images will be
         returned if any of those are found.
     """
-    begin_time = datetime.datetime.now()
     images = []
 
     try:
-        request = Request(
-            apikey=os.environ.get('FANART_APIKEY'),
-            id=entity_id,
-            ws=fanart.WS.MUSIC,
-            type=fanart.TYPE.ALL,
-            sort=fanart.SORT.POPULAR,
-            limit=fanart.LIMIT.ONE,
-        )
-
-        data = request.response()
-
-        # We get all thumbnails and background images for the artist. If there are none of those, we return any logos present.
-        if 'artistthumb' in data and len(data['artistthumb']) > 0:
-            images = list(map(lambda x: Image().load({ 'url': x['url'] }), data['artistthumb']))
-
-        if 'artistbackground' in data and len(data['artistbackground']) > 0:
-            images = list(chain(images, list(map(lambda x: Image().load({ 'url': x['url'] }), data['artistbackground']))))
-
-        if 'hdmusiclogo' in data and len(data['hdmusiclogo']) > 0 and len(images) == 0:
-            images = list(map(lambda x: Image().load({ 'url': x['url'] }), data['hdmusiclogo']))
-
+        data = get_fanart_data(get_artist_images_request(entity_id), 'artist_images')
+        images = read_artist_images(data)
     except (ResponseFanartError, RuntimeError) as error:
         # TODO: Log this somewhere
         print(f'Error fetching artist images: {error}')
 
-    print(f'__Fanart artist lookup: {datetime.datetime.now() - begin_time}')
-
     return images
 
 
@@ -54,39 +41,133 @@ def get_album_images(entity_id: str, entity_type: EntityType):
         of images for their albums will be returned. If it's for an album, the dictionary returned will have at most one key for the given album, if
         any images were found.
     """
-    begin_time = datetime.datetime.now()
     images = {}
 
     try:
-        ws_param = fanart.WS.MUSIC_ALBUMS if entity_type == EntityType.ALBUM else fanart.WS.MUSIC
+        data = get_fanart_data(get_album_images_request(entity_id, entity_type), 'album_images')
+        images = read_album_images(data)
+    except (ResponseFanartError, RuntimeError) as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching artist images: {error}')
+
+    return images
 
-        request = Request(
-            apikey=os.environ.get('FANART_APIKEY'),
-            id=entity_id,
-            ws=ws_param,
-            type=fanart.TYPE.MUSIC.COVER,
-            sort=fanart.SORT.POPULAR,
-            limit=fanart.LIMIT.ONE,
-        )
 
-        data = request.response()
+async def get_artist_images_async(entity_id: str):
+    images = []
 
-        if 'albums' in data:
-            record = data['albums']
+    try:
+        data = await get_fanart_data_async(get_artist_images_request(entity_id), 'artist_images')
+        images = read_artist_images(data)
+    except (ResponseFanartError, RuntimeError) as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching artist images: {error}')
 
-            for key in record:
-                images[key] = []
+    return images
 
-                if 'albumcover' in record[key] and len(record[key]['albumcover']) > 0:
-                    images[key] = list(map(lambda x: Image().load({ 'url': x['url'] }), record[key]['albumcover']))
 
-                if 'cdart' in record[key] and len(record[key]) > 0 and len(images[key]) == 0:
-                    images[key] = list(map(lambda x: Image().load({ 'url': x['url'] }), record[key]['cdart']))
+async def get_album_images_async(entity_id: str, entity_type: EntityType):
+    images = {}
 
+    try:
+        data = await get_fanart_data_async(get_album_images_request(entity_id, entity_type), 'album_images')
+        images = read_album_images(data)
     except (ResponseFanartError, RuntimeError) as error:
         # TODO: Log this somewhere
         print(f'Error fetching artist images: {error}')
 
-    print(f'__Fanart album lookup: {datetime.datetime.now() - begin_time}')
+    return images
+
+
+def get_artist_images_request(entity_id: str):
+    return Request(
+        apikey=os.environ.get('FANART_APIKEY'),
+        id=entity_id,
+        ws=fanart.WS.MUSIC,
+        type=fanart.TYPE.ALL,
+        sort=fanart.SORT.POPULAR,
+        limit=fanart.LIMIT.ONE,
+    )
+
+
+def get_album_images_request(entity_id: str, entity_type: EntityType):
+    ws_param = fanart.WS.MUSIC_ALBUMS if entity_type == EntityType.ALBUM else fanart.WS.MUSIC
+
+    return Request(
+        apikey=os.environ.get('FANART_APIKEY'),
+        id=entity_id,
+        ws=ws_param,
+        type=fanart.TYPE.MUSIC.COVER,
+        sort=fanart.SORT.POPULAR,
+        limit=fanart.LIMIT.ONE,
+    )
+
+
+def read_artist_images(data: dict):
+    images = []
+
+    # We get all thumbnails and background images for the artist. If there are none of those, we return any logos present.
+    if 'artistthumb' in data and len(data['artistthumb']) > 0:
+        images = list(map(lambda x: {'url': x['url']}, data['artistthumb']))
+
+    if 'artistbackground' in data and len(data['artistbackground']) > 0:
+        images = list(chain(images, list(map(lambda x: {'url': x['url']}, data['artistbackground']))))
+
+    if 'hdmusiclogo' in data and len(data['hdmusiclogo']) > 0 and len(images) == 0:
+        images = list(map(lambda x: {'url': x['url']}, data['hdmusiclogo']))
+
+    return images
+
+
+def read_album_images(data: dict):
+    images = {}
+
+    if 'albums' in data:
+        record = data['albums']
+
+        for key in record:
+            images[key] = []
+
+            if 'albumcover' in record[key] and len(record[key]['albumcover']) > 0:
+                images[key] = list(map(lambda x: {'url': x['url']}, record[key]['albumcover']))
+
+            if 'cdart' in record[key] and len(record[key]) > 0 and len(images[key]) == 0:
+                images[key] = list(map(lambda x: {'url': x['url']}, record[key]['cdart']))
 
     return images
+
+
+def get_fanart_data(request: Request, call: str):
+    """
+        This does the same thing as Request.response() from the fanart package, except the request goes through our shared connection pool. Only
+        a failed request counts as an error in the metrics, since fanart also reports an entity with no images as an error.
+    """
+    try:
+        with track_upstream_call(Upstream.FANART.value, call):
+            response = http_get(str(request))
+            data = response.json()
+    except (requests.RequestException, ValueError) as error:
+        raise ResponseFanartError(str(error)) from error
+
+    return check_fanart_data(data, response.text)
+
+
+async def get_fanart_data_async(request: Request, call: str):
+    try:
+        with track_upstream_call(Upstream.FANART.value, call):
+            response = await async_http_get(str(request))
+            data = response.json()
+    except (httpx.HTTPError, ValueError) as error:
+        raise ResponseFanartError(str(error)) from error
+
+    return check_fanart_data(data, response.text)
+
+
+def check_fanart_data(data, response_text: str):
+    if not isinstance(data, dict):
+        raise ResponseFanartError(response_text)
+
+    if 'error message' in data:
+        raise ResponseFanartError(f'{data.get('status')} {data['error message']}')
+
+    return data
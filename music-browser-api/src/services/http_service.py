@@ -0,0 +1,68 @@
+import asyncio
+import threading
+from urllib.parse import urlparse
+import weakref
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from src import Config
+
+app_config = Config()
+sessions = {}
+sessions_lock = threading.Lock()
+
+# The clients used by async_http_get. Async clients are tied to the event loop they were created on, so each long-lived loop has one of its own,
+# which lasts as long as the loop does.
+async_clients = weakref.WeakKeyDictionary()
+
+
+def http_get(url: str, headers: dict = None):
+    """
+        All outbound HTTP from the services goes through here, so that connections to each upstream host are pooled and kept alive across
+        requests rather than paying for a new TCP and TLS handshake every time.
+    """
+    host = urlparse(url).hostname
+    session = get_session(host)
+
+    return session.get(url=url, headers=headers, timeout=get_host_timeout(host))
+
+
+def get_session(host: str):
+    with sessions_lock:
+        session = sessions.get(host)
+
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=app_config.HTTP_POOL_SIZE)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            if not app_config.HTTP_KEEP_ALIVE:
+                session.headers['connection'] = 'close'
+
+            sessions[host] = session
+
+    return session
+
+
+def get_host_timeout(host: str):
+    return app_config.HTTP_HOST_TIMEOUTS.get(host, app_config.HTTP_TIMEOUT)
+
+
+def get_async_client():
+    """The pool settings match the ones used for the requests sessions"""
+    loop = asyncio.get_running_loop()
+    client = async_clients.get(loop)
+
+    if client is None:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=app_config.HTTP_POOL_SIZE if app_config.HTTP_KEEP_ALIVE else 0)
+        client = async_clients[loop] = httpx.AsyncClient(limits=limits, timeout=app_config.HTTP_TIMEOUT)
+
+    return client
+
+
+async def async_http_get(url: str, headers: dict = None):
+    host = urlparse(url).hostname
+
+    return await get_async_client().get(url, headers=headers, timeout=get_host_timeout(host))
@@ -0,0 +1,574 @@
+import json
+import sqlite3
+import threading
+
+from src import Config
+from src.enums.enums import EntityType
+from src.services.search_index_service import create_search_index, search_index, add_artists, add_albums, add_songs, get_artist_entry, \
+                                              get_album_entry, is_album
+
+app_config = Config()
+connections = threading.local()
+
+# The records are stored in the same shape musicbrainzngs gives us for the equivalent web service request, so the builders in
+# music_brainz_service work on them unchanged. The other columns are only there to look records up by.
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS artist (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS release_group (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        types TEXT NOT NULL,
+        first_release_date TEXT NOT NULL,
+        has_official INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS artist_release_group (
+        artist_id TEXT NOT NULL,
+        release_group_id TEXT NOT NULL,
+        PRIMARY KEY (artist_id, release_group_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS release (
+        id TEXT PRIMARY KEY,
+        release_group_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        date TEXT NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS release_release_group ON release (release_group_id, date);
+    CREATE TABLE IF NOT EXISTS recording (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS recording_release (
+        recording_id TEXT NOT NULL,
+        release_id TEXT NOT NULL,
+        PRIMARY KEY (recording_id, release_id)
+    ) WITHOUT ROWID;
+'''
+
+# The most releases included in a release group lookup, which is the same limit the web service has
+RELEASE_LIST_LIMIT = 25
+
+IMPORT_BATCH_SIZE = 1000
+
+
+def get_connection():
+    """
+        Each thread gets its own read-only connection to the database, which it keeps for as long as it runs.
+    """
+    connection = getattr(connections, 'connection', None)
+
+    if connection is None:
+        connection = sqlite3.connect(f'file:{app_config.LOCAL_DATABASE_PATH}?mode=ro', uri=True, check_same_thread=False)
+        connections.connection = connection
+
+    return connection
+
+
+def get_artist(entity_id: str):
+    row = get_connection().execute('SELECT data FROM artist WHERE id = ?', (entity_id,)).fetchone()
+
+    if row is None:
+        raise LookupError(f'Artist {entity_id} not found')
+
+    return {'artist': json.loads(row[0])}
+
+
+def browse_release_groups(artist_id: str, release_types: list, limit: int, offset: int):
+    """
+        Release groups are filtered the way the web service does for its 'website-default' status, i.e. those with an official release, unless
+        the artist has none of those, in which case all of them are included.
+    """
+    connection = get_connection()
+    type_filter, type_params = get_type_filter(release_types)
+
+    official_only = connection.execute('SELECT EXISTS (SELECT 1 FROM artist_release_group arg JOIN release_group rg ON rg.id = arg.release_group_id '
+                                       'WHERE arg.artist_id = ? AND rg.has_official = 1)', (artist_id,)).fetchone()[0]
+
+    query = (f'FROM artist_release_group arg JOIN release_group rg ON rg.id = arg.release_group_id WHERE arg.artist_id = ? AND {type_filter}'
+             f'{' AND rg.has_official = 1' if official_only else ''}')
+    params = (artist_id, *type_params)
+
+    count = connection.execute(f'SELECT COUNT(*) {query}', params).fetchone()[0]
+    rows = connection.execute(f'SELECT rg.data {query} ORDER BY rg.first_release_date, rg.title, rg.id LIMIT ? OFFSET ?',
+                              (*params, limit or 25, offset or 0)).fetchall()
+
+    return {'release-group-list': list(map(lambda x: json.loads(x[0]), rows)), 'release-group-count': count}
+
+
+def get_release_group(entity_id: str):
+    connection = get_connection()
+    row = connection.execute('SELECT data FROM release_group WHERE id = ?', (entity_id,)).fetchone()
+
+    if row is None:
+        raise LookupError(f'Release group {entity_id} not found')
+
+    release_group = json.loads(row[0])
+    rows = connection.execute('SELECT data FROM release WHERE release_group_id = ? ORDER BY date, id LIMIT ?',
+                              (entity_id, RELEASE_LIST_LIMIT)).fetchall()
+    release_group['release-list'] = list(map(lambda x: get_release_summary(json.loads(x[0])), rows))
+
+    return {'release-group': release_group}
+
+
+def get_release(entity_id: str):
+    row = get_connection().execute('SELECT data FROM release WHERE id = ?', (entity_id,)).fetchone()
+
+    if row is None:
+        raise LookupError(f'Release {entity_id} not found')
+
+    return {'release': json.loads(row[0])}
+
+
+def get_recording(entity_id: str):
+    row = get_connection().execute('SELECT data FROM recording WHERE id = ?', (entity_id,)).fetchone()
+
+    if row is None:
+        raise LookupError(f'Recording {entity_id} not found')
+
+    return {'recording': json.loads(row[0])}
+
+
+def browse_releases(recording_id: str, release_types: list, limit: int, offset: int):
+    connection = get_connection()
+    type_filter, type_params = get_type_filter(release_types)
+
+    query = ('FROM recording_release rr JOIN release r ON r.id = rr.release_id JOIN release_group rg ON rg.id = r.release_group_id '
+             f'WHERE rr.recording_id = ? AND {type_filter}')
+    params = (recording_id, *type_params)
+
+    count = connection.execute(f'SELECT COUNT(*) {query}', params).fetchone()[0]
+    rows = connection.execute(f'SELECT r.data {query} ORDER BY r.date, r.id LIMIT ? OFFSET ?', (*params, limit or 25, offset or 0)).fetchall()
+
+    return {'release-list': list(map(lambda x: get_release_summary(json.loads(x[0]), True), rows)), 'release-count': count}
+
+
+def search(entity_type: EntityType, search_query: str, artist_query: str, limit: int, offset: int):
+    return search_index(get_connection(), entity_type, search_query, artist_query, limit, offset)
+
+
+def get_recording_album(connection: sqlite3.Connection, recording_id: str):
+    """Returns the release group of the earliest official album release the recording appears on, for showing in search results"""
+    row = connection.execute("SELECT rg.data FROM recording_release rr JOIN release r ON r.id = rr.release_id "
+                             "JOIN release_group rg ON rg.id = r.release_group_id WHERE rr.recording_id = ? AND r.status = 'official' "
+                             "AND rg.types LIKE '%|album|%' ORDER BY r.date, r.id LIMIT 1", (recording_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    release_group = json.loads(row[0])
+
+    return {'id': release_group['id'], 'title': release_group['title']}
+
+
+def get_type_filter(release_types: list):
+    if not release_types:
+        return '1 = 1', ()
+
+    return f'({' OR '.join(['rg.types LIKE ?'] * len(release_types))})', tuple(map(lambda x: f'%|{x.lower()}|%', release_types))
+
+
+def get_release_summary(release: dict, include_release_group: bool = False):
+    """The parts of a release that are included when it is listed as part of another entity, rather than looked up by itself"""
+    keys = ['id', 'title', 'status', 'date', 'country', 'disambiguation', 'artist-credit', 'artist-credit-phrase', 'release-event-list']
+
+    if include_release_group:
+        keys.append('release-group')
+
+    summary = {key: release[key] for key in keys if key in release}
+
+    if 'medium-list' in release:
+        summary['medium-list'] = list(map(lambda x: compact({'position': x.get('position'), 'format': x.get('format'),
+                                                              'track-count': x.get('track-count')}), release['medium-list']))
+
+    return summary
+
+
+def create_database(path: str):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    create_search_index(connection)
+
+    return connection
+
+
+def import_records(connection: sqlite3.Connection, entity: str, lines):
+    """
+        Imports the records from one of the MusicBrainz JSON dumps, given as an iterable of lines with one JSON record on each. Returns the number
+        of records imported.
+    """
+    import_function = IMPORT_FUNCTIONS[entity]
+    batch = []
+    count = 0
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        batch.append(json.loads(line))
+
+        if len(batch) == IMPORT_BATCH_SIZE:
+            import_function(connection, batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        import_function(connection, batch)
+        count += len(batch)
+
+    connection.commit()
+
+    return count
+
+
+def finish_import(connection: sqlite3.Connection):
+    """Fills in what depends on more than one dump, once they have all been imported"""
+    connection.execute("UPDATE release_group SET has_official = EXISTS (SELECT 1 FROM release WHERE release.release_group_id = release_group.id "
+                       "AND release.status = 'official')")
+    connection.commit()
+
+    build_search_index(connection)
+    connection.execute('ANALYZE')
+
+
+def build_search_index(connection: sqlite3.Connection):
+    """
+        Fills the search index from the imported records. Searches only return albums with an official release, and the songs in the results are
+        shown with the earliest official album they are on.
+    """
+    connection.execute('DELETE FROM artist_entry')
+    connection.execute('DELETE FROM album_entry')
+    connection.execute('DELETE FROM song_entry')
+
+    for rows in read_batches(connection.execute('SELECT data FROM artist')):
+        add_artists(connection, list(map(lambda x: get_artist_entry(json.loads(x[0])), rows)))
+
+    for rows in read_batches(connection.execute('SELECT data FROM release_group WHERE has_official = 1')):
+        add_albums(connection, list(filter(is_album, map(lambda x: get_album_entry(json.loads(x[0])), rows))))
+
+    for rows in read_batches(connection.execute('SELECT id, data FROM recording')):
+        songs = []
+
+        for row in rows:
+            song = json.loads(row[1])
+            release_group = get_recording_album(connection, row[0])
+
+            if release_group:
+                song['release-list'] = [{'release-group': release_group}]
+
+            songs.append(song)
+
+        add_songs(connection, songs)
+
+    connection.commit()
+
+
+def read_batches(cursor: sqlite3.Cursor):
+    rows = cursor.fetchmany(IMPORT_BATCH_SIZE)
+
+    while rows:
+        yield rows
+        rows = cursor.fetchmany(IMPORT_BATCH_SIZE)
+
+
+def import_artists(connection: sqlite3.Connection, records: list):
+    connection.executemany('INSERT OR REPLACE INTO artist (id, name, data) VALUES (?, ?, ?)',
+                           map(lambda x: (x['id'], x['name'], json.dumps(convert_artist(x))), records))
+
+
+def import_release_groups(connection: sqlite3.Connection, records: list):
+    rows = []
+    artist_rows = []
+
+    for record in records:
+        release_group = convert_release_group(record)
+        types = [record.get('primary-type')] + record.get('secondary-types', [])
+
+        rows.append((record['id'], record['title'], release_group.get('artist-credit-phrase', ''),
+                     '|' + '|'.join(map(lambda x: x.lower(), filter(None, types))) + '|', record.get('first-release-date') or '',
+                     json.dumps(release_group)))
+        artist_rows.extend(map(lambda x: (x['artist']['id'], record['id']), record.get('artist-credit', [])))
+
+    connection.executemany('INSERT OR REPLACE INTO release_group (id, title, artist_name, types, first_release_date, data) VALUES (?, ?, ?, ?, ?, ?)',
+                           rows)
+    connection.executemany('INSERT OR IGNORE INTO artist_release_group (artist_id, release_group_id) VALUES (?, ?)', artist_rows)
+
+
+def import_releases(connection: sqlite3.Connection, records: list):
+    rows = []
+    recording_rows = []
+
+    for record in records:
+        rows.append((record['id'], record['release-group']['id'], (record.get('status') or '').lower(), record.get('date') or '',
+                     json.dumps(convert_release(record))))
+
+        for medium in record.get('media', []):
+            recording_rows.extend(map(lambda x: (x['recording']['id'], record['id']), medium.get('tracks', [])))
+
+    connection.executemany('INSERT OR REPLACE INTO release (id, release_group_id, status, date, data) VALUES (?, ?, ?, ?, ?)', rows)
+    connection.executemany('INSERT OR IGNORE INTO recording_release (recording_id, release_id) VALUES (?, ?)', recording_rows)
+
+
+def import_recordings(connection: sqlite3.Connection, records: list):
+    rows = []
+
+    for record in records:
+        recording = convert_recording(record)
+        rows.append((record['id'], record['title'], recording.get('artist-credit-phrase', ''), json.dumps(recording)))
+
+    connection.executemany('INSERT OR REPLACE INTO recording (id, title, artist_name, data) VALUES (?, ?, ?, ?)', rows)
+
+
+IMPORT_FUNCTIONS = {
+    'artist': import_artists,
+    'release-group': import_release_groups,
+    'release': import_releases,
+    'recording': import_recordings
+}
+
+
+def convert_artist(record: dict):
+    """
+        The convert functions turn a record from the JSON dumps into what musicbrainzngs would return for it, with the includes we use for that
+        type of request. As with the XML the web service returns, empty values are left out.
+    """
+    artist = compact({
+        'id': record['id'],
+        'name': record['name'],
+        'sort-name': record.get('sort-name'),
+        'type': record.get('type'),
+        'disambiguation': record.get('disambiguation'),
+        'life-span': convert_life_span(record.get('life-span')),
+        'area': convert_area(record.get('area')),
+        'begin-area': convert_area(record.get('begin-area')),
+        'end-area': convert_area(record.get('end-area'))
+    })
+
+    add_tags(artist, record)
+    add_relations(artist, record)
+    add_annotation(artist, record)
+
+    if record.get('aliases'):
+        artist['alias-list'] = list(map(lambda x: compact({'alias': x['name'], 'sort-name': x.get('sort-name'), 'type': x.get('type'),
+                                                           'locale': x.get('locale'), 'primary': 'primary' if x.get('primary') else None}),
+                                        record['aliases']))
+
+    return artist
+
+
+def convert_release_group(record: dict):
+    release_group = compact({
+        'id': record['id'],
+        'title': record['title'],
+        'type': get_release_group_type(record),
+        'primary-type': record.get('primary-type'),
+        'secondary-type-list': record.get('secondary-types') or None,
+        'first-release-date': record.get('first-release-date'),
+        'disambiguation': record.get('disambiguation')
+    })
+
+    add_artist_credit(release_group, record)
+    add_tags(release_group, record)
+    add_relations(release_group, record)
+    add_annotation(release_group, record)
+
+    return release_group
+
+
+def convert_release(record: dict):
+    release = compact({
+        'id': record['id'],
+        'title': record['title'],
+        'status': record.get('status'),
+        'date': record.get('date'),
+        'country': record.get('country'),
+        'disambiguation': record.get('disambiguation'),
+        'release-group': compact({
+            'id': record['release-group']['id'],
+            'title': record['release-group']['title'],
+            'type': get_release_group_type(record['release-group']),
+            'primary-type': record['release-group'].get('primary-type'),
+            'first-release-date': record['release-group'].get('first-release-date')
+        })
+    })
+
+    add_artist_credit(release, record)
+
+    release_events = list(map(lambda x: compact({'date': x.get('date'), 'area': convert_area(x.get('area'))}), record.get('release-events') or []))
+
+    if release_events:
+        release['release-event-list'] = release_events
+
+    if record.get('label-info'):
+        release['label-info-list'] = list(map(lambda x: compact({
+            'catalog-number': x.get('catalog-number'),
+            'label': compact({'id': x['label']['id'], 'name': x['label']['name'], 'disambiguation': x['label'].get('disambiguation')})
+                     if x.get('label') else None
+        }), record['label-info']))
+
+    if record.get('media'):
+        release['medium-list'] = list(map(convert_medium, record['media']))
+
+    return release
+
+
+def convert_medium(record: dict):
+    medium = compact({
+        'position': str(record['position']) if record.get('position') is not None else None,
+        'format': record.get('format'),
+        'track-count': record.get('track-count')
+    })
+
+    tracks = []
+
+    for item in record.get('tracks', []):
+        track = compact({
+            'id': item['id'],
+            'position': str(item['position']) if item.get('position') is not None else None,
+            'number': item.get('number'),
+            'length': str(item['length']) if item.get('length') is not None else None,
+            'recording': compact({
+                'id': item['recording']['id'],
+                'title': item['recording']['title'],
+                'length': str(item['recording']['length']) if item['recording'].get('length') is not None else None
+            })
+        })
+
+        add_artist_credit(track, item)
+        tracks.append(track)
+
+    medium['track-list'] = tracks
+
+    return medium
+
+
+def convert_recording(record: dict):
+    recording = compact({
+        'id': record['id'],
+        'title': record['title'],
+        'length': str(record['length']) if record.get('length') is not None else None,
+        'disambiguation': record.get('disambiguation'),
+        'first-release-date': record.get('first-release-date')
+    })
+
+    add_artist_credit(recording, record)
+    add_tags(recording, record)
+    add_relations(recording, record)
+    add_annotation(recording, record)
+
+    return recording
+
+
+def get_release_group_type(record: dict):
+    """
+        The web service gives a release group a single type, which is its secondary type (e.g. Compilation or Live) for an album that has one, and
+        its primary type otherwise
+    """
+    secondary_types = record.get('secondary-types') or []
+
+    if record.get('primary-type') == 'Album' and len(secondary_types) > 0:
+        return secondary_types[0]
+
+    return record.get('primary-type')
+
+
+def convert_life_span(record: dict):
+    if not record:
+        return None
+
+    return compact({'begin': record.get('begin'), 'end': record.get('end'), 'ended': 'true' if record.get('ended') else None}) or None
+
+
+def convert_area(record: dict):
+    if not record:
+        return None
+
+    return compact({'id': record.get('id'), 'name': record.get('name'), 'sort-name': record.get('sort-name')})
+
+
+def convert_artist_stub(record: dict):
+    return compact({
+        'id': record['id'],
+        'name': record['name'],
+        'sort-name': record.get('sort-name'),
+        'type': record.get('type'),
+        'disambiguation': record.get('disambiguation')
+    })
+
+
+def add_artist_credit(target: dict, record: dict):
+    """musicbrainzngs gives an artist credit as a list of name credits, with any join phrase between them as a plain string"""
+    if not record.get('artist-credit'):
+        return
+
+    credit = []
+    phrase = ''
+
+    for item in record['artist-credit']:
+        name_credit = {'artist': convert_artist_stub(item['artist'])}
+
+        if item.get('name') and item['name'] != item['artist']['name']:
+            name_credit['name'] = item['name']
+
+        credit.append(name_credit)
+        phrase += (item.get('name') or item['artist']['name']) + (item.get('joinphrase') or '')
+
+        if item.get('joinphrase'):
+            credit.append(item['joinphrase'])
+
+    target['artist-credit'] = credit
+    target['artist-credit-phrase'] = phrase
+
+
+def add_tags(target: dict, record: dict):
+    if record.get('tags'):
+        target['tag-list'] = list(map(lambda x: {'name': x['name'], 'count': str(x['count'])}, record['tags']))
+
+    if record.get('genres'):
+        target['genre-list'] = list(map(lambda x: compact({'id': x.get('id'), 'name': x['name'], 'count': str(x['count'])}), record['genres']))
+
+
+def add_relations(target: dict, record: dict):
+    url_relations = []
+    artist_relations = []
+
+    for relation in record.get('relations') or []:
+        entry = compact({
+            'type': relation.get('type'),
+            'direction': relation.get('direction') if relation.get('direction') == 'backward' else None,
+            'begin': relation.get('begin'),
+            'end': relation.get('end'),
+            'ended': 'true' if relation.get('ended') else None,
+            'source-credit': relation.get('source-credit'),
+            'target-credit': relation.get('target-credit')
+        })
+
+        if relation.get('target-type') == 'url' and relation.get('url'):
+            entry['target'] = relation['url']['resource']
+            url_relations.append(entry)
+        elif relation.get('target-type') == 'artist' and relation.get('artist'):
+            entry['target'] = relation['artist']['id']
+            entry['artist'] = convert_artist_stub(relation['artist'])
+            artist_relations.append(entry)
+
+    if url_relations:
+        target['url-relation-list'] = url_relations
+
+    if artist_relations:
+        target['artist-relation-list'] = artist_relations
+
+
+def add_annotation(target: dict, record: dict):
+    if record.get('annotation'):
+        target['annotation'] = {'text': record['annotation']}
+
+
+def compact(record: dict):
+    return {key: value for key, value in record.items() if value is not None and value != ''}
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import json
+import time
+from apiflask import Schema
+from flask_caching import Cache
+
+from src import Config
+from src.services.budget_service import LookupBudget
+from src.services.coalesce_service import SingleFlight
+from src.services.event_loop_service import run_provider_call
+from src.services.executor_service import get_background_executor
+from src.services.metrics_service import record_cache_access, increment_counter
+from src.services.serialization_service import serialize
+
+app_config = Config()
+lookup_refreshes = SingleFlight('lookup_refresh')
+
+
+def get_lookup_result(cache_key: str, schema: Schema, lookup_function, cache: Cache):
+    """
+        Returns the serialized result of a lookup, along with its freshness, ETag and the optional parts it had to leave out. A result younger than
+        LOOKUP_FRESH_AGE is 'fresh'. An older one that is still within LOOKUP_STALE_GRACE is 'stale'; it is returned right away and a refresh is
+        started in the background, so the next request gets an up-to-date result. Anything else is a 'miss', and the caller waits for the lookup to
+        run, which is given LOOKUP_BUDGET to fetch its optional parts in. The lookup function is passed the budget, and whether it is a refresh.
+        A refresh goes back to the upstreams rather than rebuilding the result from the cached responses, which outlive LOOKUP_FRESH_AGE. The
+        lookup function may return a coroutine (as the async provider does), which is run on the event loop.
+    """
+    result = get_current_lookup_result(cache_key, schema, lookup_function, cache)
+
+    if result is not None:
+        return result
+
+    data, etag, omitted = refresh_lookup(cache_key, schema, lookup_function, LookupBudget(app_config.LOOKUP_BUDGET), cache)
+
+    return data, 'miss', etag, omitted
+
+
+async def get_lookup_result_async(cache_key: str, schema: Schema, lookup_function, cache: Cache):
+    """
+        The same as get_lookup_result, for callers on the event loop. The lookup function has to return a coroutine, which is awaited on a miss.
+        The cache is read and written from worker threads, so the loop isn't held up while it does.
+    """
+    result = await asyncio.to_thread(get_current_lookup_result, cache_key, schema, lookup_function, cache)
+
+    if result is not None:
+        return result
+
+    budget = LookupBudget(app_config.LOOKUP_BUDGET)
+    data = serialize(schema, await lookup_function(budget))
+    etag, omitted = await asyncio.to_thread(store_lookup_result, cache_key, data, budget, cache)
+
+    return data, 'miss', etag, omitted
+
+
+def get_current_lookup_result(cache_key: str, schema: Schema, lookup_function, cache: Cache):
+    """Returns the cached result if it is fresh or stale, starting a refresh of a stale one, and None on a miss"""
+    entry = get_cached_lookup(cache_key, cache)
+    record_cache_access('lookup', entry is not None)
+
+    if entry is not None:
+        age = time.time() - entry['stored_at']
+
+        # Entries stored by earlier versions of the service don't have an ETag
+        etag = entry.get('etag') or get_etag(entry['data'])
+
+        if age < app_config.LOOKUP_FRESH_AGE:
+            return entry['data'], 'fresh', etag, []
+
+        if age < app_config.LOOKUP_FRESH_AGE + app_config.LOOKUP_STALE_GRACE:
+            # Nobody is waiting on a background refresh, so it has no budget, and always gets the whole result
+            lookup_refreshes.submit(cache_key, lambda: get_background_executor().submit(refresh_lookup, cache_key, schema, lookup_function,
+                                                                                          LookupBudget(), cache, True))
+            return entry['data'], 'stale', etag, []
+
+    return None
+
+
+def refresh_lookup(cache_key: str, schema: Schema, lookup_function, budget: LookupBudget, cache: Cache, refresh: bool = False):
+    data = serialize(schema, run_provider_call(lookup_function(budget, refresh)))
+    etag, omitted = store_lookup_result(cache_key, data, budget, cache)
+
+    return data, etag, omitted
+
+
+def store_lookup_result(cache_key: str, data: dict, budget: LookupBudget, cache: Cache):
+    """
+        A result that is missing some of its optional parts isn't stored, so the next request runs the lookup again. By then the parts that were
+        late have usually been cached, and the lookup is complete.
+    """
+    etag = get_etag(data)
+    omitted = sorted(budget.omitted)
+
+    if omitted:
+        for part in omitted:
+            increment_counter('partial_lookups', {'omitted': part})
+    else:
+        set_cached_lookup(cache_key, data, etag, cache)
+
+    return etag, omitted
+
+
+def get_etag(data: dict):
+    """
+        The ETag is a hash of the serialized result. The response body is serialized from the same data with sorted keys, so the two always change
+        together, and the ETag is known without building the response.
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:40]
+
+
+def get_cached_lookup(cache_key: str, cache: Cache):
+    entry = None
+
+    try:
+        entry = cache.get(cache_key)
+    except RuntimeError as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching cached lookup: {error}')
+
+    return entry
+
+
+def set_cached_lookup(cache_key: str, data: dict, etag: str, cache: Cache):
+    try:
+        cache.set(cache_key, {'stored_at': time.time(), 'data': data, 'etag': etag}, timeout=app_config.LOOKUP_FRESH_AGE + app_config.LOOKUP_STALE_GRACE)
+    except RuntimeError as error:
+        # TODO: Log this somewhere
+        print(f'Error storing lookup in the cache: {error}')
@@ -0,0 +1,142 @@
+import bisect
+from contextlib import contextmanager
+import threading
+import time
+
+from src.services.executor_service import get_executor_stats
+from src.services.timing_service import add_stage_time, add_cache_access, UPSTREAM_STAGES
+
+METRIC_PREFIX = 'music_browser'
+
+# Upper bounds in seconds, which cover everything from a cache read up to an upstream call that has been stuck behind the rate limiter
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+counters = {}
+histograms = {}
+counters_lock = threading.Lock()
+
+
+def increment_counter(name: str, labels: dict = None, amount: int = 1):
+    """
+        Counters are kept per process, so with several workers each one reports its own values.
+    """
+    key = (name, tuple(sorted((labels or {}).items())))
+
+    with counters_lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe_histogram(name: str, labels: dict, value: float):
+    """Each histogram keeps a count per bucket, plus the sum and count of everything observed. The bucket counts are made cumulative when rendered."""
+    key = (name, tuple(sorted((labels or {}).items())))
+
+    with counters_lock:
+        histogram = histograms.get(key)
+
+        if histogram is None:
+            histogram = histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+
+        if index < len(LATENCY_BUCKETS):
+            histogram['buckets'][index] += 1
+
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def observe_duration(name: str, labels: dict, begin_time: float):
+    """The begin time should come from time.monotonic()"""
+    observe_histogram(name, labels, time.monotonic() - begin_time)
+
+
+@contextmanager
+def track_upstream_call(upstream: str, call: str):
+    """
+        Records how long a call to an upstream took, and counts it as an error if it raised. The time is also added to the request's Server-Timing
+        stage for the upstream. This works around an await too, so the async calls are timed the same way.
+    """
+    labels = {'upstream': upstream, 'call': call}
+    begin_time = time.monotonic()
+
+    try:
+        yield
+    except Exception:
+        increment_counter('upstream_errors', labels)
+        raise
+    finally:
+        duration = time.monotonic() - begin_time
+        observe_histogram('upstream_request_duration_seconds', labels, duration)
+        add_stage_time(UPSTREAM_STAGES.get(upstream, upstream), duration)
+
+
+def record_cache_access(cache_name: str, hit: bool):
+    increment_counter('cache_requests', {'cache': cache_name, 'result': 'hit' if hit else 'miss'})
+    add_cache_access(cache_name, hit)
+
+
+def get_counters():
+    with counters_lock:
+        return list(map(lambda x: {'name': x[0][0], 'labels': dict(x[0][1]), 'value': x[1]}, counters.items()))
+
+
+def get_metrics_text():
+    """Renders the counters, histograms and executor gauges in the Prometheus text exposition format (version 0.0.4)"""
+    with counters_lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted(map(lambda x: (x[0], {'buckets': list(x[1]['buckets']), 'sum': x[1]['sum'], 'count': x[1]['count']}),
+                                     histograms.items()))
+
+    lines = []
+    written = set()
+
+    for (name, labels), value in counter_items:
+        metric = f'{METRIC_PREFIX}_{name}_total'
+
+        if metric not in written:
+            lines.append(f'# TYPE {metric} counter')
+            written.add(metric)
+
+        lines.append(f'{metric}{format_labels(dict(labels))} {format_value(value)}')
+
+    for (name, labels), histogram in histogram_items:
+        metric = f'{METRIC_PREFIX}_{name}'
+        labels = dict(labels)
+
+        if metric not in written:
+            lines.append(f'# TYPE {metric} histogram')
+            written.add(metric)
+
+        total = 0
+
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            total += count
+            lines.append(f'{metric}_bucket{format_labels(labels | {'le': format_value(bound)})} {total}')
+
+        lines.append(f'{metric}_bucket{format_labels(labels | {'le': '+Inf'})} {histogram['count']}')
+        lines.append(f'{metric}_sum{format_labels(labels)} {format_value(histogram['sum'])}')
+        lines.append(f'{metric}_count{format_labels(labels)} {histogram['count']}')
+
+    executor_stats = sorted(get_executor_stats().items())
+
+    for name, key in [('executor_queued', 'queued'), ('executor_active', 'active'), ('executor_max_workers', 'maxWorkers')]:
+        metric = f'{METRIC_PREFIX}_{name}'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.extend(map(lambda x: f'{metric}{format_labels({'executor': x[0]})} {x[1][key]}', executor_stats))
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(map(lambda x: f'{x[0]}="{escape_label_value(str(x[1]))}"', labels.items())) + '}'
+
+
+def escape_label_value(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
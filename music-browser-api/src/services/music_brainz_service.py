@@ -1,12 +1,21 @@
+import asyncio
+import hashlib
+import json
+import re
+import urllib.parse
 from flask_caching import Cache
 import musicbrainzngs
 
 from src import Config
-from src.schema.schema import SearchResult, Artist, Album, Song, Image, Member, LifeSpan, Link, Discography, SearchOutput, Tag, Track, TrackList
-from src.services.fanart_service import get_artist_images, get_album_images
-from src.services.wikipedia_service import get_entity_description
-from src.models.models import Links, DataRequest
-from src.enums.enums import EntityType
+from src.services.fanart_service import get_artist_images, get_album_images, get_artist_images_async, get_album_images_async
+from src.models.models import DataRequest, SearchResult, Artist, Album, Song, Image, Member, LifeSpan, Link, Discography, SearchOutput, Tag, Track, \
+                             TrackList
+from src.enums.enums import EntityType, RequestPriority, DiscographyType, Upstream
+from src.services.metrics_service import record_cache_access, increment_counter, track_upstream_call
+from src.services.timing_service import timed_stage
+from src.services.coalesce_service import host_lock
+from src.services.rate_limit_service import music_brainz_rate_limiter
+from src.services.http_service import async_http_get
 
 app_config = Config()
 excluded_tags = list(map(lambda x: x.strip(), app_config.EXCLUDED_TAGS.split(','))) if app_config.EXCLUDED_TAGS else []
@@ -15,15 +24,56 @@ excluded_tags = list(map(lambda x: x.strip(), app_config.EXCLUDED_TAGS.split(','
 # potentially deal with rendering very large page numbers in their pagination UI.
 MAX_SEARCH_RESULTS = 200
 
+# The includes used for each type of MusicBrainz request. These also determine the version of the cached responses for each type, so a change here
+# means entries fetched with the old includes are no longer used.
+INCLUDES = {
+    'artist': ['tags', 'genres', 'aliases', 'artist-rels', 'url-rels', 'annotation'],
+    # The 'releases' include is needed for this request to succeed, even though we are doing a lookup of a release group (not sure why)
+    'album': ['tags', 'genres', 'releases', 'artist-credits', 'media', 'url-rels', 'annotation'],
+    'release': ['recordings', 'labels', 'artist-credits'],
+    'song': ['artist-credits', 'tags', 'genres', 'url-rels', 'annotation'],
+    'song_albums': ['artist-credits', 'release-groups']
+}
+
+# The MusicBrainz release group types included in each type of discography
+DISCOGRAPHY_RELEASE_TYPES = {
+    DiscographyType.ALBUM.value: ['album'],
+    DiscographyType.SINGLE_EP.value: ['single', 'ep'],
+    DiscographyType.COMPILATION.value: ['compilation'],
+    DiscographyType.LIVE.value: ['live'],
+    DiscographyType.DEMO.value: ['demo']
+}
+
+# The most release groups MusicBrainz returns for a single browse request
+DISCOGRAPHY_PAGE_SIZE = 100
+
+# The countries whose releases are preferred when picking the release for a release group, in order of preference
+COUNTRY_ORDER = ['US', 'GB', 'CA', 'AU', 'JP']
+
+
+def set_music_brainz_server(url: str):
+    """Points musicbrainzngs at the server with the given URL, e.g. http://localhost:8081. The async calls build their URLs from the same settings."""
+    parts = urllib.parse.urlparse(url)
+    musicbrainzngs.set_hostname(parts.netloc, parts.scheme == 'https')
+
+
+def call_music_brainz(priority: RequestPriority, function, **kwargs):
+    """Every MusicBrainz call goes through here so that it gets a slot from the rate limiter shared by all workers on the host"""
+    music_brainz_rate_limiter.wait(priority)
+
+    with track_upstream_call(Upstream.MUSIC_BRAINZ.value, function.__name__):
+        return function(**kwargs)
+
+
 def get_artist_data(data_request: DataRequest):
     result = None
 
     if data_request.data_type == 'artist':
-        result = musicbrainzngs.get_artist_by_id(id=data_request.entity_id, includes=['tags', 'genres', 'artist-rels', 'url-rels', 'annotation'])
+        result = call_music_brainz(data_request.priority, musicbrainzngs.get_artist_by_id, id=data_request.entity_id, includes=INCLUDES['artist'])
 
     if data_request.data_type == 'artist_albums':
-        result = musicbrainzngs.browse_release_groups(artist=data_request.entity_id, release_type=['album'], release_group_status='website-default',
-                                                      limit=data_request.limit, offset=data_request.offset, )
+        result = call_music_brainz(data_request.priority, musicbrainzngs.browse_release_groups, artist=data_request.entity_id, release_type=['album'],
+                                   release_group_status='website-default', limit=data_request.limit, offset=data_request.offset)
     if data_request.data_type == 'artist_images':
         if not data_request.use_cache:
             result = get_artist_images(data_request.entity_id)
@@ -38,13 +88,16 @@ def get_artist_data(data_request: DataRequest):
 def get_discography_data(data_request: DataRequest):
     result = None
 
-    if data_request.data_type == 'discography':
-        result = musicbrainzngs.browse_release_groups(artist=data_request.entity_id, release_type=data_request.release_types, limit=data_request.limit,
-                                                      offset=data_request.offset, release_group_status='website-default')
+    if data_request.data_type == 'discography_index':
+        release_groups = read_all_release_groups(lambda limit, offset: call_music_brainz(data_request.priority, musicbrainzngs.browse_release_groups,
+                                                                                         artist=data_request.entity_id, limit=limit, offset=offset,
+                                                                                         release_group_status='website-default'))
+        result = build_discography_index(release_groups)
 
     if data_request.data_type == 'song_albums':
-        result = musicbrainzngs.browse_releases(recording=data_request.entity_id, release_type=data_request.release_types, limit=data_request.limit,
-                                                offset=data_request.offset, includes=['artist-credits', 'release-groups'])
+        result = call_music_brainz(data_request.priority, musicbrainzngs.browse_releases, recording=data_request.entity_id,
+                                   release_type=data_request.release_types, limit=data_request.limit, offset=data_request.offset,
+                                   includes=INCLUDES['song_albums'])
 
     if data_request.data_type == 'album_images':
         if not data_request.use_cache:
@@ -53,13 +106,80 @@ def get_discography_data(data_request: DataRequest):
     return result
 
 
+def read_all_release_groups(browse_function):
+    """
+        Reads every release group of an artist, a page of DISCOGRAPHY_PAGE_SIZE at a time (the most MusicBrainz allows), from the given function,
+        which is called with the limit and offset for each page.
+    """
+    release_groups = []
+    more = True
+
+    while more:
+        more = add_release_group_page(release_groups, browse_function(DISCOGRAPHY_PAGE_SIZE, len(release_groups)))
+
+    return release_groups
+
+
+async def read_all_release_groups_async(browse_function):
+    """The same as read_all_release_groups, for a browse function that is a coroutine"""
+    release_groups = []
+    more = True
+
+    while more:
+        more = add_release_group_page(release_groups, await browse_function(DISCOGRAPHY_PAGE_SIZE, len(release_groups)))
+
+    return release_groups
+
+
+def add_release_group_page(release_groups: list, page: dict):
+    """
+        Adds a page of release groups to the ones read so far, and returns whether there are more to read. Reading stops at the count MusicBrainz
+        gives, or at an empty page in case the count is off.
+    """
+    release_groups.extend(page.get('release-group-list', []))
+
+    return bool(page.get('release-group-list')) and len(release_groups) < int(page.get('release-group-count', 0))
+
+
+def build_discography_index(release_groups: list):
+    """
+        Builds the index the artist discography pages are served from. It has the list of release groups for each discography type, each one sorted
+        by release date across the whole list, so any page of any type can be sliced out of it with an accurate count. A release group is listed
+        under every type its primary or secondary types match, as the type filter of a MusicBrainz browse would do, except that albums only
+        include release groups whose type is Album (i.e. without a secondary type such as Compilation or Live).
+    """
+    index = {discog_type: [] for discog_type in DISCOGRAPHY_RELEASE_TYPES}
+
+    for release_group in release_groups:
+        entry = {key: release_group[key] for key in ['id', 'title', 'type', 'primary-type', 'secondary-type-list', 'first-release-date']
+                 if key in release_group}
+        types = list(map(lambda x: str(x).lower(), [release_group.get('primary-type')] + release_group.get('secondary-type-list', [])))
+
+        for discog_type, release_types in DISCOGRAPHY_RELEASE_TYPES.items():
+            if discog_type == DiscographyType.ALBUM.value and str(release_group.get('type')).lower() != 'album':
+                continue
+
+            if any(x in types for x in release_types):
+                index[discog_type].append(entry)
+
+    for discog_type in index:
+        index[discog_type] = sorted(index[discog_type], key=lambda x: x.get('first-release-date', ''))
+
+    return index
+
+
+def get_discography_page(index: dict, discog_type: str, limit: int, offset: int):
+    """Returns a page of the given discography type from the index, in the same shape as a browse of the artist's release groups"""
+    release_groups = index.get(discog_type, [])
+
+    return {'release-group-list': release_groups[offset:offset + limit], 'release-group-count': len(release_groups)}
+
+
 def get_album_data(data_request: DataRequest):
     result = None
 
     if data_request.data_type == 'album':
-        # The 'releases' include is needed for this request to succeed, even though we are doing a lookup of a release group (not sure why)
-        includes = ['tags', 'genres', 'releases', 'artist-credits', 'media', 'url-rels', 'annotation']
-        result = musicbrainzngs.get_release_group_by_id(id=data_request.entity_id, includes=includes)
+        result = call_music_brainz(data_request.priority, musicbrainzngs.get_release_group_by_id, id=data_request.entity_id, includes=INCLUDES['album'])
 
     if data_request.data_type == 'album_images':
         if not data_request.use_cache:
@@ -73,7 +193,52 @@ def get_album_data(data_request: DataRequest):
     return result
 
 
-def get_release_data(release_group):
+@timed_stage('release')
+def get_release_data(release_group, cache: Cache, priority: RequestPriority = RequestPriority.INTERACTIVE, refresh: bool = False):
+    """
+        Returns the track lists, label and catalog number for the given release group, taken from the release picked by get_release_id. A list of
+        track lists is used to support releases that have more than one medium (e.g. box sets). For most albums there will only be one. The result
+        is cached by release group, so later lookups of the same album don't need the release at all. A refresh fetches the release again, and
+        replaces what is cached.
+    """
+    result = get_cached_release_data(release_group['id'], cache) if not refresh else None
+
+    if result is not None:
+        return result
+
+    release_request = get_release_request(release_group, priority, refresh)
+
+    if release_request is None:
+        result = {'release_id': None, 'track_list': [], 'label': '', 'catalog_number': ''}
+    else:
+        release_data = get_cached_response(release_request, cache)
+
+        if release_data is None:
+            release_data = fetch_response(get_release_by_id, release_request, cache)
+
+        result = build_release_data(release_data)
+
+    set_cached_release_data(release_group['id'], result, cache)
+
+    return result
+
+
+def get_release_request(release_group, priority: RequestPriority, refresh: bool = False):
+    release_id = get_release_id(release_group)
+
+    if release_id is None:
+        return None
+
+    release_request = DataRequest()
+    release_request.data_type = 'release'
+    release_request.entity_id = release_id
+    release_request.priority = priority
+    release_request.refresh = refresh
+
+    return release_request
+
+
+def get_release_id(release_group):
     """
         This function attempts to retrieve an accurate MusicBrainz release based on a given release group. It's not perfect because we aren't
         using the existing facility that MusicBrainz offers to get a canonical release, which itself is fairly unwieldy. Instead, we are making
@@ -93,162 +258,489 @@ def get_release_data(release_group):
         - If a release hasn't been found, do the same check on non-date-matching releases using the same country order. If one is found, use it.
         - If a release still hasn't been found, we use the first one in the original list.
     :param release_group: The release group for which we want to get release data.
-    :return: A list of track lists for the given release group, if a candidate release was found. A list of track lists is used to support releases
-    that have more than one medium (e.g. box sets). For most albums the return value will only have one element.
+    :return: The ID of the release to use for the given release group, or None if it doesn't have any releases.
     """
-    result = {'track_list': [], 'label': '', 'catalog_number': ''}
-
-    if 'release-list' in release_group and len(release_group['release-list']) > 0:
-        release_id = None
+    if 'release-list' not in release_group or len(release_group['release-list']) == 0:
+        return None
 
-        release_list = release_group['release-list']
-        candidate_releases = {
-            'release-date': [],
-            'other-date': [],
-            'format': ''
-        }
+    release_id = None
+    release_list = release_group['release-list']
 
-        if len(release_list) == 1:
-            release_id = release_list[0]['id']
-        else:
-            for release in release_list:
-                if 'status' in release and str(release['status']).lower() == 'official' and 'country' in release:
-                    candidate_release = {'release_id': release['id'], 'country': release['country'], 'format': ''}
+    if len(release_list) == 1:
+        release_id = release_list[0]['id']
+    else:
+        # Both buckets are keyed by country. For date matches, a CD release replaces one in another format (there could be some instances where
+        # the first US release has multiple mediums, which will probably not make sense for the given album). Otherwise the first release for a
+        # country is the one kept.
+        first_release_date = release_group.get('first-release-date')
+        release_date_matches = {}
+        other_date_releases = {}
 
-                    if 'medium-list' in release and len(release['medium-list']) > 0 and 'format' in release['medium-list'][0]:
-                        candidate_release['format'] = release['medium-list'][0]['format']
+        for release in release_list:
+            if 'status' not in release or str(release['status']).lower() != 'official' or 'country' not in release:
+                continue
 
-                    if 'first-release-date' in release_group and 'date' in release and release_group['first-release-date'] == release['date']:
-                        existing_items = [x for x in candidate_releases['release-date'] if x['country'] == release['country']]
+            country = release['country']
 
-                        if len(existing_items) > 0:
-                            # If we've already found a release for the given country but it is not in CD format, and the release being checked is
-                            # for the same country but is in CD format, use it instead. There could be some instances where the first US release
-                            # has multiple mediums, which will probably not make sense for the given album.
-                            if existing_items[0]['format'] != 'CD' and candidate_release['format'] == 'CD':
-                                existing_items[0]['release_id'] = candidate_release['release_id']
+            if first_release_date is not None and 'date' in release and release['date'] == first_release_date:
+                release_format = ''
 
-                            continue
+                if 'medium-list' in release and len(release['medium-list']) > 0 and 'format' in release['medium-list'][0]:
+                    release_format = release['medium-list'][0]['format']
 
-                        candidate_releases['release-date'].append(candidate_release)
-                        continue
+                existing_release = release_date_matches.get(country)
 
-                    if not any(x for x in candidate_releases['other-date'] if x['country'] == release['country']):
-                        existing_items = [x for x in candidate_releases['other-date'] if x['country'] == release['country']]
+                if existing_release is None:
+                    release_date_matches[country] = {'release_id': release['id'], 'format': release_format}
+                elif existing_release['format'] != 'CD' and release_format == 'CD':
+                    existing_release['release_id'] = release['id']
+            elif country not in other_date_releases:
+                other_date_releases[country] = release['id']
 
-                        if len(existing_items) > 0:
-                            if existing_items[0]['format'] != 'CD' and candidate_release['format'] == 'CD':
-                                existing_items[0]['release_id'] = candidate_release['release_id']
+        if len(release_date_matches) > 0:
+            release_id = get_release_id_by_country({key: value['release_id'] for key, value in release_date_matches.items()})
+        elif len(other_date_releases) > 0:
+            release_id = get_release_id_by_country(other_date_releases)
 
-                            continue
+    if release_id is None:
+        release_id = release_list[0]['id']
 
-                        candidate_releases['other-date'].append(candidate_release)
+    return release_id
 
-            if len(candidate_releases['release-date']) > 0:
-                release_id = get_release_id_by_country(candidate_releases['release-date'])
-            elif len(candidate_releases['other-date']) > 0:
-                release_id = get_release_id_by_country(candidate_releases['other-date'])
 
-        if release_id is None:
-            release_id = release_list[0]['id']
+def build_release_data(release_data: dict):
+    record = release_data['release']
+    result = {'release_id': record['id'], 'track_list': [], 'label': '', 'catalog_number': ''}
 
-        release_data = musicbrainzngs.get_release_by_id(id=release_id, includes=['recordings', 'labels', 'artist-credits'])
-        record = release_data['release']
+    if 'medium-list' in record and len(record['medium-list']) > 0:
+        for item in record['medium-list']:
+            track_list = build_release_tracks(item)
+            result['track_list'].append(track_list)
 
-        if 'medium-list' in record and len(record['medium-list']) > 0:
-            for item in record['medium-list']:
-                track_list = build_release_tracks(item)
-                result['track_list'].append(track_list)
+    if 'label-info-list' in record and len(record['label-info-list']) > 0:
+        if 'catalog-number' in record['label-info-list'][0] and len(record['label-info-list']) > 0 and record['label-info-list'][0]['catalog-number'] != '[none]':
+            result['catalog_number'] = record['label-info-list'][0]['catalog-number']
 
-        if 'label-info-list' in record and len(record['label-info-list']) > 0:
-            if 'catalog-number' in record['label-info-list'][0] and len(record['label-info-list']) > 0 and record['label-info-list'][0]['catalog-number'] != '[none]':
-                result['catalog_number'] = record['label-info-list'][0]['catalog-number']
+        if 'label' in record['label-info-list'][0] and len(record['label-info-list']) > 0 and record['label-info-list'][0]['label']['name'] != '[no label]':
+            result['label'] = record['label-info-list'][0]['label']['name']
 
-            if 'label' in record['label-info-list'][0] and len(record['label-info-list']) > 0 and record['label-info-list'][0]['label']['name'] != '[no label]':
-                result['label'] = record['label-info-list'][0]['label']['name']
+            if 'disambiguation' in record['label-info-list'][0]['label']:
+                result['label'] += f' ({record['label-info-list'][0]['label']['disambiguation']})'
 
-                if 'disambiguation' in record['label-info-list'][0]['label']:
-                    result['label'] += f' ({record['label-info-list'][0]['label']['disambiguation']})'
 
     return result
 
 
+def get_release_by_id(data_request: DataRequest):
+    return call_music_brainz(data_request.priority, musicbrainzngs.get_release_by_id, id=data_request.entity_id, includes=INCLUDES['release'])
+
+
 def get_song_data(data_request: DataRequest):
     result = None
 
     if data_request.data_type == 'song':
-        result = musicbrainzngs.get_recording_by_id(id=data_request.entity_id, includes=['artist-credits', 'tags', 'genres', 'url-rels', 'annotation'])
+        result = call_music_brainz(data_request.priority, musicbrainzngs.get_recording_by_id, id=data_request.entity_id, includes=INCLUDES['song'])
 
     if data_request.data_type == 'song_albums':
-        result = musicbrainzngs.browse_releases(recording=data_request.entity_id, release_type=['album'], includes=['artist-credits', 'release-groups'],
-                                                limit=data_request.limit, offset=data_request.offset)
+        result = call_music_brainz(data_request.priority, musicbrainzngs.browse_releases, recording=data_request.entity_id, release_type=['album'],
+                                   includes=INCLUDES['song_albums'], limit=data_request.limit, offset=data_request.offset)
 
     return result
 
 
-def get_release_id_by_country(candidate_releases: list):
-    release_id = None
-    country_list = []
-
-    for candidate_release in candidate_releases:
-        country = candidate_release['country']
-        country_obj = {}
-
-        if country == 'US':
-            country_obj['ordinal'] = 1
-        elif country == 'GB':
-            country_obj['ordinal'] = 2
-        elif country == 'CA':
-            country_obj['ordinal'] = 3
-        elif country == 'AU':
-            country_obj['ordinal'] = 4
-        elif country == 'JP':
-            country_obj['ordinal'] = 5
-        else:
-            continue
+async def call_music_brainz_async(priority: RequestPriority, entity: str, entity_id: str = '', includes: list = None, params: dict = None):
+    """
+        Makes the same request musicbrainzngs would for the given entity, ID, includes and parameters, on the running event loop. The response is
+        parsed by musicbrainzngs, so the result has the same shape as the one from the equivalent musicbrainzngs function.
+    """
+    await music_brainz_rate_limiter.wait_async(priority)
 
-        country_obj['release_id'] = candidate_release['release_id']
-        country_list.append(country_obj)
+    url = get_music_brainz_url(entity, entity_id, includes, params)
 
-    country_list = sorted(country_list, key=lambda x: x['ordinal'])
+    with track_upstream_call(Upstream.MUSIC_BRAINZ.value, get_music_brainz_call_name(entity, entity_id, params)):
+        response = await async_http_get(url, headers={'user-agent': musicbrainzngs.musicbrainz._useragent})
 
-    if len(country_list) > 0:
-        release_id = country_list[0]['release_id']
+        if response.status_code != 200:
+            raise musicbrainzngs.ResponseError(f'Status {response.status_code} for {url}')
 
-    return release_id
+    return musicbrainzngs.musicbrainz.mb_parser_xml(response.content)
+
+
+def get_music_brainz_call_name(entity: str, entity_id: str, params: dict = None):
+    """The name of the musicbrainzngs function that makes the same call, so the metrics for both providers line up"""
+    name = entity.replace('-', '_')
+
+    if entity_id:
+        return f'get_{name}_by_id'
+
+    return f'search_{name}s' if 'query' in (params or {}) else f'browse_{name}s'
+
+
+def get_music_brainz_url(entity: str, entity_id: str, includes: list = None, params: dict = None):
+    args = dict(params or {})
+
+    if includes:
+        args['inc'] = ' '.join(includes)
+
+    scheme = 'https' if musicbrainzngs.musicbrainz.https else 'http'
+    query = urllib.parse.urlencode(sorted(args.items()))
+
+    return urllib.parse.urlunparse((scheme, musicbrainzngs.musicbrainz.hostname, f'/ws/2/{entity}/{entity_id}', '', query, ''))
+
+
+def get_browse_params(params: dict, release_types: list = None, limit: int = None, offset: int = None):
+    """Browse parameters as musicbrainzngs builds them, where the limit and offset are left out unless they are set to something other than zero"""
+    result = dict(params)
+
+    if limit:
+        result['limit'] = limit
+
+    if offset:
+        result['offset'] = offset
+
+    if release_types:
+        result['type'] = '|'.join(release_types)
+
+    return result
+
+
+def get_search_params(fields: dict, query: str = '', limit: int = None, offset: int = None):
+    """
+        Search parameters as musicbrainzngs builds them for a search that has fields, which all of ours do. The query and the field values are
+        escaped and lower-cased.
+    """
+    query_parts = []
+
+    if query:
+        query_parts.append(re.sub(musicbrainzngs.musicbrainz.LUCENE_SPECIAL, r'\\\1', query).lower())
+
+    for key, value in fields.items():
+        value = re.sub(musicbrainzngs.musicbrainz.LUCENE_SPECIAL, r'\\\1', value)
+
+        if value:
+            query_parts.append(f'{key}:({value.lower()})')
+
+    result = {'query': ' '.join(query_parts).strip()}
+
+    if limit:
+        result['limit'] = str(limit)
+
+    if offset:
+        result['offset'] = str(offset)
+
+    return result
+
+
+async def get_artist_data_async(data_request: DataRequest):
+    result = None
+
+    if data_request.data_type == 'artist':
+        result = await call_music_brainz_async(data_request.priority, 'artist', data_request.entity_id, INCLUDES['artist'])
+
+    if data_request.data_type == 'artist_albums':
+        params = get_browse_params({'artist': data_request.entity_id, 'release-group-status': 'website-default'}, ['album'], data_request.limit,
+                                   data_request.offset)
+        result = await call_music_brainz_async(data_request.priority, 'release-group', params=params)
+
+    if data_request.data_type == 'artist_images':
+        if not data_request.use_cache:
+            result = await get_artist_images_async(data_request.entity_id)
+
+    if data_request.data_type == 'album_images':
+        if not data_request.use_cache:
+            result = await get_album_images_async(data_request.entity_id, EntityType.ARTIST)
+
+    return result
+
+
+async def get_discography_data_async(data_request: DataRequest):
+    result = None
+
+    if data_request.data_type == 'discography_index':
+        params = {'artist': data_request.entity_id, 'release-group-status': 'website-default'}
+        release_groups = await read_all_release_groups_async(lambda limit, offset: call_music_brainz_async(
+            data_request.priority, 'release-group', params=get_browse_params(params, limit=limit, offset=offset)))
+        result = build_discography_index(release_groups)
+
+    if data_request.data_type == 'song_albums':
+        params = get_browse_params({'recording': data_request.entity_id}, data_request.release_types, data_request.limit, data_request.offset)
+        result = await call_music_brainz_async(data_request.priority, 'release', includes=INCLUDES['song_albums'], params=params)
+
+    if data_request.data_type == 'album_images':
+        if not data_request.use_cache:
+            result = await get_album_images_async(data_request.entity_id, EntityType.ARTIST)
+
+    return result
+
+
+async def get_album_data_async(data_request: DataRequest):
+    result = None
+
+    if data_request.data_type == 'album':
+        result = await call_music_brainz_async(data_request.priority, 'release-group', data_request.entity_id, INCLUDES['album'])
+
+    if data_request.data_type == 'album_images':
+        if not data_request.use_cache:
+            if data_request.secondary_id:
+                entity_id = data_request.secondary_id
+            else:
+                entity_id = data_request.entity_id
+
+            result = await get_album_images_async(entity_id, EntityType.ALBUM)
+
+    return result
+
+
+@timed_stage('release')
+async def get_release_data_async(release_group, cache: Cache, priority: RequestPriority = RequestPriority.INTERACTIVE, refresh: bool = False):
+    """The same as get_release_data, for callers on an event loop. The cached entries are read and written on worker threads."""
+    result = await asyncio.to_thread(get_cached_release_data, release_group['id'], cache) if not refresh else None
+
+    if result is not None:
+        return result
+
+    release_request = get_release_request(release_group, priority, refresh)
+
+    if release_request is None:
+        result = {'release_id': None, 'track_list': [], 'label': '', 'catalog_number': ''}
+    else:
+        release_data = await asyncio.to_thread(get_cached_response, release_request, cache)
+
+        if release_data is None:
+            release_data = await fetch_response_async(get_release_by_id_async, release_request, cache)
+
+        result = build_release_data(release_data)
+
+    await asyncio.to_thread(set_cached_release_data, release_group['id'], result, cache)
+
+    return result
+
+
+async def get_release_by_id_async(data_request: DataRequest):
+    return await call_music_brainz_async(data_request.priority, 'release', data_request.entity_id, INCLUDES['release'])
+
+
+async def get_song_data_async(data_request: DataRequest):
+    result = None
+
+    if data_request.data_type == 'song':
+        result = await call_music_brainz_async(data_request.priority, 'recording', data_request.entity_id, INCLUDES['song'])
+
+    if data_request.data_type == 'song_albums':
+        params = get_browse_params({'recording': data_request.entity_id}, ['album'], data_request.limit, data_request.offset)
+        result = await call_music_brainz_async(data_request.priority, 'release', includes=INCLUDES['song_albums'], params=params)
+
+    return result
+
+
+def get_release_id_by_country(releases_by_country: dict):
+    """Returns the release for the first of the countries in COUNTRY_ORDER that has one, if any of them do"""
+    for country in COUNTRY_ORDER:
+        if country in releases_by_country:
+            return releases_by_country[country]
+
+    return None
+
+
+def fetch_response(fetch_function, data_request: DataRequest, cache: Cache):
+    if data_request.data_type not in app_config.RESPONSE_CACHE_TIMEOUTS:
+        return fetch_function(data_request)
+
+    # Background calls can wait a long time for a slot in the rate limit, so they don't take the host-wide lock, which would hold up an
+    # interactive request for the same response (such as a visitor opening the album being prefetched) for all of that time
+    if data_request.priority == RequestPriority.BACKGROUND:
+        result = fetch_function(data_request)
+        set_cached_response(data_request, result, cache)
+
+        return result
+
+    with host_lock(get_response_cache_key(data_request)):
+        # Another worker may have fetched the same response while we were waiting for the lock
+        result = get_cached_response(data_request, cache)
+
+        if result is not None:
+            increment_counter('coalesced_requests', {'call': 'musicbrainz', 'scope': 'host'})
+            return result
+
+        result = fetch_function(data_request)
+        set_cached_response(data_request, result, cache)
+
+    return result
+
+
+async def fetch_response_async(fetch_function, data_request: DataRequest, cache: Cache):
+    """
+        The same as fetch_response, except it doesn't take the host-wide lock, since waiting on that would hold up the event loop. Identical calls
+        from other workers are only avoided once the response is in the cache, which is written from a worker thread.
+    """
+    result = await fetch_function(data_request)
+    await asyncio.to_thread(set_cached_response, data_request, result, cache)
+
+    return result
+
+
+def get_cached_response(data_request: DataRequest, cache: Cache):
+    response = None
+
+    # A request made to refresh a lookup always goes to MusicBrainz, and the response it gets replaces the cached one
+    if data_request.data_type in app_config.RESPONSE_CACHE_TIMEOUTS and not data_request.refresh:
+        try:
+            response = cache.get(get_response_cache_key(data_request))
+        except RuntimeError as error:
+            # TODO: Log this somewhere
+            print(f'Error fetching cached response: {error}')
+
+        record_cache_access('response', response is not None)
+
+    return response
+
+
+def set_cached_response(data_request: DataRequest, response: dict, cache: Cache):
+    if data_request.data_type in app_config.RESPONSE_CACHE_TIMEOUTS and response is not None:
+        try:
+            cache.set(get_response_cache_key(data_request), response, timeout=int(app_config.RESPONSE_CACHE_TIMEOUTS[data_request.data_type]))
+        except RuntimeError as error:
+            # TODO: Log this somewhere
+            print(f'Error storing response in the cache: {error}')
+
+
+def get_response_cache_key(data_request: DataRequest):
+    """
+        The key is built from the parts of the request that affect the MusicBrainz response, plus a version derived from the includes for that type
+        of request.
+    """
+    version = hashlib.md5(json.dumps(INCLUDES.get(data_request.data_type, [])).encode('utf-8')).hexdigest()[:8]
+    release_types = '+'.join(sorted(map(lambda x: x.lower(), data_request.release_types))) if data_request.release_types else ''
+
+    return f'mb-{data_request.data_type}-{version}-{data_request.entity_id}-{release_types}-{data_request.limit}-{data_request.offset}'
+
+
+def normalize_search_query(query: str, parse_artist: bool):
+    """
+        Search text is trimmed, case-folded and has its whitespace collapsed, so queries that only differ in those ways share cache entries (the
+        search server ignores those differences anyway). If requested, an 'artist:' qualifier is split off and returned separately.
+    """
+    search_query = re.sub(r'\s+', ' ', query).strip().casefold()
+    artist_query = ''
+
+    if parse_artist and 'artist:' in search_query:
+        artist_query = search_query[search_query.index('artist:') + 7:].strip()
+        search_query = search_query[:search_query.index('artist:')].strip()
+
+    return search_query, artist_query
+
+
+def get_search_cache_key(entity_type: str, search_query: str, artist_query: str, page: int, page_size: int):
+    query_hash = hashlib.md5(f'{search_query}\n{artist_query}'.encode('utf-8')).hexdigest()
+
+    return f'search-{entity_type}-{page}-{page_size}-{query_hash}'
+
+
+def get_cached_search_data(entity_type: str, search_query: str, artist_query: str, page: int, page_size: int, cache: Cache):
+    data = None
+
+    try:
+        data = cache.get(get_search_cache_key(entity_type, search_query, artist_query, page, page_size))
+    except RuntimeError as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching cached search results: {error}')
+
+    record_cache_access('search', data is not None)
+
+    return data
+
+
+def set_cached_search_data(entity_type: str, search_query: str, artist_query: str, page: int, page_size: int, data: dict, cache: Cache):
+    try:
+        cache.set(get_search_cache_key(entity_type, search_query, artist_query, page, page_size), data, timeout=app_config.SEARCH_CACHE_TIMEOUT)
+    except RuntimeError as error:
+        # TODO: Log this somewhere
+        print(f'Error storing search results in the cache: {error}')
+
+
+def get_cached_release_data(release_group_id: str, cache: Cache):
+    release_data = None
+
+    if 'release_data' in app_config.RESPONSE_CACHE_TIMEOUTS:
+        try:
+            release_data = cache.get(get_release_data_cache_key(release_group_id))
+        except RuntimeError as error:
+            # TODO: Log this somewhere
+            print(f'Error fetching cached release data: {error}')
+
+    record_cache_access('release_data', release_data is not None)
+
+    return release_data
+
+
+def set_cached_release_data(release_group_id: str, release_data: dict, cache: Cache):
+    if 'release_data' in app_config.RESPONSE_CACHE_TIMEOUTS:
+        try:
+            cache.set(get_release_data_cache_key(release_group_id), release_data, timeout=int(app_config.RESPONSE_CACHE_TIMEOUTS['release_data']))
+        except RuntimeError as error:
+            # TODO: Log this somewhere
+            print(f'Error storing release data in the cache: {error}')
+
+
+def get_release_data_cache_key(release_group_id: str):
+    """The version covers the includes of both the release group and the release, since the chosen release depends on the two of them"""
+    version = hashlib.md5(json.dumps([INCLUDES['album'], INCLUDES['release']]).encode('utf-8')).hexdigest()[:8]
+
+    return f'mb-release_data-{version}-{release_group_id}'
 
 
 def get_cached_images(entity_id: str, entity_type: EntityType, cache: Cache):
     images = None
 
     try:
-        cache_key = f'{entity_type.value}-images'
-        cache_collection = cache.get(cache_key)
-
-        if cache_collection:
-            images = cache_collection[entity_id]
-    except (RuntimeError, KeyError) as error:
+        images = cache.get(get_images_cache_key(entity_id, entity_type))
+    except RuntimeError as error:
         # TODO: Log this somewhere
         print(f'Error fetching cached images: {error}')
 
+    record_cache_access('images', images is not None)
+
     return images
 
 
 def set_cached_images(entity_id: str, entity_type: EntityType, images: list, cache: Cache):
+    # Each entity has its own entry, and the cache backend replaces the entry as a whole, so concurrent writers for different entities never
+    # clobber each other
     try:
-        cache_key = f'{entity_type.value}-images'
-        cache_collection = cache.get(cache_key)
-
-        if cache_collection is None:
-            cache_collection = {}
-
-        cache_collection[entity_id] = images
-        cache.set(cache_key, cache_collection)
-    except (RuntimeError, KeyError) as error:
+        cache.set(get_images_cache_key(entity_id, entity_type), images)
+    except RuntimeError as error:
         # TODO: Log this somewhere
         print(f'Error storing images in the cache: {error}')
 
 
+def get_images_cache_key(entity_id: str, entity_type: EntityType):
+    return f'{entity_type.value}-images-{entity_id}'
+
+
+def migrate_cached_images(cache: Cache):
+    """
+        Earlier versions of the service stored the images for every artist or album in one collection per entity type. This splits any such
+        collection into per-entity entries and then removes it. Entries that already exist were written after the upgrade, so they are left alone.
+    """
+    for entity_type in [EntityType.ARTIST, EntityType.ALBUM]:
+        legacy_cache_key = f'{entity_type.value}-images'
+
+        try:
+            cache_collection = cache.get(legacy_cache_key)
+
+            if cache_collection:
+                for entity_id, images in cache_collection.items():
+                    cache.add(get_images_cache_key(entity_id, entity_type), images)
+
+                print(f'Migrated {len(cache_collection)} cached {entity_type.value} image entries')
+
+            cache.delete(legacy_cache_key)
+        except (RuntimeError, AttributeError) as error:
+            # TODO: Log this somewhere
+            print(f'Error migrating cached images: {error}')
+
+
+@timed_stage('build')
 def build_search_results(entity_type: EntityType, rows_key: str, count_key: str, data):
     rows = []
 
@@ -287,7 +779,8 @@ def build_search_results(entity_type: EntityType, rows_key: str, count_key: str,
     return results
 
 
-def build_artist(data):
+@timed_stage('build')
+def build_artist(data, description: str):
     record = data[0]['artist']
     albums_record = data[1]
 
@@ -335,7 +828,6 @@ def build_artist(data):
                 album.albumType = 'Album'
                 album.id = rel_group['id']
                 album.name = rel_group['title']
-                album.tracks = []
 
                 if 'first-release-date' in rel_group:
                     album.releaseDate = rel_group['first-release-date']
@@ -383,13 +875,13 @@ def build_artist(data):
 
     artist.members = members
 
-    links = build_link_list(record)
-    artist.links = links.items
-    artist.description = links.entity_description
+    artist.links = build_link_list(record)
+    artist.description = description
 
     return artist
 
 
+@timed_stage('build')
 def build_discography_list(data, entity_type, album_only=False):
     record = data[0]
     album_images = data[1]
@@ -452,7 +944,8 @@ def build_discography_list(data, entity_type, album_only=False):
     return result
 
 
-def build_album(data):
+@timed_stage('build')
+def build_album(data, description: str):
     record = data[0]['release-group']
     album_images = data[1]
 
@@ -487,9 +980,8 @@ def build_album(data):
 
     album.images = images
 
-    links = build_link_list(record)
-    album.links = links.items
-    album.description = links.entity_description
+    album.links = build_link_list(record)
+    album.description = description
 
     return album
 
@@ -497,7 +989,6 @@ def build_album(data):
 def build_release_tracks(data: dict):
     result = TrackList()
     result.tracks = []
-    result.total_duration = ''
 
     if 'track-list' in data:
         total_duration = 0
@@ -549,6 +1040,7 @@ def build_release_tracks(data: dict):
     return result
 
 
+@timed_stage('build')
 def build_song(data):
     record = data[0]['recording']
     albums_record = data[1]
@@ -632,8 +1124,7 @@ def build_song(data):
         albums = sorted(albums, key=lambda x: x.releaseDate)
 
     song.appearsOn = albums
-    links = build_link_list(record)
-    song.links = links.items
+    song.links = build_link_list(record)
 
     return song
 
@@ -657,52 +1148,58 @@ def build_tag_list(data: list):
     return items
 
 
+def get_wikidata_url(data: dict):
+    if 'url-relation-list' in data:
+        for link in data['url-relation-list']:
+            if link['type'] == 'wikidata':
+                return link['target']
+
+    return None
+
+
 def build_link_list(data: dict):
-    links = Links()
+    links = []
 
     if 'url-relation-list' in data:
         fan_page_found = False
 
         for link in data['url-relation-list']:
-            if link['type'] == 'wikidata':
-                links.entity_description = get_entity_description(link['target'])
-            else:
-                link_entry = Link()
-
-                if link['type'] == 'allmusic':
-                    link_entry.label = 'All Music'
-                    link_entry.ordinal = 1
-                elif link['type'] == 'discogs':
-                    link_entry.label = 'Discogs'
-                    link_entry.ordinal = 2
-                elif link['type'] == 'songkick':
-                    link_entry.label = 'Songkick'
-                    link_entry.ordinal = 4
-                elif link['type'] == 'setlistfm':
-                    link_entry.label = 'Setlist.fm'
-                    link_entry.ordinal = 5
-                elif link['type'] == 'fanpage':
-                    if not fan_page_found:
-                        link_entry.label = 'Fan page'
-                        link_entry.ordinal = 6
-                        fan_page_found = True
-                    else:
-                        continue
-                elif link['type'] == 'other databases':
-                    if 'rateyourmusic.com' in link['target']:
-                        link_entry.label = 'Rate Your Music'
-                        link_entry.ordinal = 3
-                    else:
-                        continue
+            link_entry = Link()
+
+            if link['type'] == 'allmusic':
+                link_entry.label = 'All Music'
+                link_entry.ordinal = 1
+            elif link['type'] == 'discogs':
+                link_entry.label = 'Discogs'
+                link_entry.ordinal = 2
+            elif link['type'] == 'songkick':
+                link_entry.label = 'Songkick'
+                link_entry.ordinal = 4
+            elif link['type'] == 'setlistfm':
+                link_entry.label = 'Setlist.fm'
+                link_entry.ordinal = 5
+            elif link['type'] == 'fanpage':
+                if not fan_page_found:
+                    link_entry.label = 'Fan page'
+                    link_entry.ordinal = 6
+                    fan_page_found = True
                 else:
                     continue
+            elif link['type'] == 'other databases':
+                if 'rateyourmusic.com' in link['target']:
+                    link_entry.label = 'Rate Your Music'
+                    link_entry.ordinal = 3
+                else:
+                    continue
+            else:
+                continue
 
-                if 'source-credit' in link:
-                    link_entry.label += f' ({link['source-credit']})'
+            if 'source-credit' in link:
+                link_entry.label += f' ({link['source-credit']})'
 
-                link_entry.target = link['target']
-                links.items.append(link_entry)
+            link_entry.target = link['target']
+            links.append(link_entry)
 
-        links.items = sorted(links.items, key=lambda x: x.ordinal)
+        links = sorted(links, key=lambda x: x.ordinal)
 
     return links
@@ -0,0 +1,89 @@
+import time
+from flask_caching import Cache
+import musicbrainzngs
+
+from src import Config
+from src.enums.enums import Upstream, RequestPriority
+from src.models.models import DataRequest, Artist
+from src.services.coalesce_service import SingleFlight
+from src.services.executor_service import get_executor, get_background_executor
+from src.services.metrics_service import increment_counter, observe_duration
+from src.services.rate_limit_service import music_brainz_rate_limiter
+from src.services.music_brainz_service import get_album_data, get_release_data, get_cached_response, fetch_response, get_wikidata_url
+from src.services.wikipedia_service import get_entity_description
+
+app_config = Config()
+album_prefetches = SingleFlight('album_prefetch')
+
+
+def submit_album_prefetch(artist: Artist, cache: Cache):
+    """
+        Warms the caches used by an album lookup for the first PREFETCH_ALBUM_COUNT albums of an artist that was just looked up, since those are
+        the pages most likely to be visited next. This runs in the background, one album at a time, and its MusicBrainz calls have background
+        priority, so they only use slots in the rate limit that interactive requests have left over.
+    """
+    if app_config.PREFETCH_ALBUM_COUNT <= 0 or not getattr(artist, 'albums', None):
+        return
+
+    album_ids = list(map(lambda x: x.id, artist.albums[:app_config.PREFETCH_ALBUM_COUNT]))
+    album_prefetches.submit(artist.id, lambda: get_background_executor().submit(prefetch_albums, album_ids, cache))
+
+
+def prefetch_albums(album_ids: list, cache: Cache):
+    begin_time = time.monotonic()
+
+    for album_id in album_ids:
+        try:
+            if not prefetch_album(album_id, cache):
+                increment_counter('album_prefetches', {'result': 'cancelled'})
+                break
+
+            increment_counter('album_prefetches', {'result': 'done'})
+        except (musicbrainzngs.MusicBrainzError, RuntimeError) as error:
+            # TODO: Log this somewhere
+            print(f'Error prefetching album {album_id}: {error}')
+            increment_counter('album_prefetches', {'result': 'error'})
+
+    observe_duration('album_prefetch_duration_seconds', {}, begin_time)
+
+
+def prefetch_album(album_id: str, cache: Cache):
+    """
+        Fetches what an album lookup needs from MusicBrainz and Wikipedia, and leaves it in the cache. The album images are not fetched, since the
+        artist lookup has already cached those for all of the artist's albums. Returns False if the prefetch was given up because the service is
+        under load.
+    """
+    if is_under_load():
+        return False
+
+    album_request = DataRequest()
+    album_request.data_type = 'album'
+    album_request.entity_id = album_id
+    album_request.priority = RequestPriority.BACKGROUND
+
+    album_data = get_cached_response(album_request, cache)
+
+    if album_data is None:
+        album_data = fetch_response(get_album_data, album_request, cache)
+
+    if is_under_load():
+        return False
+
+    release_group = album_data['release-group']
+    get_release_data(release_group, cache, RequestPriority.BACKGROUND)
+
+    wikidata_url = get_wikidata_url(release_group)
+
+    if wikidata_url:
+        get_entity_description(wikidata_url, cache)
+
+    return True
+
+
+def is_under_load():
+    """
+        The service counts as under load while there are MusicBrainz calls waiting for a worker, or while the rate limit is booked up by other
+        requests (which covers the workers in other processes, and calls made by the async provider).
+    """
+    return (get_executor(Upstream.MUSIC_BRAINZ).stats()['queued'] > 0 or
+            music_brainz_rate_limiter.backlog() > music_brainz_rate_limiter.interval)
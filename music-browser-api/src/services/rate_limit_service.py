@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from src import Config
+from src.enums.enums import RequestPriority
+from src.services.metrics_service import increment_counter
+from src.services.timing_service import add_stage_time, UPSTREAM_STAGES
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, in which case the limit is only enforced within each process
+    fcntl = None
+
+app_config = Config()
+
+
+class RateLimiter:
+    """
+        Spaces out calls to an upstream across every worker process on the host. The time of the next free slot is kept in a shared file, and each
+        caller reserves a slot (under an exclusive lock on that file) before sleeping until it comes up. Within a process, callers take turns to
+        reserve in priority order, so interactive requests go ahead of background ones that are waiting. Background callers also back off while
+        the shared schedule is already booked up, which leaves those slots to interactive requests from other workers.
+    """
+
+    def __init__(self, name: str, interval: float, state_file: str):
+        self.name = name
+        self.interval = interval
+        self.state_file = state_file
+        self.local_next_slot = 0.0
+        self.local_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.busy = False
+
+
+    def wait(self, priority: RequestPriority = RequestPriority.INTERACTIVE):
+        begin_time = time.monotonic()
+
+        while True:
+            ticket = (priority.value, next(self.sequence))
+
+            with self.condition:
+                heapq.heappush(self.waiters, ticket)
+
+                while self.busy or self.waiters[0] != ticket:
+                    self.condition.wait()
+
+                heapq.heappop(self.waiters)
+                self.busy = True
+
+            try:
+                max_backlog = self.interval if priority == RequestPriority.BACKGROUND else None
+                slot = self.reserve_slot(max_backlog)
+
+                if slot is not None:
+                    delay = slot - time.time()
+
+                    if delay > 0:
+                        time.sleep(delay)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+            if slot is not None:
+                break
+
+            time.sleep(self.interval)
+
+        return self.record_wait(priority, begin_time)
+
+
+    async def wait_async(self, priority: RequestPriority = RequestPriority.INTERACTIVE):
+        """
+            The same as wait, for callers on an event loop. These don't take part in the in-process queue (which would block the loop), so they
+            only get the ordering provided by the shared schedule. Slots are reserved from a worker thread, since the lock on the shared file may
+            have to wait for other worker processes.
+        """
+        begin_time = time.monotonic()
+        max_backlog = self.interval if priority == RequestPriority.BACKGROUND else None
+
+        while True:
+            slot = await asyncio.to_thread(self.reserve_slot, max_backlog)
+
+            if slot is not None:
+                break
+
+            await asyncio.sleep(self.interval)
+
+        delay = slot - time.time()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        return self.record_wait(priority, begin_time)
+
+
+    def record_wait(self, priority: RequestPriority, begin_time: float):
+        wait_time = time.monotonic() - begin_time
+        labels = {'limiter': self.name, 'priority': priority.name.lower()}
+        increment_counter('rate_limit_waits', labels)
+        increment_counter('rate_limit_wait_seconds', labels, wait_time)
+        add_stage_time(f'{UPSTREAM_STAGES.get(self.name, self.name)}-wait', wait_time)
+
+        return wait_time
+
+
+    def backlog(self):
+        """Returns how far ahead of now the shared schedule is booked, in seconds. This is read without the lock, so it is only an estimate."""
+        if fcntl is None:
+            next_slot = self.local_next_slot
+        else:
+            try:
+                with open(self.state_file, encoding='ascii') as file:
+                    content = file.read().strip()
+
+                next_slot = float(content) if content else 0.0
+            except (OSError, ValueError):
+                next_slot = 0.0
+
+        return max(next_slot - time.time(), 0.0)
+
+
+    def reserve_slot(self, max_backlog: float = None):
+        """
+            Returns the time the caller may make its request, or None if the schedule is booked further ahead than the given backlog.
+        """
+        if fcntl is None:
+            with self.local_lock:
+                slot, self.local_next_slot = self.book_slot(self.local_next_slot, max_backlog)
+
+            return slot
+
+        fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            content = os.pread(fd, 64, 0).decode('ascii').strip()
+
+            try:
+                next_slot = float(content) if content else 0.0
+            except ValueError:
+                next_slot = 0.0
+
+            slot, next_slot = self.book_slot(next_slot, max_backlog)
+
+            if slot is not None:
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, f'{next_slot:.6f}'.encode('ascii'), 0)
+
+            return slot
+        finally:
+            os.close(fd)
+
+
+    def book_slot(self, next_slot: float, max_backlog: float = None):
+        now = time.time()
+        slot = max(now, next_slot)
+
+        if max_backlog is not None and slot - now > max_backlog:
+            return None, next_slot
+
+        return slot, slot + self.interval
+
+
+music_brainz_rate_limiter = RateLimiter('musicbrainz', app_config.MUSIC_BRAINZ_RATE_LIMIT_INTERVAL, app_config.MUSIC_BRAINZ_RATE_LIMIT_FILE)
@@ -0,0 +1,266 @@
+import json
+import re
+import sqlite3
+import threading
+
+from src import Config
+from src.enums.enums import EntityType
+from src.services.executor_service import get_background_executor
+from src.services.music_brainz_service import MAX_SEARCH_RESULTS
+from src.services.rate_limit_service import music_brainz_rate_limiter
+
+app_config = Config()
+connections = threading.local()
+
+
+def get_index_schema(name: str, columns: list):
+    """
+        Each index is an FTS5 table over a regular table of entries, which holds the search result for each entity in the same shape the search
+        server returns it. Triggers keep the FTS table in step with the entries, so an entry can simply be inserted or updated by its ID.
+    """
+    column_list = ', '.join(columns)
+    new_values = ', '.join(map(lambda x: f'new.{x}', columns))
+    old_values = ', '.join(map(lambda x: f'old.{x}', columns))
+
+    return f'''
+        CREATE TABLE IF NOT EXISTS {name}_entry (
+            entry_id INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            {' TEXT NOT NULL, '.join(columns)} TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS {name}_search USING fts5({column_list}, content='{name}_entry', content_rowid='entry_id',
+                                                                   tokenize='unicode61 remove_diacritics 2');
+        CREATE TRIGGER IF NOT EXISTS {name}_entry_insert AFTER INSERT ON {name}_entry BEGIN
+            INSERT INTO {name}_search (rowid, {column_list}) VALUES (new.entry_id, {new_values});
+        END;
+        CREATE TRIGGER IF NOT EXISTS {name}_entry_delete AFTER DELETE ON {name}_entry BEGIN
+            INSERT INTO {name}_search ({name}_search, rowid, {column_list}) VALUES ('delete', old.entry_id, {old_values});
+        END;
+        CREATE TRIGGER IF NOT EXISTS {name}_entry_update AFTER UPDATE ON {name}_entry BEGIN
+            INSERT INTO {name}_search ({name}_search, rowid, {column_list}) VALUES ('delete', old.entry_id, {old_values});
+            INSERT INTO {name}_search (rowid, {column_list}) VALUES (new.entry_id, {new_values});
+        END;
+    '''
+
+
+SCHEMA = get_index_schema('artist', ['name', 'aliases']) + get_index_schema('album', ['title', 'artist_name']) + \
+         get_index_schema('song', ['title', 'artist_name'])
+
+# For each type of entity, the columns the search text is matched against and their weights when ranking, along with the keys the search server
+# uses for its results. Matches on an artist's name count for more than those on one of their aliases.
+INDEXES = {
+    EntityType.ARTIST: {'name': 'artist', 'columns': ['name', 'aliases'], 'weights': '10.0, 2.0', 'rows_key': 'artist-list',
+                        'count_key': 'artist-count'},
+    EntityType.ALBUM: {'name': 'album', 'columns': ['title'], 'weights': '10.0, 1.0', 'rows_key': 'release-group-list',
+                       'count_key': 'release-group-count'},
+    EntityType.SONG: {'name': 'song', 'columns': ['title'], 'weights': '10.0, 1.0', 'rows_key': 'recording-list', 'count_key': 'recording-count'}
+}
+
+
+def get_search_index():
+    """Each thread gets its own connection to the search index, which it keeps for as long as it runs"""
+    connection = getattr(connections, 'connection', None)
+
+    if connection is None:
+        connection = sqlite3.connect(app_config.SEARCH_INDEX_PATH, timeout=10, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        create_search_index(connection)
+        connections.connection = connection
+
+    return connection
+
+
+def create_search_index(connection: sqlite3.Connection):
+    connection.executescript(SCHEMA)
+
+
+def search_index(connection: sqlite3.Connection, entity_type: EntityType, search_query: str, artist_query: str, limit: int, offset: int):
+    """
+        Returns the matches for a search in the same shape as the search server's results, so they can go through build_search_results. The last
+        word of the search text is matched as a prefix, since searches are often made while the text is still being typed. Each result gets a
+        score out of 100 like the search server's, relative to the best match for the search, with exact matches on the name always scoring 100.
+    """
+    index = INDEXES[entity_type]
+    table = f'{index['name']}_search'
+    match_query = get_match_query(index['columns'], search_query)
+
+    if artist_query:
+        artist_match_query = get_match_query(['artist_name'], artist_query)
+        match_query = f'{match_query} AND {artist_match_query}' if match_query and artist_match_query else match_query or artist_match_query
+
+    if not match_query:
+        return {index['rows_key']: [], index['count_key']: 0}
+
+    name_column = index['columns'][0]
+    rank = f'bm25({table}, {index['weights']})'
+
+    count = connection.execute(f'SELECT COUNT(*) FROM {table} WHERE {table} MATCH ?', (match_query,)).fetchone()[0]
+
+    if count == 0:
+        return {index['rows_key']: [], index['count_key']: 0}
+
+    best_rank = connection.execute(f'SELECT {rank} FROM {table} WHERE {table} MATCH ? ORDER BY 1 LIMIT 1', (match_query,)).fetchone()[0]
+    rows = connection.execute(f'SELECT e.data, e.{name_column} = ? COLLATE NOCASE, {rank} FROM {table} s JOIN {index['name']}_entry e '
+                              f'ON e.entry_id = s.rowid WHERE {table} MATCH ? ORDER BY 2 DESC, 3 LIMIT ? OFFSET ?',
+                              (search_query, match_query, max(min(limit, MAX_SEARCH_RESULTS - offset), 0), offset)).fetchall()
+    results = []
+
+    for data, exact_match, row_rank in rows:
+        result = json.loads(data)
+        result['ext:score'] = '100' if exact_match else str(max(round(100 * row_rank / best_rank), 1) if best_rank else 100)
+        results.append(result)
+
+    return {index['rows_key']: results, index['count_key']: count}
+
+
+def get_match_query(columns: list, text: str):
+    terms = re.findall(r'[^\W_]+', text)
+
+    if not terms:
+        return None
+
+    terms = list(map(lambda x: f'"{x}"', terms))
+    terms[-1] += '*'
+
+    return f'{{{' '.join(columns)}}} : ({' '.join(terms)})'
+
+
+def add_artists(connection: sqlite3.Connection, records: list):
+    connection.executemany('INSERT INTO artist_entry (id, name, aliases, data) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (id) DO UPDATE SET name = excluded.name, aliases = excluded.aliases, data = excluded.data',
+                           map(lambda x: (x['id'], x['name'], ' '.join(map(lambda y: y['alias'], x.get('alias-list', []))), json.dumps(x)), records))
+
+
+def add_albums(connection: sqlite3.Connection, records: list):
+    connection.executemany('INSERT INTO album_entry (id, title, artist_name, data) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (id) DO UPDATE SET title = excluded.title, artist_name = excluded.artist_name, data = excluded.data',
+                           map(lambda x: (x['id'], x['title'], x.get('artist-credit-phrase', ''), json.dumps(x)), records))
+
+
+def add_songs(connection: sqlite3.Connection, records: list):
+    connection.executemany('INSERT INTO song_entry (id, title, artist_name, data) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (id) DO UPDATE SET title = excluded.title, artist_name = excluded.artist_name, data = excluded.data',
+                           map(lambda x: (x['id'], x['title'], x.get('artist-credit-phrase', ''), json.dumps(x)), records))
+
+
+def get_artist_entry(record: dict):
+    """The entry functions keep the parts of a looked up entity that the search server includes in its results, and that we use from them"""
+    return {key: record[key] for key in ['id', 'name', 'sort-name', 'type', 'disambiguation', 'tag-list', 'alias-list'] if key in record}
+
+
+def get_album_entry(record: dict, artist_credit: list = None, artist_credit_phrase: str = None):
+    entry = {key: record[key] for key in ['id', 'title', 'type', 'primary-type', 'first-release-date', 'tag-list', 'artist-credit',
+                                          'artist-credit-phrase'] if key in record}
+
+    if artist_credit is not None:
+        entry['artist-credit'] = artist_credit
+        entry['artist-credit-phrase'] = artist_credit_phrase
+
+    entry.setdefault('artist-credit-phrase', '')
+
+    return entry
+
+
+def is_album(record: dict):
+    """Album searches only return release groups of the album type, so those are the only ones worth indexing"""
+    return str(record.get('type', '')).lower() == 'album'
+
+
+def index_artist_lookup(artist: dict, albums: dict):
+    connection = get_search_index()
+    artist_credit = [{'artist': {'id': artist['id'], 'name': artist['name']}}]
+
+    add_artists(connection, [get_artist_entry(artist)])
+    add_albums(connection, list(map(lambda x: get_album_entry(x, artist_credit, artist['name']),
+                                    filter(is_album, albums.get('release-group-list', [])))))
+    connection.commit()
+
+
+def index_album_lookup(release_group: dict, track_lists: list):
+    """Besides the album itself, the songs on the release picked for it are indexed, each with the album they are on"""
+    connection = get_search_index()
+    album_artist_credit = release_group.get('artist-credit', [])
+    songs = []
+
+    for track_list in track_lists:
+        for track in track_list.tracks:
+            song = {'id': track.id, 'title': track.name, 'release-list': [{'release-group': {'id': release_group['id'],
+                                                                                            'title': release_group['title']}}]}
+
+            if getattr(track, 'artistId', None):
+                song['artist-credit'] = [{'artist': {'id': track.artistId, 'name': track.artist}}]
+                song['artist-credit-phrase'] = track.artist
+            else:
+                song['artist-credit'] = album_artist_credit
+                song['artist-credit-phrase'] = release_group.get('artist-credit-phrase', '')
+
+            songs.append(song)
+
+    if is_album(release_group):
+        add_albums(connection, [get_album_entry(release_group)])
+
+    add_songs(connection, songs)
+    connection.commit()
+
+
+def index_song_lookup(recording: dict, releases: dict):
+    connection = get_search_index()
+    song = {key: recording[key] for key in ['id', 'title', 'length', 'disambiguation', 'tag-list', 'artist-credit'] if key in recording}
+    song['artist-credit-phrase'] = recording.get('artist-credit-phrase', '')
+
+    album_releases = [x for x in releases.get('release-list', []) if 'release-group' in x and is_album(x['release-group'])]
+
+    if album_releases:
+        song['release-list'] = [{'release-group': {'id': album_releases[0]['release-group']['id'],
+                                                   'title': album_releases[0]['release-group']['title']}}]
+
+    add_songs(connection, [song])
+    connection.commit()
+
+
+def submit_index_update(index_function, *args):
+    """
+        Adds the entities from a lookup to the search index, if it is turned on. This is done in the background, so the lookup doesn't wait on it.
+    """
+    if app_config.SEARCH_INDEX:
+        get_background_executor().submit(update_search_index, index_function, *args)
+
+
+def update_search_index(index_function, *args):
+    try:
+        index_function(*args)
+    except (sqlite3.Error, KeyError) as error:
+        # TODO: Log this somewhere
+        print(f'Error updating the search index: {error}')
+
+
+def search_index_preferred():
+    """
+        Searches go to the search index rather than the search server while the MusicBrainz rate limiter is booked up further ahead than
+        SEARCH_INDEX_MAX_BACKLOG, since the index gives a quick answer where the server would keep the user waiting.
+    """
+    return app_config.SEARCH_INDEX and music_brainz_rate_limiter.backlog() > app_config.SEARCH_INDEX_MAX_BACKLOG
+
+
+def get_indexed_search_data(entity_type: str, search_query: str, artist_query: str, limit: int, offset: int):
+    """
+        Returns the matches from the search index, or None if it is turned off or has no matches. The index only holds the entities that have been
+        looked up, so its results stand in for the search server's when that can't be used, rather than being complete.
+    """
+    if not app_config.SEARCH_INDEX:
+        return None
+
+    data = None
+    entity_type = EntityType(entity_type)
+
+    try:
+        data = search_index(get_search_index(), entity_type, search_query, artist_query, limit, offset)
+    except sqlite3.Error as error:
+        # TODO: Log this somewhere
+        print(f'Error searching the search index: {error}')
+
+    if data is None or data[INDEXES[entity_type]['count_key']] == 0:
+        return None
+
+    return data
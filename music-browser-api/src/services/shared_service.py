@@ -2,7 +2,9 @@ from flask.config import Config
 
 from src.enums.enums import EntityType, DataProvider
 from src.providers.music_brainz_provider import MusicBrainzProvider
+from src.providers.async_music_brainz_provider import AsyncMusicBrainzProvider
 from src.providers.spotify_provider import SpotifyProvider
+from src.providers.local_database_provider import LocalDatabaseProvider
 
 
 def supported_entity_type(entity_type: str):
@@ -10,7 +12,7 @@ def supported_entity_type(entity_type: str):
 
 
 def supported_data_provider(provider_name: str):
-    return provider_name in [DataProvider.MUSIC_BRAINZ.value, DataProvider.SPOTIFY.value]
+    return provider_name in [DataProvider.MUSIC_BRAINZ.value, DataProvider.SPOTIFY.value, DataProvider.LOCAL_DATABASE.value]
 
 
 def get_data_provider(config: Config):
@@ -18,8 +20,14 @@ def get_data_provider(config: Config):
     data_provider = None
 
     if provider_name == DataProvider.MUSIC_BRAINZ.value:
-        data_provider = MusicBrainzProvider()
+        data_provider = AsyncMusicBrainzProvider() if uses_async_provider(config) else MusicBrainzProvider()
     elif provider_name == DataProvider.SPOTIFY.value:
         data_provider = SpotifyProvider(config['SPOTIFY_CLIENT_ID'], config['SPOTIFY_CLIENT_SECRET'])
+    elif provider_name == DataProvider.LOCAL_DATABASE.value:
+        data_provider = LocalDatabaseProvider()
 
     return data_provider
+
+
+def uses_async_provider(config: Config):
+    return config['DATA_PROVIDER'] == DataProvider.MUSIC_BRAINZ.value and config['ASYNC_PROVIDER']
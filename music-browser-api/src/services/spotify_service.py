@@ -1,4 +1,4 @@
-from src.schema.schema import SearchResult
+from src.models.models import SearchResult
 
 
 def build_artist_search_results(data):
@@ -13,9 +13,6 @@ def build_artist_search_results(data):
             if 'genres' in rec:
                 result.tags = rec['genres']
 
-            if 'images' in rec:
-                result.images = rec['images']
-
             results.append(result)
 
     return {
@@ -36,9 +33,6 @@ def build_album_search_results(data):
             if 'artists' in rec and len(rec['artists']) > 0:
                 result.artist = rec['artists'][0]['name']
 
-            if 'images' in rec:
-                result.images = rec['images']
-
             results.append(result)
 
     return {
@@ -0,0 +1,111 @@
+import contextvars
+import functools
+import inspect
+import random
+import threading
+import time
+
+from src import Config
+
+app_config = Config()
+
+# The timings of the request being handled, or None if it isn't being timed. Work submitted to one of our executors runs in a copy of the
+# submitting request's context, and asyncio tasks get one of their own, so stages timed on other threads still end up in the request's timings.
+request_timings = contextvars.ContextVar('request_timings', default=None)
+timings_lock = threading.Lock()
+
+# The names the upstreams are given in the Server-Timing header
+UPSTREAM_STAGES = {'musicbrainz': 'mb', 'fanart': 'fanart', 'wikipedia': 'wiki'}
+
+
+def start_request_timing():
+    """Timings are only kept when SERVER_TIMING is on, and then only for the share of requests given by SERVER_TIMING_SAMPLE_RATE"""
+    timed = app_config.SERVER_TIMING and random.random() < app_config.SERVER_TIMING_SAMPLE_RATE
+    request_timings.set({'begin_time': time.monotonic(), 'stages': {}, 'caches': {}} if timed else None)
+
+
+def add_stage_time(stage: str, duration: float):
+    timings = request_timings.get()
+
+    if timings is None:
+        return
+
+    with timings_lock:
+        total, count = timings['stages'].get(stage, (0.0, 0))
+        timings['stages'][stage] = (total + duration, count + 1)
+
+
+def add_cache_access(cache_name: str, hit: bool):
+    timings = request_timings.get()
+
+    if timings is None:
+        return
+
+    with timings_lock:
+        hits, reads = timings['caches'].get(cache_name, (0, 0))
+        timings['caches'][cache_name] = (hits + int(hit), reads + 1)
+
+
+def timed_stage(stage: str):
+    """Adds the time spent in the decorated function to the given stage. A coroutine function is timed until it finishes, not until it returns."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                begin_time = time.monotonic()
+
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    add_stage_time(stage, time.monotonic() - begin_time)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            begin_time = time.monotonic()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_stage_time(stage, time.monotonic() - begin_time)
+
+        return wrapper
+
+    return decorator
+
+
+def finish_request_timing():
+    """
+        Returns the value of the Server-Timing header for the request, or None if it isn't being timed. A stage that ran more than once, such as
+        MusicBrainz calls made side by side, is given its total time along with the number of times it ran, so its duration can be longer than the
+        request's. Each cache that was read is listed without a duration, marked with whether the reads were hits.
+    """
+    timings = request_timings.get()
+    request_timings.set(None)
+
+    if timings is None:
+        return None
+
+    with timings_lock:
+        stages = dict(timings['stages'])
+        caches = dict(timings['caches'])
+
+    entries = []
+
+    for stage, (duration, count) in stages.items():
+        entries.append(f'{stage};dur={duration * 1000:.1f}' + (f';desc="{count} calls"' if count > 1 else ''))
+
+    for cache_name, (hits, reads) in sorted(caches.items()):
+        entries.append(f'{cache_name}-cache;desc="{get_cache_description(hits, reads)}"')
+
+    entries.append(f'total;dur={(time.monotonic() - timings['begin_time']) * 1000:.1f}')
+
+    return ', '.join(entries)
+
+
+def get_cache_description(hits: int, reads: int):
+    if hits == reads:
+        return 'hit'
+
+    return 'miss' if hits == 0 else f'{hits} of {reads} hit'
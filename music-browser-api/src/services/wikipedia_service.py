@@ -1,76 +1,205 @@
+import asyncio
 import urllib.parse
-import datetime
+from flask_caching import Cache
+import httpx
 import requests
 
+from src import Config
+from src.enums.enums import Upstream
+from src.services.http_service import http_get, async_http_get
+from src.services.metrics_service import track_upstream_call, record_cache_access
+
+app_config = Config()
 user_agent = 'Music_Browser_API/1.0'
 
-def get_entity_description(wikidata_url: str):
+def get_entity_description(wikidata_url: str, cache: Cache, refresh: bool = False):
+    """
+        Descriptions are cached by Wikidata ID. Entities that have no English Wikipedia page, or whose page has an empty intro, are cached as
+        well (for a shorter time) so we don't keep asking for something that isn't there. Failed requests are not cached. A refresh skips the
+        cached description, and replaces it with the one it fetches.
+    """
+    wikidata_id = get_wikidata_id(wikidata_url)
+    cached_description = get_cached_description(wikidata_id, cache) if not refresh else None
+
+    if cached_description is not None:
+        return cached_description['description']
+
     page_title = get_wikipedia_page_title(wikidata_url)
+
+    if page_title is None:
+        return ''
+
+    if page_title == '':
+        set_cached_description(wikidata_id, 'no-page', '', cache)
+        return ''
+
     desc = get_wikipedia_page_intro(page_title)
 
-    return desc
+    if desc is None:
+        return ''
 
+    set_cached_description(wikidata_id, 'found' if desc else 'empty', desc, cache)
 
-def get_wikipedia_page_title(wikidata_url: str):
-    page_title = ''
+    return desc
 
-    try:
-        wikidata_id = wikidata_url[wikidata_url.rindex('/') + 1:]
-        url = f'https://www.wikidata.org/w/api.php?action=wbgetentities&props=sitelinks&ids={wikidata_id}&sitefilter=enwiki&format=json'
 
-        headers = {
-            'user-agent': user_agent
-        }
+def get_wikidata_id(wikidata_url: str):
+    return wikidata_url[wikidata_url.rindex('/') + 1:]
 
-        begin_time = datetime.datetime.now()
-        response = requests.get(url=url, timeout=30, headers=headers)
 
-        print(f'__Wikipedia page title: {datetime.datetime.now() - begin_time}')
+def get_wikipedia_page_title(wikidata_url: str):
+    """
+        Returns an empty string if the entity has no English Wikipedia page, or None if the request failed.
+    """
+    page_title = None
 
-        if response.status_code == 200:
-            content = response.json()
+    try:
+        wikidata_id = get_wikidata_id(wikidata_url)
+        with track_upstream_call(Upstream.WIKIPEDIA.value, 'page_title'):
+            response = http_get(url=get_page_title_url(wikidata_id), headers={'user-agent': user_agent})
 
-            if 'entities' in content:
-                if 'sitelinks' in content['entities'][wikidata_id] and 'enwiki' in content['entities'][wikidata_id]['sitelinks']:
-                    page_title = content['entities'][wikidata_id]['sitelinks']['enwiki']['title']
-        else:
-            print(f'Error fetching entity description: Status {response.status_code}')
-    except RuntimeError:
+        page_title = read_page_title(response, wikidata_id)
+    except (RuntimeError, requests.RequestException) as error:
         # TODO: Log this somewhere
-        print(f'Error fetching entity description: {RuntimeError}')
+        print(f'Error fetching entity description: {error}')
 
     return page_title
 
 
 def get_wikipedia_page_intro(page_title: str):
+    """
+        Returns an empty string if the page has no intro, or None if the request failed.
+    """
     intro = ''
 
     if page_title is not None and page_title != '':
+        intro = None
+
         try:
-            url = f'https://en.wikipedia.org/w/api.php?action=query&prop=extracts&exlimit=1&exintro=true&titles={urllib.parse.quote_plus(page_title)}&explaintext=1&format=json'
+            with track_upstream_call(Upstream.WIKIPEDIA.value, 'page_intro'):
+                response = http_get(url=get_page_intro_url(page_title), headers={'user-agent': user_agent})
 
-            headers = {
-                'user-agent': user_agent
-            }
+            intro = read_page_intro(response)
+        except (RuntimeError, requests.RequestException) as error:
+            # TODO: Log this somewhere
+            print(f'Error fetching Wikipedia content: {error}')
 
-            begin_time = datetime.datetime.now()
-            response = requests.get(url=url, timeout=30, headers=headers)
+    return intro
 
-            print(f'__Wikipedia page intro: {datetime.datetime.now() - begin_time}')
 
-            if response.status_code == 200:
-                content = response.json()
+async def get_entity_description_async(wikidata_url: str, cache: Cache, refresh: bool = False):
+    """The same as get_entity_description, with the requests made on the running event loop and the cache used from worker threads"""
+    wikidata_id = get_wikidata_id(wikidata_url)
+    cached_description = await asyncio.to_thread(get_cached_description, wikidata_id, cache) if not refresh else None
 
-                if 'query' in content and 'pages' in content['query']:
-                    keys = list(content['query']['pages'].keys())
+    if cached_description is not None:
+        return cached_description['description']
 
-                    if len(keys) > 0:
-                        entry = content['query']['pages'][keys[0]]
+    page_title = None
 
-                        if 'extract' in entry:
-                            intro = content['query']['pages'][keys[0]]['extract']
-        except RuntimeError:
-            # TODO: Log this somewhere
-            print(f'Error fetching Wikipedia content: {RuntimeError}')
+    try:
+        with track_upstream_call(Upstream.WIKIPEDIA.value, 'page_title'):
+            response = await async_http_get(url=get_page_title_url(wikidata_id), headers={'user-agent': user_agent})
+
+        page_title = read_page_title(response, wikidata_id)
+    except (RuntimeError, ValueError, httpx.HTTPError) as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching entity description: {error}')
+
+    if page_title is None:
+        return ''
+
+    if page_title == '':
+        await asyncio.to_thread(set_cached_description, wikidata_id, 'no-page', '', cache)
+        return ''
+
+    desc = None
+
+    try:
+        with track_upstream_call(Upstream.WIKIPEDIA.value, 'page_intro'):
+            response = await async_http_get(url=get_page_intro_url(page_title), headers={'user-agent': user_agent})
+
+        desc = read_page_intro(response)
+    except (RuntimeError, ValueError, httpx.HTTPError) as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching Wikipedia content: {error}')
+
+    if desc is None:
+        return ''
+
+    await asyncio.to_thread(set_cached_description, wikidata_id, 'found' if desc else 'empty', desc, cache)
+
+    return desc
+
+
+def get_page_title_url(wikidata_id: str):
+    return f'{app_config.WIKIDATA_URL}/w/api.php?action=wbgetentities&props=sitelinks&ids={wikidata_id}&sitefilter=enwiki&format=json'
+
+
+def read_page_title(response, wikidata_id: str):
+    page_title = None
+
+    if response.status_code == 200:
+        content = response.json()
+        page_title = ''
+
+        if 'entities' in content:
+            if 'sitelinks' in content['entities'][wikidata_id] and 'enwiki' in content['entities'][wikidata_id]['sitelinks']:
+                page_title = content['entities'][wikidata_id]['sitelinks']['enwiki']['title']
+    else:
+        print(f'Error fetching entity description: Status {response.status_code}')
+
+    return page_title
+
+
+def get_page_intro_url(page_title: str):
+    return f'{app_config.WIKIPEDIA_URL}/w/api.php?action=query&prop=extracts&exlimit=1&exintro=true&titles={urllib.parse.quote_plus(page_title)}&explaintext=1&format=json'
+
+
+def read_page_intro(response):
+    intro = None
+
+    if response.status_code == 200:
+        content = response.json()
+        intro = ''
+
+        if 'query' in content and 'pages' in content['query']:
+            keys = list(content['query']['pages'].keys())
+
+            if len(keys) > 0:
+                entry = content['query']['pages'][keys[0]]
+
+                if 'extract' in entry:
+                    intro = content['query']['pages'][keys[0]]['extract']
+    else:
+        print(f'Error fetching Wikipedia content: Status {response.status_code}')
 
     return intro
+
+
+def get_cached_description(wikidata_id: str, cache: Cache):
+    cached_description = None
+
+    try:
+        cached_description = cache.get(f'description-{wikidata_id}')
+    except RuntimeError as error:
+        # TODO: Log this somewhere
+        print(f'Error fetching cached description: {error}')
+
+    record_cache_access('description', cached_description is not None)
+
+    return cached_description
+
+
+def set_cached_description(wikidata_id: str, status: str, description: str, cache: Cache):
+    """
+        The status is one of 'found', 'no-page' or 'empty'. Only found descriptions get the full cache timeout, so that pages created or filled in
+        on Wikipedia later on are picked up reasonably soon.
+    """
+    timeout = app_config.DESCRIPTION_CACHE_TIMEOUT if status == 'found' else app_config.DESCRIPTION_NEGATIVE_CACHE_TIMEOUT
+
+    try:
+        cache.set(f'description-{wikidata_id}', {'status': status, 'description': description}, timeout=timeout)
+    except RuntimeError as error:
+        # TODO: Log this somewhere
+        print(f'Error storing description in the cache: {error}')
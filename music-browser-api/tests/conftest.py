@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from benchmarks.stub_upstreams import StubUpstream, start_stub_upstreams, stop_stub_upstreams
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# The stand-in upstreams and the scratch directory, shared by every test in the session
+stubs = {}
+work_dir = tempfile.mkdtemp(prefix='music-browser-tests-')
+
+
+def pytest_configure(config):
+    """
+        The service reads its settings when it is first imported, so the stand-ins for the upstreams are started, and the settings that point the
+        service at them put in place, before any test module is collected.
+    """
+    started_stubs, settings = start_stub_upstreams(FIXTURES_DIR)
+    stubs.update(started_stubs)
+
+    os.environ.update(settings)
+    os.environ['DATA_PROVIDER'] = 'music-brainz'
+    os.environ['ASYNC_PROVIDER'] = 'false'
+    os.environ['CACHE_TYPE'] = 'FileSystemCache'
+    os.environ['CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    os.environ['COALESCE_LOCK_DIR'] = os.path.join(work_dir, 'locks')
+    os.environ['MUSIC_BRAINZ_RATE_LIMIT_FILE'] = os.path.join(work_dir, 'mb-rate-limit')
+    os.environ['MUSIC_BRAINZ_RATE_LIMIT_INTERVAL'] = '0'
+
+
+def pytest_unconfigure(config):
+    stop_stub_upstreams(stubs)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    """The service's app, with an empty cache, so each test starts out calling the upstreams"""
+    from src import app, cache
+
+    cache.clear()
+
+    yield app
+
+    cache.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def upstreams():
+    """The stand-in upstreams, by name, e.g. for a test to change how long they take to answer"""
+    return stubs
+
+
+@pytest.fixture
+def upstream_requests(monkeypatch):
+    """The paths of the requests each stand-in upstream gets during the test, by upstream name"""
+    requests = {}
+
+    for name, stub in stubs.items():
+        requests[name] = []
+        monkeypatch.setattr(stub, 'get_response', record_requests(stub, requests[name]))
+
+    return requests
+
+
+def record_requests(stub: StubUpstream, paths: list):
+    def get_response(path: str, headers: dict):
+        paths.append(path)
+        return StubUpstream.get_response(stub, path, headers)
+
+    return get_response
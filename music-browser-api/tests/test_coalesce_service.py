@@ -0,0 +1,116 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+import pytest
+
+from src.services import coalesce_service
+from src.services.coalesce_service import SingleFlight, host_lock
+
+
+def test_calls_in_flight_share_a_future():
+    flight = SingleFlight('test')
+    started = []
+
+    def start_function():
+        started.append(Future())
+        return started[-1]
+
+    first_future = flight.submit('key', start_function)
+    second_future = flight.submit('key', start_function)
+    other_future = flight.submit('other-key', start_function)
+
+    assert first_future is second_future
+    assert other_future is not first_future
+    assert len(started) == 2
+
+
+def test_finished_call_is_started_again():
+    flight = SingleFlight('test')
+    future = flight.submit('key', Future)
+    future.set_result('first')
+
+    assert flight.submit('key', Future) is not future
+    assert 'key' in flight.calls
+
+
+def test_error_reaches_every_caller():
+    flight = SingleFlight('test')
+    futures = [flight.submit('key', Future) for _ in range(3)]
+    futures[0].set_exception(RuntimeError('failed'))
+
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result()
+
+    assert flight.calls == {}
+
+
+def test_coroutine_is_run_once_for_concurrent_callers():
+    flight = SingleFlight('test')
+    calls = []
+
+    async def fetch():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def run():
+        return await asyncio.gather(*[flight.submit_async('key', fetch) for _ in range(5)])
+
+    assert asyncio.run(run()) == ['result'] * 5
+    assert len(calls) == 1
+    assert flight.calls == {} and flight.tasks == set()
+
+
+def test_async_callers_share_a_call_started_with_submit():
+    flight = SingleFlight('test')
+    future = flight.submit('key', Future)
+
+    async def fetch():
+        raise AssertionError('The call in flight should have been shared')
+
+    async def run():
+        asyncio.get_running_loop().call_later(0.05, future.set_result, 'result')
+        return await flight.submit_async('key', fetch)
+
+    assert asyncio.run(run()) == 'result'
+
+
+@pytest.mark.skipif(coalesce_service.fcntl is None, reason='Requests are only coalesced within the process without fcntl')
+def test_host_lock_holds_up_other_callers_for_the_same_key():
+    entered = [threading.Event(), threading.Event()]
+    release = threading.Event()
+
+    def hold_lock(index: int):
+        with host_lock('key'):
+            entered[index].set()
+            release.wait(5)
+
+    threads = [threading.Thread(target=hold_lock, args=(index,)) for index in range(2)]
+    threads[0].start()
+    entered[0].wait(5)
+    threads[1].start()
+
+    assert not entered[1].wait(0.2)
+
+    release.set()
+
+    assert entered[1].wait(5)
+
+    for thread in threads:
+        thread.join()
+
+
+@pytest.mark.parametrize('async_provider', [False, True])
+def test_concurrent_lookups_share_their_upstream_calls(app, monkeypatch, upstreams, upstream_requests, async_provider):
+    monkeypatch.setitem(app.config, 'ASYNC_PROVIDER', async_provider)
+    monkeypatch.setattr(upstreams['musicbrainz'], 'latency', 0.3)
+
+    with ThreadPoolExecutor(4) as executor:
+        responses = list(executor.map(lambda x: app.test_client().get('/lookup/song/T1'), range(4)))
+
+    assert [response.status_code for response in responses] == [200] * 4
+
+    # One call for the recording, and one for the albums it is on
+    assert len(upstream_requests['musicbrainz']) == 2
@@ -0,0 +1,142 @@
+import pytest
+
+from src import cache
+from src.services.budget_service import LookupBudget
+from src.services.lookup_cache_service import app_config, lookup_refreshes, get_etag, store_lookup_result
+
+# The lookups, along with the keys their results are cached under (with the default page size)
+LOOKUPS = [
+    ('/lookup/artist/A1', 'lookup-music-brainz-artist-A1-10'),
+    ('/lookup/album/RG1?artistId=A1', 'lookup-music-brainz-album-RG1-A1')
+]
+
+
+def age_lookup(cache_key: str, seconds: float):
+    """Makes the cached result of a lookup look as if it was stored the given number of seconds earlier"""
+    entry = cache.get(cache_key)
+    entry['stored_at'] -= seconds
+    cache.set(cache_key, entry)
+
+
+def wait_for_refresh(cache_key: str):
+    future = lookup_refreshes.calls.get(cache_key)
+
+    if future is not None:
+        future.result(timeout=10)
+
+
+@pytest.mark.parametrize('async_provider', [False, True])
+@pytest.mark.parametrize('path, cache_key', LOOKUPS)
+def test_stale_result_is_refreshed_from_the_upstreams(app, client, monkeypatch, upstream_requests, async_provider, path, cache_key):
+    monkeypatch.setitem(app.config, 'ASYNC_PROVIDER', async_provider)
+    body = client.get(path).get_json()
+    age_lookup(cache_key, app_config.LOOKUP_FRESH_AGE + 1)
+
+    for paths in upstream_requests.values():
+        paths.clear()
+
+    response = client.get(path)
+    wait_for_refresh(cache_key)
+
+    assert response.headers['X-Cache-Status'] == 'stale'
+    assert response.get_json() == body
+
+    # The cached responses, images and description are all still within their own timeouts, so these were only made because of the refresh
+    assert all(upstream_requests.values())
+    assert client.get(path).headers['X-Cache-Status'] == 'fresh'
+
+
+@pytest.mark.parametrize('path, cache_key', LOOKUPS)
+def test_fresh_result_is_served_from_the_cache(client, upstream_requests, path, cache_key):
+    first_response = client.get(path)
+
+    for paths in upstream_requests.values():
+        paths.clear()
+
+    response = client.get(path)
+
+    assert first_response.headers['X-Cache-Status'] == 'miss'
+    assert response.headers['X-Cache-Status'] == 'fresh'
+    assert response.get_json() == first_response.get_json()
+    assert not any(upstream_requests.values())
+
+
+@pytest.mark.parametrize('path, cache_key', LOOKUPS)
+def test_result_is_stale_until_the_grace_period_ends(client, path, cache_key):
+    client.get(path)
+    age_lookup(cache_key, app_config.LOOKUP_FRESH_AGE + app_config.LOOKUP_STALE_GRACE - 60)
+
+    assert client.get(path).headers['X-Cache-Status'] == 'stale'
+
+    wait_for_refresh(cache_key)
+    age_lookup(cache_key, app_config.LOOKUP_FRESH_AGE + app_config.LOOKUP_STALE_GRACE + 1)
+
+    assert client.get(path).headers['X-Cache-Status'] == 'miss'
+
+
+def test_etag_does_not_depend_on_key_order():
+    assert get_etag({'id': 'A1', 'name': 'Band', 'tags': [1, 2]}) == get_etag({'tags': [1, 2], 'name': 'Band', 'id': 'A1'})
+    assert get_etag({'id': 'A1', 'tags': [1, 2]}) != get_etag({'id': 'A1', 'tags': [2, 1]})
+
+
+@pytest.mark.parametrize('fast_serialization', [False, True])
+@pytest.mark.parametrize('path, cache_key', LOOKUPS)
+def test_etag_is_stable_and_matches_the_body(app, client, monkeypatch, fast_serialization, path, cache_key):
+    monkeypatch.setitem(app.config, 'FAST_SERIALIZATION', fast_serialization)
+    first_response = client.get(path)
+    response = client.get(path)
+
+    assert response.headers['X-Cache-Status'] == 'fresh'
+    assert response.headers['ETag'] == first_response.headers['ETag']
+    assert response.headers['ETag'] == f'"{get_etag(response.get_json())}"'
+
+
+@pytest.mark.parametrize('fast_serialization', [False, True])
+@pytest.mark.parametrize('path, cache_key', LOOKUPS)
+def test_matching_etag_gets_not_modified(app, client, monkeypatch, fast_serialization, path, cache_key):
+    monkeypatch.setitem(app.config, 'FAST_SERIALIZATION', fast_serialization)
+    etag = client.get(path).headers['ETag']
+
+    response = client.get(path, headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+    assert client.get(path, headers={'If-None-Match': '"outdated"'}).status_code == 200
+
+
+def test_partial_result_is_not_stored():
+    budget = LookupBudget()
+    budget.omitted.update(['images', 'description'])
+
+    etag, omitted = store_lookup_result('lookup-partial', {'id': 'A1'}, budget, cache)
+
+    assert omitted == ['description', 'images']
+    assert cache.get('lookup-partial') is None
+
+
+@pytest.mark.parametrize('async_provider', [False, True])
+@pytest.mark.parametrize('path, cache_key', LOOKUPS)
+def test_partial_response_is_not_cached(app, client, monkeypatch, upstreams, async_provider, path, cache_key):
+    monkeypatch.setitem(app.config, 'ASYNC_PROVIDER', async_provider)
+    monkeypatch.setattr(app_config, 'LOOKUP_BUDGET', 0.2)
+
+    for name in ['fanart', 'wikidata']:
+        monkeypatch.setattr(upstreams[name], 'latency', 1.0)
+
+    response = client.get(path)
+
+    assert response.status_code == 200
+    assert response.headers['X-Partial-Response'] == 'description, images'
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert 'ETag' not in response.headers
+    assert cache.get(cache_key) is None
+
+    # Without a budget, the next request waits for the parts that were left out, and its complete result is cached as usual
+    monkeypatch.setattr(app_config, 'LOOKUP_BUDGET', 0.0)
+    response = client.get(path)
+
+    assert response.headers['X-Cache-Status'] == 'miss'
+    assert 'X-Partial-Response' not in response.headers
+    assert 'ETag' in response.headers
+    assert cache.get(cache_key) is not None
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+# Each route the providers serve, along with the errors they have to report the same way
+PATHS = [
+    '/lookup/artist/A1',
+    '/lookup/album/RG1?artistId=A1',
+    '/lookup/song/T1',
+    '/lookup/discography/artist/A1?discogType=album',
+    '/lookup/discography/artist/A1?discogType=single_ep',
+    '/lookup/discography/song/T1',
+    '/search/artist?query=Band',
+    '/search/song?query=Song%20artist:Band',
+    '/lookup/artist/A404',
+    '/lookup/discography/foo/A1',
+    '/search/foo?query=x'
+]
+
+COMPARED_HEADERS = ['Content-Type', 'ETag', 'Cache-Control', 'X-Cache-Status', 'X-Partial-Response']
+
+
+def get_wsgi_response(client, path: str):
+    response = client.get(path)
+
+    return response.status_code, response.get_data(as_text=True), {key: response.headers.get(key) for key in COMPARED_HEADERS}
+
+
+def get_asgi_response(path: str):
+    from src import asgi_app
+
+    route, _, query = path.partition('?')
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': route,
+             'raw_path': route.encode('ascii'), 'query_string': query.encode('ascii'), 'root_path': '', 'headers': [(b'host', b'localhost')],
+             'client': ('127.0.0.1', 50000), 'server': ('localhost', 80)}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+
+    headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in messages[0]['headers']}
+    body = b''.join(message.get('body', b'') for message in messages[1:]).decode('utf-8')
+
+    return messages[0]['status'], body, {key: headers.get(key.lower()) for key in COMPARED_HEADERS}
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_async_provider_matches_sync_provider(app, client, monkeypatch, path):
+    from src import cache
+
+    expected = get_wsgi_response(client, path)
+
+    cache.clear()
+    monkeypatch.setitem(app.config, 'ASYNC_PROVIDER', True)
+
+    assert get_wsgi_response(client, path) == expected
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_asgi_adapter_matches_wsgi_app(app, client, monkeypatch, path):
+    from src import cache
+
+    expected = get_wsgi_response(client, path)
+
+    cache.clear()
+    monkeypatch.setitem(app.config, 'ASYNC_PROVIDER', True)
+
+    assert get_asgi_response(path) == expected
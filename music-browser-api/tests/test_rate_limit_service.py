@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from src.enums.enums import RequestPriority
+from src.services.rate_limit_service import RateLimiter
+
+INTERVAL = 0.1
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    return os.path.join(tmp_path, 'rate-limit')
+
+
+def test_slots_are_spaced_out_by_the_interval(state_file):
+    limiter = RateLimiter('test', INTERVAL, state_file)
+    begin_time = time.time()
+    slots = [limiter.reserve_slot() for _ in range(3)]
+
+    assert slots[0] == pytest.approx(begin_time, abs=0.05)
+    assert slots[1] - slots[0] == pytest.approx(INTERVAL, abs=0.001)
+    assert slots[2] - slots[1] == pytest.approx(INTERVAL, abs=0.001)
+
+
+def test_schedule_is_shared_through_the_state_file(state_file):
+    # Each limiter stands in for a different worker process
+    limiters = [RateLimiter('test', INTERVAL, state_file) for _ in range(2)]
+    slots = [limiters[index % 2].reserve_slot() for index in range(4)]
+
+    for earlier_slot, slot in zip(slots, slots[1:]):
+        assert slot - earlier_slot == pytest.approx(INTERVAL, abs=0.001)
+
+
+def test_slot_is_refused_beyond_the_backlog(state_file):
+    limiter = RateLimiter('test', INTERVAL, state_file)
+
+    for _ in range(5):
+        limiter.reserve_slot()
+
+    backlog = limiter.backlog()
+
+    assert backlog == pytest.approx(5 * INTERVAL, abs=0.05)
+    assert limiter.reserve_slot(max_backlog=INTERVAL) is None
+
+    # A refused caller doesn't book anything
+    assert limiter.backlog() <= backlog
+    assert limiter.reserve_slot(max_backlog=10 * INTERVAL) is not None
+
+
+def test_book_slot():
+    limiter = RateLimiter('test', INTERVAL, '')
+    now = time.time()
+
+    slot, next_slot = limiter.book_slot(0.0)
+
+    assert slot == pytest.approx(now, abs=0.05)
+    assert next_slot == slot + INTERVAL
+    assert limiter.book_slot(now + 1.0) == (now + 1.0, now + 1.0 + INTERVAL)
+    assert limiter.book_slot(now + 1.0, max_backlog=0.5) == (None, now + 1.0)
+
+
+def test_wait_sleeps_until_the_slot(state_file):
+    limiter = RateLimiter('test', INTERVAL, state_file)
+    begin_time = time.monotonic()
+
+    for _ in range(3):
+        limiter.wait()
+
+    assert time.monotonic() - begin_time >= 2 * INTERVAL
+
+
+def test_background_wait_backs_off_while_the_schedule_is_booked(state_file):
+    limiter = RateLimiter('test', INTERVAL, state_file)
+    next_slot = [limiter.reserve_slot() for _ in range(4)][-1] + INTERVAL
+
+    thread = threading.Thread(target=limiter.wait, args=(RequestPriority.BACKGROUND,))
+    thread.start()
+    time.sleep(INTERVAL / 2)
+
+    # Another worker's interactive request still gets the next free slot, since the background caller hasn't booked one yet
+    interactive_slot = RateLimiter('test', INTERVAL, state_file).reserve_slot()
+    thread.join()
+
+    assert interactive_slot == pytest.approx(next_slot, abs=0.01)
+
+
+def test_wait_async_shares_the_schedule_with_wait(state_file):
+    limiter = RateLimiter('test', INTERVAL, state_file)
+    begin_time = time.monotonic()
+
+    async def run():
+        for _ in range(2):
+            await limiter.wait_async()
+
+    limiter.wait()
+    asyncio.run(run())
+
+    assert time.monotonic() - begin_time >= 2 * INTERVAL
+    assert limiter.backlog() <= INTERVAL
@@ -0,0 +1,185 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import os
+import statistics
+import sys
+import threading
+import time
+
+from src import app
+from src.enums.enums import EntityType, DiscographyType
+from src.services.executor_service import shutdown_executors
+from src.services.shared_service import supported_data_provider
+
+
+class Pacer:
+    """Spaces out the start of each lookup so no more than the given number start per second, across all of the workers"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        with self.lock:
+            start = max(time.monotonic(), self.next_start)
+            self.next_start = start + self.interval
+
+        delay = start - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def read_entries(path: str, default_entity_type: str):
+    entries = []
+
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            entry = read_entry(line, line_number, default_entity_type)
+
+            if entry:
+                entries.append(entry)
+
+    return entries
+
+
+def read_entry(line: str, line_number: int, default_entity_type: str):
+    """
+        Each line of the file has an entity type (artist, album or song) followed by an MBID, or just an MBID if a default entity type was given.
+        An album can also have the MBID of its artist after its own, which is how album lookups are usually made. Blank lines and lines starting
+        with # are skipped.
+    """
+    parts = line.split()
+
+    if not parts or parts[0].startswith('#'):
+        return None
+
+    if parts[0] not in [EntityType.ARTIST.value, EntityType.ALBUM.value, EntityType.SONG.value]:
+        if not default_entity_type:
+            raise ValueError(f'Line {line_number} has no entity type, and no default was given')
+
+        parts.insert(0, default_entity_type)
+
+    return ' '.join(parts[:3] if parts[0] == EntityType.ALBUM.value else parts[:2])
+
+
+def get_urls(entry: str, page_size: int):
+    """The requests a visitor would make for the entity, so that the lookup results and everything they are built from end up in the cache"""
+    parts = entry.split()
+    entity_type, entity_id = parts[0], parts[1]
+
+    match entity_type:
+        case EntityType.ARTIST.value:
+            return [f'/lookup/artist/{entity_id}?pageSize={page_size}'] + \
+                   list(map(lambda x: f'/lookup/discography/artist/{entity_id}?discogType={x.value}&pageSize={page_size}', DiscographyType))
+        case EntityType.ALBUM.value:
+            return [f'/lookup/album/{entity_id}' + (f'?artistId={parts[2]}' if len(parts) > 2 else '')]
+        case EntityType.SONG.value:
+            return [f'/lookup/song/{entity_id}?pageSize={page_size}',
+                    f'/lookup/discography/song/{entity_id}?discogType={DiscographyType.ALBUM.value}&pageSize={page_size}']
+
+    return []
+
+
+def warm_entry(entry: str, page_size: int, pacer: Pacer):
+    pacer.wait()
+
+    client = app.test_client()
+    begin_time = time.monotonic()
+    cache_statuses = []
+    error = None
+
+    for url in get_urls(entry, page_size):
+        response = client.get(url)
+
+        if response.status_code != 200:
+            error = f'{url} returned {response.status_code}'
+            break
+
+        cache_statuses.append(response.headers.get('X-Cache-Status', ''))
+
+    return {'entry': entry, 'duration': time.monotonic() - begin_time, 'cache_statuses': cache_statuses, 'error': error}
+
+
+def print_summary(results: list, skipped: int, total_time: float):
+    print(f'\nWarmed {len([x for x in results if not x['error']])} of {len(results)} entries in {datetime.timedelta(seconds=round(total_time))}'
+          f' ({skipped} skipped as already done)')
+
+    for entity_type in [EntityType.ARTIST.value, EntityType.ALBUM.value, EntityType.SONG.value]:
+        durations = sorted(x['duration'] for x in results if x['entry'].split()[0] == entity_type and not x['error'])
+
+        if durations:
+            p95 = durations[min(int(len(durations) * 0.95), len(durations) - 1)]
+            print(f'  {entity_type}: {len(durations)} done, mean {statistics.mean(durations):.2f}s, median {statistics.median(durations):.2f}s, '
+                  f'p95 {p95:.2f}s, max {durations[-1]:.2f}s')
+
+    statuses = [status for x in results for status in x['cache_statuses']]
+
+    if statuses:
+        print('  Lookup cache: ' + ', '.join(f'{statuses.count(x)} {x}' for x in sorted(set(statuses))))
+
+    failures = [x for x in results if x['error']]
+
+    if failures:
+        print(f'  {len(failures)} failed (these will be retried on the next run):')
+
+        for failure in failures:
+            print(f'    {failure['entry']}: {failure['error']}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warms the caches for a list of MusicBrainz entities, by looking each of them up the way the API does')
+    parser.add_argument('file', help='A file with one entity per line, e.g. "artist <MBID>", "album <MBID> [<artist MBID>]" or "song <MBID>"')
+    parser.add_argument('--entity-type', choices=[EntityType.ARTIST.value, EntityType.ALBUM.value, EntityType.SONG.value],
+                        help='The entity type for lines that only have an MBID')
+    parser.add_argument('--concurrency', type=int, default=2, help='How many entities are looked up at the same time')
+    parser.add_argument('--rate', type=float, default=1.0, help='The most entities started per second (0 for no limit)')
+    parser.add_argument('--page-size', type=int, default=10, choices=[10, 25], help='The page size the lookups are made with')
+    parser.add_argument('--progress-file', help='Where finished entities are recorded, so an interrupted run can carry on from where it stopped '
+                                                '(defaults to the input file name plus .progress)')
+    parser.add_argument('--restart', action='store_true', help='Ignore the progress file, and warm every entity again')
+    args = parser.parse_args()
+
+    if app.config['DATA_PROVIDER'] is None or not supported_data_provider(app.config['DATA_PROVIDER']):
+        print('Missing or unsupported data provider configuration, shutting down')
+        sys.exit(1)
+
+    progress_file = args.progress_file or f'{args.file}.progress'
+    entries = read_entries(args.file, args.entity_type)
+    done = set()
+
+    if os.path.exists(progress_file) and not args.restart:
+        with open(progress_file, encoding='utf-8') as file:
+            done = set(map(lambda x: x.strip(), file))
+
+    pending = [x for x in entries if x not in done]
+    pacer = Pacer(args.rate)
+    results = []
+    begin_time = time.monotonic()
+
+    print(f'Warming {len(pending)} entities ({len(entries) - len(pending)} already done) with {args.concurrency} workers')
+
+    with open(progress_file, 'w' if args.restart else 'a', encoding='utf-8') as progress, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = list(map(lambda x: executor.submit(warm_entry, x, args.page_size, pacer), pending))
+
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            if not result['error']:
+                progress.write(result['entry'] + '\n')
+                progress.flush()
+
+            status = result['error'] or ', '.join(result['cache_statuses'])
+            print(f'[{len(results)}/{len(pending)}] {result['entry']}: {result['duration']:.2f}s ({status})')
+
+    # Refreshes, search index updates and prefetches started by the lookups are left to finish, so they end up in the cache too
+    shutdown_executors(wait=True)
+    print_summary(results, len(entries) - len(pending), time.monotonic() - begin_time)
+
+
+if __name__ == '__main__':
+    main()